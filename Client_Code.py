@@ -1,59 +1,264 @@
 import socket  # socket operations
 import json  # For JSON encoding/decoding
+import select
+
+import columnar
+from journal import Journal
+from protocol import MAGIC, encode_frame, recv_frame
 
 class Client:
-    def __init__(self, host, port):
+    def __init__(self, host, port, journal=None, compact=False):
         # Initialise the client socket and connect to the server.
         # host: Server hostname or IP address
         # port: Server port number
+        # journal: journal.Journal receiving the transaction log, or None for no log. The caller
+        #          closes it; clients in one process should share one rather than open the same file
+        # compact: ask for product lists and carts in the columnar encoding instead of JSON
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # Create a socket object
         self.s.connect((host, port))  # Connect to the server
+        self.s.sendall(MAGIC)  # Switch the connection to the framed protocol
+        self.next_request_id = 1
+        self.catalog = None  # Last product list received
+        self.catalog_version = None  # Its version, sent back so unchanged catalogs are not resent
+        self.subscription_id = None  # Request id of SUBSCRIBE; pushed updates carry it
+        self.feed_seq = None  # Last change feed sequence applied, for resuming after a reconnect
+        self.feed_epoch = None  # The feed that sequence belongs to; a restarted server has a new one
+        self._products_by_id = {}
+        self._resubscribe = False
+        self.on_update = None  # Called with every change feed update after it is applied
+        self.journal = journal
+        self.compact = compact and self.request('ENCODING columnar') == 'ENCODING columnar'
+
+    def _new_request_id(self):
+        request_id = self.next_request_id
+        self.next_request_id = (self.next_request_id % 0xFFFFFFFF) + 1
+        return request_id
+
+    def send_requests(self, commands):
+        # Pipeline several commands: all frames go out in one write, then the replies
+        # are collected and returned in the same order as the commands.
+        return [payload.decode('utf-8') for payload in self.send_raw_requests(commands)]
+
+    def send_raw_requests(self, commands):
+        # send_requests, but the replies are returned as bytes (needed for columnar replies).
+        request_ids = [self._new_request_id() for _ in commands]
+        self.s.sendall(b''.join(encode_frame(request_id, command)
+                                for request_id, command in zip(request_ids, commands)))
+        return self._collect(request_ids)
+
+    def _collect(self, request_ids):
+        # Read frames until every request in request_ids is answered. Catalog updates
+        # pushed for SUBSCRIBE in the meantime are applied on the way.
+        replies = {}
+        while len(replies) < len(request_ids):
+            frame = recv_frame(self.s)
+            if frame is None:
+                raise ConnectionError("Server closed the connection")
+            request_id, payload = frame
+            if request_id in request_ids and request_id not in replies:
+                replies[request_id] = payload
+            elif request_id == self.subscription_id:
+                self._apply_update(json.loads(payload))
+        return [replies[request_id] for request_id in request_ids]
+
+    def request(self, command):
+        # Send one command and wait for its reply.
+        return self.send_requests([command])[0]
+
+    def subscribe(self):
+        # Keep self.catalog current from the server's change feed instead of refetching it.
+        # After a reconnect this resumes from the last sequence seen, so only the missed
+        # changes are sent (a server that restarted since sends a full snapshot instead).
+        # Updates are applied by poll_updates and by every request.
+        request_id = self._new_request_id()
+        command = 'SUBSCRIBE' if self.feed_seq is None else f'SUBSCRIBE {self.feed_seq} {self.feed_epoch}'
+        self.s.sendall(encode_frame(request_id, command))
+        self.subscription_id = request_id
+        self._resubscribe = False
+        try:
+            update = json.loads(self._collect([request_id])[0])  # A snapshot or the missed changes
+        except ValueError:
+            self.subscription_id = None  # Server without SUBSCRIBE: keep fetching the whole list
+            return False
+        self._apply_update(update)
+        return True
+
+    def poll_updates(self, timeout=0.0):
+        # Apply the catalog updates that arrive within timeout seconds. Returns how many arrived.
+        applied = 0
+        while select.select([self.s], [], [], timeout)[0]:
+            frame = recv_frame(self.s)
+            if frame is None:
+                raise ConnectionError("Server closed the connection")
+            request_id, payload = frame
+            if request_id == self.subscription_id:
+                self._apply_update(json.loads(payload))
+                applied += 1
+            timeout = 0.0  # Only wait for the first one
+        return applied
+
+    def _apply_update(self, update):
+        if update['type'] == 'snapshot':
+            self.catalog = update['products']
+            self.catalog_version = None  # Not comparable with the feed's sequence numbers
+            self._products_by_id = {product['id']: product for product in self.catalog}
+            self.feed_seq = update['seq']
+            self.feed_epoch = update['epoch']
+        elif update['type'] == 'delta':
+            for change in update['changes']:
+                product = self._products_by_id.get(change['id'])
+                if product is not None:
+                    product['price'] = change['price']
+                    product['stock'] = change['stock']
+            self.feed_seq = update['seq']
+            self.feed_epoch = update['epoch']
+        else:  # resync: we fell behind and were dropped; fetch_products subscribes again
+            self.feed_seq = None
+            self.feed_epoch = None
+            self.subscription_id = None
+            self._resubscribe = True
+        if self.on_update:
+            self.on_update(update)
+
+    def fetch_products(self):
+        # Return the product list, reusing the cached copy if the server says it is current.
+        if self._resubscribe:
+            self.subscribe()
+        if self.subscription_id is not None:
+            self.poll_updates()
+            return self.catalog  # Kept current by the change feed
+        if self.catalog_version is None:
+            command = 'VIEW_PRODUCTS -1'
+        else:
+            command = f'VIEW_PRODUCTS {self.catalog_version}'
+        if self.compact:
+            response = self.send_raw_requests([command])[0]
+            if not response.startswith(b'NOT_MODIFIED'):
+                self.catalog_version, self.catalog = columnar.decode(response)
+            return self.catalog
+        response = self.request(command)
+        if not response.startswith('NOT_MODIFIED'):
+            catalog = json.loads(response)  # Parse JSON response
+            self.catalog = catalog['products']
+            self.catalog_version = catalog['version']
+        return self.catalog
+
+    def query_products(self, **params):
+        # Fetch one page of the catalog, e.g. query_products(sort='price', max_price=20, limit=10).
+        # Pass the returned next_cursor back as cursor= to get the following page.
+        return json.loads(self.request(f'QUERY_PRODUCTS {json.dumps(params)}'))
+
+    def start_session(self):
+        # Keep this connection's cart on the server under a session token and return the token.
+        # Pass it to resume_session on a later connection to carry on with the same cart.
+        response = self.request('SESSION')
+        if not response.startswith('SESSION '):
+            raise RuntimeError(response)
+        return response.split()[1]
+
+    def resume_session(self, token):
+        # Attach the server-side cart of an earlier session. Returns False if it has expired.
+        response = self.request(f'RESUME {token}')
+        print(response)
+        return response.startswith('Resumed')
 
     def display_products(self):
-        self.s.sendall(b'VIEW_PRODUCTS')  # Send request to view products
-        products = self.s.recv(1024).decode('utf-8')  # Receive product list from the server
-        product_list = json.loads(products)  # Parse JSON response into a Python list
+        product_list = self.fetch_products()  # Receive product list from the server
         print("\nAvailable Products:")
         for product in product_list:
             print(f"ID: {product['id']} | Name: {product['name']} | Price: £{product['price']} | Stock: {product['stock']}")
 
     def add_to_cart(self, product_id, quantity):
-        self.s.sendall(f'ADD_TO_CART {product_id} {quantity}'.encode('utf-8'))  # Send add-to-cart request
-        response = self.s.recv(1024).decode('utf-8')  # Receive server's response
-        self.log_transaction(f"Added to cart: Product ID {product_id}, Quantity {quantity}")
+        response = self.request(f'ADD_TO_CART {product_id} {quantity}')  # Send add-to-cart request
+        self.log_transaction('add_to_cart', product_id=product_id, quantity=quantity, response=response)
         print(response)
+        return response
+
+    def remove_from_cart(self, product_id):
+        print(self.request(f'REMOVE_FROM_CART {product_id}'))
+
+    def update_quantity(self, product_id, quantity):
+        # Set the quantity of a cart line directly instead of rebuilding the cart
+        print(self.request(f'UPDATE_QTY {product_id} {quantity}'))
 
     def view_cart(self):
-        self.s.sendall(b'VIEW_CART')  # Send request to view cart
-        cart_contents = self.s.recv(1024).decode('utf-8')  # Receive cart contents
-        cart = json.loads(cart_contents)  # Parse JSON response into a Python list
+        if self.compact:
+            _, cart = columnar.decode(self.send_raw_requests(['VIEW_CART'])[0])
+        else:
+            cart_contents = self.request('VIEW_CART')  # Receive cart contents
+            cart = json.loads(cart_contents)  # Parse JSON response into a Python list
         print("\nYour Cart:")
         for item in cart:
             print(f"ID: {item['id']} | Name: {item['name']} | Quantity: {item['quantity']} | Price: £{item['price']}")
 
     def checkout(self):
-        self.s.sendall(b'CHECKOUT')  # Send checkout request
-        response = self.s.recv(1024).decode('utf-8')  # Receive server's response
+        response = self.request('CHECKOUT')  # Receive server's response
         print(f"Server response: {response}")  # Debugging output
 
         # Log the result of the checkout process
-        self.log_transaction(f"Checkout response: {response}")
+        self.log_transaction('checkout', response=response)
+        return response
+
+    def batch(self, commands):
+        # Run several commands as one BATCH: a single frame out and a single reply back,
+        # executed by the server in one critical section. Stops at the first command that
+        # fails and undoes its cart changes back to the last successful CHECKOUT.
+        # Returns (ok, replies of the commands that ran, how many of them took effect):
+        # when ok is False, replies[:committed] still happened, including any order placed.
+        result = json.loads(self.request('BATCH ' + json.dumps(commands)))
+        if 'error' in result:
+            raise ValueError(result['error'])
+        return result['ok'], result['replies'], result['committed']
+
+    def add_many(self, items):
+        # Add several products in one round trip. items: iterable of (product_id, quantity).
+        # All or nothing: if one line cannot be added the cart is left unchanged.
+        items = list(items)
+        ok, replies, _ = self.batch([f'ADD_TO_CART {product_id} {quantity}' for product_id, quantity in items])
+        self.log_transaction('add_many', items=items, ok=ok, response=replies[-1] if replies else None)
+        print(replies[-1] if replies and not ok else f"Added {len(items)} line(s) to cart.")
+        return ok, replies
+
+    def checkout_batch(self, items):
+        # Add items and check out in one round trip, e.g. checkout_batch([(1, 2), (4, 1)]).
+        # Anything already in the cart is checked out with them. Returns the checkout
+        # result {'success': ..., 'message': ...}; on failure the cart is left as it was
+        # before the call.
+        items = list(items)
+        commands = [f'ADD_TO_CART {product_id} {quantity}' for product_id, quantity in items] + ['CHECKOUT']
+        ok, replies, _ = self.batch(commands)
+        if len(replies) == len(commands):
+            result = json.loads(replies[-1])  # The CHECKOUT reply
+        else:
+            result = {'success': False, 'message': replies[-1]}  # An ADD_TO_CART failed
+        print(f"Server response: {json.dumps(result)}")
+        self.log_transaction('checkout', items=items, response=json.dumps(result))
+        return result
+
+    def run_session(self, commands):
+        # Send a whole session (e.g. several ADD_TO_CART followed by CHECKOUT) in one
+        # round trip and return the replies in order.
+        return self.send_requests(commands)
 
     def close(self):
         self.s.close()  # Close the socket connection
 
-    def log_transaction(self, message):
-        # Log the transaction details to the transaction.txt file
-        with open('transaction.txt', 'a') as file:
-            file.write(f"{message}\n")
+    def log_transaction(self, op, **fields):
+        # Record the transaction in the journal. Queued for the journal's writer thread,
+        # so the request path never waits on the file.
+        if self.journal is not None:
+            self.journal.append(op, **fields)
 
 
 def main(): # clients purchase process 
+    journal = Journal()  # transaction.jsonl
     try:
-        client = Client('localhost', 5000)
+        client = Client('localhost', 5000, journal=journal)
     except Exception as e:
         print(f"Error connecting to server: {e}")
+        journal.close()
         return
+    client.subscribe()  # Product listings stay current without refetching the catalog
 
     print('\nWelcome to the shopping system')
     try:
@@ -62,8 +267,11 @@ def main(): # clients purchase process
             print("1. View Products")
             print("2. Add to Cart")
             print("3. View Cart")
-            print("4. Checkout")
-            print("5. Exit")
+            print("4. Remove from Cart")
+            print("5. Change Quantity")
+            print("6. Checkout")
+            print("7. Quick Checkout (several products in one go)")
+            print("8. Exit")
             choice = input("Enter your choice: ")
 
             if choice == '1':
@@ -81,14 +289,37 @@ def main(): # clients purchase process
             elif choice == '3':
                 client.view_cart()
             elif choice == '4':
-                client.checkout()
+                try:
+                    client.remove_from_cart(int(input("Enter Product ID: ")))
+                except ValueError:
+                    print("Invalid input. Please enter numbers only.")
             elif choice == '5':
+                try:
+                    product_id = int(input("Enter Product ID: "))
+                    quantity = int(input("Enter New Quantity (0 removes it): "))
+                    client.update_quantity(product_id, quantity)
+                except ValueError:
+                    print("Invalid input. Please enter numbers only.")
+            elif choice == '6':
+                client.checkout()
+            elif choice == '7':
+                try:
+                    # e.g. "1x2 4x1": two of product 1 and one of product 4
+                    entries = input("Enter products as <id>x<quantity>, separated by spaces: ").split()
+                    items = [tuple(int(part) for part in entry.split('x')) for entry in entries]
+                    if not items or any(len(item) != 2 or item[1] <= 0 for item in items):
+                        raise ValueError
+                    client.checkout_batch(items)
+                except ValueError:
+                    print("Invalid input. Use e.g. 1x2 4x1.")
+            elif choice == '8':
                 print("Thank You For Your Purchase!!")
                 break
             else:
                 print("Invalid choice. Please try again.")
     finally:
         client.close()
+        journal.close()  # Writes out whatever is still queued
 
 if __name__ == "__main__":
     main()
@@ -1,20 +1,47 @@
 import socket
 
+from protocol import MAGIC, encode_frame, recv_frame
+
+def send_batch(client_socket, commands, first_request_id):
+    # Pipeline a batch of commands in one write and print the replies in order.
+    request_ids = list(range(first_request_id, first_request_id + len(commands)))
+    client_socket.sendall(b''.join(encode_frame(request_id, command)
+                                   for request_id, command in zip(request_ids, commands)))
+    replies = {}
+    while len(replies) < len(request_ids):
+        frame = recv_frame(client_socket)
+        if frame is None:
+            print('Server closed the connection.')
+            return
+        request_id, payload = frame
+        replies[request_id] = payload.decode()
+    for command, request_id in zip(commands, request_ids):
+        print(f'Server response to {command}:', replies[request_id])
+
 def client_program():
     host = 'localhost'
     port = 5000
 
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     client_socket.connect((host, port))
+    client_socket.sendall(MAGIC)  # Use the framed protocol
 
+    # Commands are queued until SEND (or EXIT), then the whole batch goes to the
+    # server in one round trip.
+    batch = []
+    next_request_id = 1
     while True:
-        message = input("Enter command (VIEW_PRODUCTS, ADD_TO_CART <id> <quantity>, VIEW_CART, CHECKOUT, or EXIT): ")
-        if message == 'EXIT':
-            break
+        message = input("Enter command (VIEW_PRODUCTS, ADD_TO_CART <id> <quantity>, VIEW_CART, CHECKOUT, SEND or EXIT): ")
+        if message in ('SEND', 'EXIT'):
+            if batch:
+                send_batch(client_socket, batch, next_request_id)
+                next_request_id += len(batch)
+                batch = []
+            if message == 'EXIT':
+                break
+            continue
 
-        client_socket.send(message.encode())
-        response = client_socket.recv(1024).decode()
-        print('Server response:', response)
+        batch.append(message)
 
     client_socket.close()
 
@@ -1,39 +1,473 @@
+import argparse
+import itertools
 import sqlite3
 import socket
 import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import analytics
+from analytics import AnalyticsError, parse_report
+from catalog import DEFAULT_PAGE_SIZE, QueryError, encode_cursor, name_key, parse_query
+from metrics import METRICS, configure_logging, log
+
+# SQL is kept in module constants so every call passes the identical string and
+# sqlite3's per-connection statement cache hands back the already prepared statement.
+CREATE_PRODUCTS_SQL = (
+    'CREATE TABLE IF NOT EXISTS products ('
+    'id INTEGER PRIMARY KEY, name TEXT NOT NULL, price REAL NOT NULL, stock INTEGER NOT NULL)'
+)
+CREATE_TRANSACTIONS_SQL = (
+    'CREATE TABLE IF NOT EXISTS transactions ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, product_id INTEGER NOT NULL, '
+    'quantity INTEGER NOT NULL, price REAL NOT NULL, order_id INTEGER, created_at REAL)'
+)
+CREATE_ORDERS_SQL = (
+    'CREATE TABLE IF NOT EXISTS orders ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, created_at REAL NOT NULL, total REAL NOT NULL)'
+)
+# Secondary indexes for paginated catalog queries (see query_products)
+CREATE_PRODUCT_INDEXES_SQL = (
+    'CREATE INDEX IF NOT EXISTS idx_products_price ON products (price, id)',
+    'CREATE INDEX IF NOT EXISTS idx_products_name ON products (name COLLATE NOCASE, id)',
+)
+SELECT_PRODUCTS_SQL = 'SELECT id, name, price, stock FROM products'
+SELECT_PRICE_SQL = 'SELECT price FROM products WHERE id = ?'
+UPDATE_STOCK_SQL = 'UPDATE products SET stock = stock - ? WHERE id = ? AND stock >= ?'
+INSERT_ORDER_SQL = 'INSERT INTO orders (created_at, total) VALUES (?, ?)'
+INSERT_TRANSACTION_SQL = (
+    'INSERT INTO transactions (order_id, product_id, quantity, price, created_at) VALUES (?, ?, ?, ?, ?)'
+)
+# Databases from before transactions carried their order's time
+BACKFILL_TRANSACTION_TIMES_SQL = (
+    'UPDATE transactions SET created_at = (SELECT created_at FROM orders WHERE orders.id = transactions.order_id)'
+)
+# Bulk catalog loads (see InventoryDatabase.import_products)
+UPSERT_PRODUCT_SQL = (
+    'INSERT INTO products (id, name, price, stock) VALUES (?, ?, ?, ?) '
+    'ON CONFLICT (id) DO UPDATE SET name = excluded.name, price = excluded.price, stock = excluded.stock'
+)
+# Keyed by which of (name, price, stock) a row sets. Only the columns named in SET get
+# their indexes rewritten, so a price feed does not touch the name index.
+UPDATE_PRODUCT_SQL = {
+    present: 'UPDATE products SET ' + ', '.join(f'{column} = ?' for column, wanted in
+                                                 zip(('name', 'price', 'stock'), present) if wanted) + ' WHERE id = ?'
+    for present in itertools.product((False, True), repeat=3) if any(present)
+}
+DROP_PRODUCT_INDEXES_SQL = ('DROP INDEX IF EXISTS idx_products_price', 'DROP INDEX IF EXISTS idx_products_name')
+IMPORT_MODES = ('upsert', 'update')
+
+
+class ConnectionPool:
+    # Bounded pool of SQLite connections that the server's worker threads share.
+    # Connections are opened lazily, up to size of them, and reused afterwards.
+    def __init__(self, db_path, size=5, timeout=30.0):
+        self.db_path = db_path
+        self.timeout = timeout  # Seconds to wait for a free connection
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()  # Most recently used first, keeps its cache warm
+        self._all = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # isolation_level=None leaves transactions to us (see transaction()), so a
+        # single UPDATE commits by itself and multi-statement work is one BEGIN/COMMIT.
+        connection = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False,
+                                     isolation_level=None, cached_statements=256)
+        connection.execute('PRAGMA journal_mode=WAL')  # Readers no longer block the writer
+        connection.execute('PRAGMA synchronous=NORMAL')  # WAL stays durable across crashes of the process
+        with self._lock:
+            self._all.append(connection)
+        return connection
+
+    @contextmanager
+    def connection(self):
+        # Borrow a connection for the duration of a with block.
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError("Timed out waiting for a database connection")
+        try:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                connection = self._connect()
+            try:
+                yield connection
+            finally:
+                if connection.in_transaction:
+                    connection.execute('ROLLBACK')  # Never hand back a half-finished transaction
+                self._idle.put(connection)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            connections, self._all = self._all, []
+        for connection in connections:
+            connection.close()
+
+
+@contextmanager
+def transaction(connection):
+    # Run the with block as one write transaction: committed on success, rolled back on error.
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield connection
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+
+def update_products(connection, rows):
+    # Apply (id, name, price, stock) rows with None meaning "keep", one executemany per
+    # combination of fields present. Unknown product IDs are ignored. Returns the number
+    # of rows that matched a product (rows that set no field match nothing).
+    groups = {}
+    for row in rows:
+        groups.setdefault((row[1] is not None, row[2] is not None, row[3] is not None), []).append(row)
+    updated = 0
+    for present, group in groups.items():
+        if any(present):
+            cursor = connection.executemany(UPDATE_PRODUCT_SQL[present],
+                                            [tuple(value for value, wanted in zip(row[1:], present) if wanted)
+                                             + (row[0],) for row in group])
+            updated += cursor.rowcount  # Summed over the executemany
+    return updated
+
+
+class CheckoutRejected(Exception):
+    pass
+
+
+def insert_order(connection, lines, created_at=None):
+    # Write an order and its line items and add them to the sales rollups (see
+    # analytics.py). lines is a list of (product_id, quantity, price).
+    # Returns the new order ID. Must run inside a transaction.
+    total = sum(quantity * price for _, quantity, price in lines)
+    if created_at is None:
+        created_at = time.time()
+    order_id = connection.execute(INSERT_ORDER_SQL, (created_at, total)).lastrowid
+    connection.executemany(INSERT_TRANSACTION_SQL, [(order_id, product_id, quantity, price, created_at)
+                                                    for product_id, quantity, price in lines])
+    analytics.record_sales(connection, lines, created_at)
+    return order_id
+
+
+def apply_checkout(connection, cart):
+    # Decrement stock for every cart item and record the order, all or nothing.
+    # Runs inside a savepoint so it can share an outer transaction with other
+    # checkouts (see GroupCommitter). Prices come from the products table, not the client.
+    # Returns (success, message).
+    try:
+        items = [(int(item['id']), int(item['quantity'])) for item in cart]
+    except (KeyError, TypeError, ValueError):
+        return False, "Invalid cart format."
+
+    connection.execute('SAVEPOINT checkout')
+    try:
+        lines = []
+        for product_id, quantity in items:
+            if quantity <= 0:
+                raise CheckoutRejected(f"Invalid quantity for Product ID {product_id}.")
+            if connection.execute(UPDATE_STOCK_SQL, (quantity, product_id, quantity)).rowcount == 0:
+                raise CheckoutRejected(f"Insufficient stock for Product ID {product_id}.")
+            price = connection.execute(SELECT_PRICE_SQL, (product_id,)).fetchone()[0]
+            lines.append((product_id, quantity, price))
+        insert_order(connection, lines)
+    except CheckoutRejected as e:
+        connection.execute('ROLLBACK TO checkout')
+        connection.execute('RELEASE checkout')
+        return False, str(e)
+    except BaseException:
+        connection.execute('ROLLBACK TO checkout')
+        connection.execute('RELEASE checkout')
+        raise
+    connection.execute('RELEASE checkout')
+    return True, "Checkout successful."
+
+
+class GroupCommitter:
+    # Collects checkouts from many threads and commits them in shared transactions,
+    # so one fsync covers a whole batch. Each checkout still succeeds or fails on its
+    # own through its savepoint. A lone checkout is committed without waiting.
+    def __init__(self, pool, max_batch=64):
+        self.pool = pool
+        self.max_batch = max_batch
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+        self._thread.start()
+
+    def submit(self, cart):
+        # Queue a checkout and return a Future resolving to (success, message).
+        future = Future()
+        self._requests.put((cart, future))
+        return future
+
+    def _run(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            batch = [request]
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    request = self._requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                batch.append(request)
+            self._commit_batch(batch)
+            if stop:
+                return
+
+    def _commit_batch(self, batch):
+        results = []
+        started = METRICS.start()
+        try:
+            with self.pool.connection() as connection:
+                with transaction(connection):
+                    for cart, _ in batch:
+                        results.append(apply_checkout(connection, cart))
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        METRICS.observe('sqlite.commit_batch', started)
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def close(self):
+        self._requests.put(None)
+        self._thread.join()
+
 
 class InventoryDatabase:
-    def __init__(self, db_path):
+    def __init__(self, db_path, pool_size=5, group_commit=False):
         self.db_path = db_path
+        self.pool = ConnectionPool(db_path, pool_size)
+        # With group_commit, concurrent checkouts share transactions and fsyncs
+        self.committer = GroupCommitter(self.pool) if group_commit else None
+        # Catalog cache. Changes made through this object invalidate it at once; commits
+        # by any other connection or process (e.g. catalog_feed.py import) are noticed
+        # through PRAGMA data_version on a connection that never writes.
+        self.catalog_version = 0
+        self._catalog = None  # (version, list payload, versioned payload)
+        self._catalog_lock = threading.Lock()  # Also guards _watch
+        self._watch = None
+        self._data_version = None
+
+    # Create the tables if the database is new
+    def create_schema(self):
+        with self.pool.connection() as connection:
+            with transaction(connection):
+                connection.execute(CREATE_PRODUCTS_SQL)
+                connection.execute(CREATE_TRANSACTIONS_SQL)
+                connection.execute(CREATE_ORDERS_SQL)
+                for statement in CREATE_PRODUCT_INDEXES_SQL:
+                    connection.execute(statement)
+                columns = [row[1] for row in connection.execute('PRAGMA table_info(transactions)')]
+                if 'order_id' not in columns:  # Databases created before orders existed
+                    connection.execute('ALTER TABLE transactions ADD COLUMN order_id INTEGER')
+                if 'created_at' not in columns:
+                    connection.execute('ALTER TABLE transactions ADD COLUMN created_at REAL')
+                    connection.execute(BACKFILL_TRANSACTION_TIMES_SQL)
+                analytics.create_schema(connection)
 
     # Fetch all products from the database
     def get_product_list(self):
-        connection = sqlite3.connect(self.db_path)
-        cursor = connection.cursor()
-        cursor.execute('SELECT id, name, price, stock FROM products')
-        products = cursor.fetchall()
-        connection.close()
+        started = METRICS.start()
+        with self.pool.connection() as connection:
+            products = connection.execute(SELECT_PRODUCTS_SQL).fetchall()
+        METRICS.observe('sqlite.get_product_list', started)
         return [{'id': p[0], 'name': p[1], 'price': p[2], 'stock': p[3]} for p in products]
 
+    # Paginated, filtered catalog query served from the indexes (keyset pagination)
+    def query_products(self, sort='id', limit=DEFAULT_PAGE_SIZE, min_price=None, max_price=None,
+                       prefix=None, after=None):
+        conditions = []
+        params = []
+        if min_price is not None:
+            conditions.append('price >= ?')
+            params.append(min_price)
+        if max_price is not None:
+            conditions.append('price <= ?')
+            params.append(max_price)
+        if prefix:
+            # A range on the NOCASE index instead of LIKE, so the prefix needs no escaping
+            conditions.append('name >= ? COLLATE NOCASE AND name < ? COLLATE NOCASE')
+            params.extend([prefix, prefix + chr(0x10FFFF)])
+        if sort == 'price':
+            order = 'price, id'
+            if after is not None:
+                conditions.append('(price, id) > (?, ?)')
+                params.extend(after)
+        elif sort == 'name':
+            order = 'name COLLATE NOCASE, id'
+            if after is not None:
+                conditions.append('(name COLLATE NOCASE, id) > (?, ?)')
+                params.extend(after)
+        else:
+            order = 'id'
+            if after is not None:
+                conditions.append('id > ?')
+                params.append(after[0])
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+        sql = f'SELECT id, name, price, stock FROM products{where} ORDER BY {order} LIMIT ?'
+        started = METRICS.start()
+        with self.pool.connection() as connection:
+            rows = connection.execute(sql, params + [limit + 1]).fetchall()  # One extra row tells us if there is more
+        METRICS.observe('sqlite.query_products', started)
+        products = [{'id': p[0], 'name': p[1], 'price': p[2], 'stock': p[3]} for p in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            key = {'price': (last[2], last[0]), 'name': (name_key(last[1]), last[0])}.get(sort, (last[0],))
+            next_cursor = encode_cursor(sort, key)
+        return {'products': products, 'next_cursor': next_cursor}
+
+    # Sales report from the rollups; report and options as returned by analytics.parse_report
+    def sales_report(self, report, **options):
+        started = METRICS.start()
+        with self.pool.connection() as connection:
+            result = analytics.run_report(connection, report, **options)
+        METRICS.observe('sqlite.sales_report', started)
+        return result
+
+    # Recompute the sales rollups from the transactions table
+    def rebuild_rollups(self):
+        with self.pool.connection() as connection:
+            with transaction(connection):
+                analytics.rebuild_rollups(connection)
+
+    # Cached, pre-encoded catalog: (version, JSON list, {"version", "products"} JSON)
+    def catalog_snapshot(self):
+        with self._catalog_lock:
+            if self._watch is None:
+                self._watch = sqlite3.connect(self.db_path, check_same_thread=False)
+            data_version = self._watch.execute('PRAGMA data_version').fetchone()[0]
+            if data_version != self._data_version:  # Someone committed since the last look
+                self._data_version = data_version
+                self.catalog_version += 1
+            if self._catalog is not None and self._catalog[0] == self.catalog_version:
+                return self._catalog
+            version = self.catalog_version
+        products = json.dumps(self.get_product_list())
+        snapshot = (version, products.encode('utf-8'),
+                    f'{{"version": {version}, "products": {products}}}'.encode('utf-8'))
+        with self._catalog_lock:
+            if version == self.catalog_version:
+                self._catalog = snapshot
+        return snapshot
+
+    def _catalog_changed(self):
+        with self._catalog_lock:
+            self.catalog_version += 1
+
     # Update the stock of a product after purchase
     def update_inventory_in_db(self, product_id, quantity):
-        connection = sqlite3.connect(self.db_path)
-        cursor = connection.cursor()
-        cursor.execute('UPDATE products SET stock = stock - ? WHERE id = ? AND stock >= ?', (quantity, product_id, quantity))
-        updated = cursor.rowcount > 0  # Check if the update was successful
-        connection.commit()
-        connection.close()
+        with self.pool.connection() as connection:
+            cursor = connection.execute(UPDATE_STOCK_SQL, (quantity, product_id, quantity))
+            updated = cursor.rowcount > 0  # Check if the update was successful
+        if updated:
+            self._catalog_changed()
         return updated
 
     # Save a transaction to the transactions table
     def save_transaction_in_db(self, cart):
-        connection = sqlite3.connect(self.db_path)
-        cursor = connection.cursor()
-        for item in cart:
-            cursor.execute('INSERT INTO transactions (product_id, quantity, price) VALUES (?, ?, ?)',
-                           (item['id'], item['quantity'], item['price']))
-        connection.commit()
-        connection.close()
+        lines = [(item['id'], item['quantity'], item['price']) for item in cart]
+        with self.pool.connection() as connection:
+            with transaction(connection):
+                return insert_order(connection, lines)
+
+    # Check out a whole cart as one atomic transaction
+    def checkout(self, cart):
+        started = METRICS.start()
+        if self.committer:
+            success, message = self.committer.submit(cart).result()
+        else:
+            with self.pool.connection() as connection:
+                with transaction(connection):
+                    success, message = apply_checkout(connection, cart)
+        METRICS.observe('sqlite.checkout', started)  # Includes the wait for a group commit
+        if success:
+            self._catalog_changed()
+        return success, message
+
+    # Bulk load products from an iterable of (id, name, price, stock) tuples
+    def import_products(self, rows, mode='upsert', chunk_size=10000, commit_every=500000, progress=None):
+        # mode 'upsert' inserts new products and overwrites existing ones; 'update' only
+        # changes existing products, and a None field keeps its current value (price or
+        # stock feeds). rows is consumed chunk_size at a time, so a generator over a huge
+        # file is loaded in constant memory. Every commit_every rows are one transaction.
+        # progress(rows written so far) is called after each commit. Returns the number of
+        # rows written; in 'update' mode rows whose product does not exist do not count.
+        if mode not in IMPORT_MODES:
+            raise ValueError(f"mode must be one of {', '.join(IMPORT_MODES)}")
+        rows = iter(rows)
+        total = 0
+        with self.pool.connection() as connection:
+            # Into an empty table it is much cheaper to build the indexes once at the end
+            rebuild_indexes = mode == 'upsert' and connection.execute('SELECT 1 FROM products LIMIT 1').fetchone() is None
+            if rebuild_indexes:
+                with transaction(connection):
+                    for statement in DROP_PRODUCT_INDEXES_SQL:
+                        connection.execute(statement)
+            try:
+                while True:
+                    in_transaction = 0
+                    with transaction(connection):
+                        while in_transaction < commit_every:
+                            chunk = list(itertools.islice(rows, chunk_size))
+                            if not chunk:
+                                break
+                            if mode == 'update':
+                                total += update_products(connection, chunk)
+                            else:
+                                connection.executemany(UPSERT_PRODUCT_SQL, chunk)
+                                total += len(chunk)
+                            in_transaction += len(chunk)
+                    if progress and in_transaction:
+                        progress(total)
+                    if in_transaction < commit_every:
+                        break
+            finally:
+                if rebuild_indexes:
+                    with transaction(connection):
+                        for statement in CREATE_PRODUCT_INDEXES_SQL:
+                            connection.execute(statement)
+        self._catalog_changed()
+        return total
+
+    # Stream every product as (id, name, price, stock) tuples in ID order
+    def export_products(self, chunk_size=10000):
+        # One read transaction, so the export is a consistent snapshot even while
+        # checkouts carry on; rows are fetched chunk_size at a time.
+        with self.pool.connection() as connection:
+            connection.execute('BEGIN')
+            try:
+                cursor = connection.execute(SELECT_PRODUCTS_SQL + ' ORDER BY id')
+                while True:
+                    chunk = cursor.fetchmany(chunk_size)
+                    if not chunk:
+                        break
+                    yield from chunk
+            finally:
+                connection.execute('COMMIT')
+
+    def close(self):
+        if self.committer:
+            self.committer.close()
+        self.pool.close()
+        with self._catalog_lock:
+            if self._watch is not None:
+                self._watch.close()
+                self._watch = None
 
 # Function to handle client requests
 def handle_client(client_socket, db):
@@ -47,42 +481,68 @@ def handle_client(client_socket, db):
             action = request.get('action')
 
             if action == 'get_product_list':
-                # Retrieve products from the database
-                products = db.get_product_list()
-                client_socket.send(json.dumps(products).encode('utf-8'))
+                # Serve the cached catalog. A client that sends the version it already
+                # holds gets a short not_modified reply instead of the whole list.
+                version, products, versioned = db.catalog_snapshot()
+                if 'version' not in request:
+                    client_socket.sendall(products)
+                elif request['version'] == version:
+                    client_socket.sendall(json.dumps({'not_modified': True, 'version': version}).encode('utf-8'))
+                else:
+                    client_socket.sendall(versioned)
+            elif action == 'query_products':
+                # Paginated catalog browse: {"action": "query_products", "sort": ..., "cursor": ...}
+                try:
+                    result = db.query_products(**parse_query(request))
+                except QueryError as e:
+                    result = {'error': str(e)}
+                client_socket.sendall(json.dumps(result).encode('utf-8'))
             elif action == 'checkout':
-                # Process checkout
+                # Process checkout: stock, order and line items commit together or not at all
                 cart = request.get('cart', [])
-                success = True
-                for item in cart:
-                    if not db.update_inventory_in_db(item['id'], item['quantity']):
-                        success = False
-                        message = f"Insufficient stock for Product ID {item['id']}."
-                        client_socket.send(json.dumps({'success': success, 'message': message}).encode('utf-8'))
-                        return
-
-                # Save the transaction if all items are available
-                db.save_transaction_in_db(cart)
-                client_socket.send(json.dumps({'success': True, 'message': "Checkout successful."}).encode('utf-8'))
+                success, message = db.checkout(cart)
+                client_socket.send(json.dumps({'success': success, 'message': message}).encode('utf-8'))
+            elif action == 'analytics':
+                # Dashboard reports: {"action": "analytics", "report": "top_sellers", "since": ..., "until": ...}
+                try:
+                    report, options = parse_report(request)
+                    result = db.sales_report(report, **options)
+                except AnalyticsError as e:
+                    result = {'error': str(e)}
+                client_socket.sendall(json.dumps(result).encode('utf-8'))
+            elif action == 'stats':
+                client_socket.sendall(json.dumps(METRICS.snapshot()).encode('utf-8'))
             else:
                 client_socket.send(json.dumps({'error': 'Invalid action'}).encode('utf-8'))
     finally:
         client_socket.close()
 
 # Main server function
-def server_program():
+def server_program(host='localhost', port=5000, db_path='store.db'):
     # Initialise the database and inventory management
-    db = InventoryDatabase('store.db')
+    db = InventoryDatabase(db_path, group_commit=True)
+    db.create_schema()
 
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind(('localhost', 5000))
+    server_socket.bind((host, port))
     server_socket.listen(5)
 
-    print("Server is running and waiting for the intial connection...")
+    log.info("Server is running and waiting for the intial connection...")
     while True:
         client_socket, _ = server_socket.accept()
-        print("Client connected.")
-        handle_client(client_socket, db)
+        log.debug("Client connected.")
+        # The connection pool makes the database safe to share between client threads
+        threading.Thread(target=handle_client, args=(client_socket, db), daemon=True).start()
 
 if __name__ == "__main__":
-    server_program()
+    parser = argparse.ArgumentParser(description="SQLite-backed inventory server")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--db', default='store.db')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--metrics-sample', type=float, default=0.01,
+                        help="fraction of database calls timed for the stats action (0 disables timing)")
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+    METRICS.configure(args.metrics_sample)
+    server_program(args.host, args.port, args.db)
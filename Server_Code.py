@@ -1,302 +1,1046 @@
-import socket
-import json
-import threading
-
-# Product class to represent inventory items
-class Product:
-    def __init__(self, product_id, name, price, stock):
-        # Initialise a product with ID, name, price, and stock.
-        self.id = product_id
-        self.name = name
-        self.price = price
-        self.stock = stock
-
-    def to_dict(self):
-        # Convert the product instance to a dictionary for JSON serialization.
-        return {
-            'id': self.id,
-            'name': self.name,
-            'price': self.price,
-            'stock': self.stock
-        }
-
-    def update_stock(self, quantity):
-        # Update stock by reducing the given quantity.
-        # Returns True if the stock is sufficient, otherwise False.
-        if self.stock >= quantity:
-            self.stock -= quantity
-            return True
-        return False
-
-# Inventory class to manage all products
-class Inventory:
-    def __init__(self):
-        # Initialise the inventory and populate it with default products.
-        self.products = {}  # Dictionary to store products by ID
-        self._initialise_products()
-
-    def _initialise_products(self):
-        # Populates inventory with predefined products.
-        product_data = [
-            (1, "Python Programming eBook", 10.99, 25),
-            (2, "Photo Editing License", 29.99, 17),
-            (3, "Study Playlist MP3", 5.99, 17),
-            (4, "Adobe Photoshop", 19.99, 25),
-            (5, "Mystery Gift", 20.99, 10),
-            (6, "Amazon Gift Card", 10.99, 20),
-        ]
-        for data in product_data:
-            product = Product(*data)
-            self.products[product.id] = product
-
-    def get_product_list(self):
-        # Return a list of all products as dictionaries.
-        return [product.to_dict() for product in self.products.values()]
-
-    def process_checkout(self, cart):
-        # Process the checkout for a client's cart.
-        # Updates stock if sufficient inventory is available.
-        # Returns a tuple
-        updated_products = []  # To track products updated during checkout
-        try:
-            for item in cart:
-                product_id = item['id']
-                quantity = item['quantity']
-                product = self.products.get(product_id)
-
-                if not product:
-                    return False, f"Product ID {product_id} not found."
-                if not product.update_stock(quantity):
-                    # Rollback for previously updated products
-                    for updated in updated_products:
-                        updated['product'].update_stock(-updated['quantity'])
-                    return False, f"Insufficient stock for {product.name}."
-                updated_products.append({'product': product, 'quantity': quantity})
-
-            return True, "successful"
-        except Exception as e:
-            # Rollback in case of any unexpected errors
-            for updated in updated_products:
-                updated['product'].update_stock(-updated['quantity'])
-            return False, f"Checkout failed due to an error: {str(e)}"
-'''
-def get_product_details(self, product_id):
-    try:
-        # Request product details
-        request_data = {'action': 'get_product_details', 'id': product_id}
-        self.client_socket.sendall(json.dumps(request_data).encode('utf-8'))
-        response = self.client_socket.recv(1024).decode('utf-8')
-
-        print(f"Request sent: {request_data}")  # Debugging output
-        print(f"Response received: {response}")  # Debugging output
-
-        # Validate the response
-        if not response:
-            print(f"No response from server for product ID: {product_id}")
-            return None  # No response from server
-        product = json.loads(response)
-
-        # Check required fields
-        if not all(key in product for key in ('id', 'name', 'price', 'stock')):
-            raise ValueError(f"Invalid product details: {product}")
-        return response
-    except (json.JSONDecodeError, ValueError, KeyError) as e:
-        print(f"Error parsing product details for ID {product_id}: {e}")
-        return None
-'''
-def add_to_cart(product_id, quantity, inventory, cart):
-    # Adds a product to the cart and adjusts inventory stock.
-    for product in inventory:
-        if product['id'] == product_id:
-            if product['stock'] >= quantity:
-                product['stock'] -= quantity
-                if product_id in cart:
-                    cart[product_id]['quantity'] += quantity
-                else:
-                    cart[product_id] = {
-                        'name': product['name'],
-                        'price': product['price'],
-                        'quantity': quantity
-                    }
-                print(f"Added {quantity} x {product['name']} to the cart.")
-                print("Current cart:", cart)  # Log cart state
-            else:
-                print(f"Not enough stock available for {product['name']}.")
-            return
-    print("Invalid Product ID.")
-    
-def add_to_cart(product_id, quantity, inventory, cart):
-    # Adds a product to the cart and adjusts inventory stock.
-    for product in inventory:
-        if product['id'] == product_id:
-            if product['stock'] >= quantity:
-                product['stock'] -= quantity
-                if product_id in cart:
-                    cart[product_id]['quantity'] += quantity
-                else:
-                    cart[product_id] = {
-                        'name': product['name'],
-                        'price': product['price'],
-                        'quantity': quantity
-                    }
-                print(f"Added {quantity} x {product['name']} to the cart.")
-                print("Current cart:", cart)  # Log cart state
-            else:
-                print(f"Not enough stock available for {product['name']}.")
-            return
-    print("Invalid Product ID.")
-
-def view_cart(cart):
-    # Displays the contents of the cart and calculates the total price.
-    if not cart:
-        print("\nYour cart is empty.")
-        return
-    
-    print("\nCart Contents:")
-    print(f"{'Product':<30} {'Quantity':<10} {'Price':<10} {'Total':<10}")
-    print("-" * 60)
-    total_cost = 0
-    for item in cart.values():
-        total = item['quantity'] * item['price']
-        total_cost += total
-        print(f"{item['name']:<30} {item['quantity']:<10} £{item['price']:<10.2f} £{total:<10.2f}")
-    print("-" * 60)
-    print(f"Total Cost: £{total_cost:.2f}")
-    print("Current cart for debugging:", cart)  # Log cart state
-
-def view_cart(cart):
-    # Displays the contents of the cart and calculates the total price.
-    if not cart:
-        print("\nYour cart is empty.")
-        return
-    
-    print("\nCart Contents:")
-    print(f"{'Product':<30} {'Quantity':<10} {'Price':<10} {'Total':<10}")
-    print("-" * 60)
-    total_cost = 0
-    for item in cart.values():
-        total = item['quantity'] * item['price']
-        total_cost += total
-        print(f"{item['name']:<30} {item['quantity']:<10} £{item['price']:<10.2f} £{total:<10.2f}")
-    print("-" * 60)
-    print(f"Total Cost: £{total_cost:.2f}")
-    print("Current cart for debugging:", cart)  # Log cart state
-
-    
-def handle_client(client_socket, inventory):
-    cart = []  # Cart specific to the client
-    try:
-        while True:
-            request = client_socket.recv(1024).decode('utf-8')
-            if not request:
-                break  # Exit if the client disconnects
-
-            print(f"Received request: {request}")  # Debugging output
-
-            if request == 'VIEW_PRODUCTS':
-                product_list = inventory.get_product_list()
-                response = json.dumps(product_list)
-                client_socket.send(response.encode('utf-8'))
-
-            elif request.startswith('ADD_TO_CART'):
-                try:
-                    _, product_id, quantity = request.split()
-                    product_id = int(product_id)
-                    quantity = int(quantity)
-                    product = inventory.products.get(product_id)
-
-                    if product:
-                        cart_item = next((item for item in cart if item['id'] == product_id), None)
-                        if cart_item:
-                            cart_item['quantity'] += quantity
-                        else:
-                            cart.append({
-                                'id': product.id,
-                                'name': product.name,
-                                'quantity': quantity,
-                                'price': product.price
-                            })
-                        response = f"Added {quantity} of {product.name} to cart."
-                    else:
-                        response = "Product not found."
-                except ValueError:
-                    response = "Invalid request format for ADD_TO_CART."
-                client_socket.send(response.encode('utf-8'))
-
-            elif request == 'VIEW_CART':
-                response = json.dumps(cart)
-                client_socket.send(response.encode('utf-8'))
-
-            elif request.startswith('GET_PRODUCT_DETAILS'):
-                try:
-                    _, product_id = request.split()
-                    product_id = int(product_id)
-                    product = inventory.products.get(product_id)
-                    if product:
-                        response = json.dumps(product.to_dict())
-                    else:
-                        response = json.dumps({"error": f"Product ID {product_id} not found"})
-                except ValueError:
-                    response = json.dumps({"error": "Invalid request format for GET_PRODUCT_DETAILS"})
-                client_socket.send(response.encode('utf-8'))
-                print(f"Sent response: {response}")  # Debugging output
-
-            elif request == 'CHECKOUT':
-                success, message = inventory.process_checkout(cart)
-                if success:
-                    cart.clear()
-                response = json.dumps({'success': success, 'message': message})
-                client_socket.send(response.encode('utf-8'))
-
-            else:
-                response = "Invalid command"
-                client_socket.send(response.encode('utf-8'))
-
-    except Exception as e:
-        print(f"Error handling client: {e}")
-    finally:
-        client_socket.close()
-
-# Main server function remains unchanged
-
-
-def server_program():
-    # Main server function to accept client connections and handle requests.
-    inventory = Inventory()
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        server_socket.bind(('localhost', 5000))
-        server_socket.listen(5)
-        print("Server is running and waiting for the connection...")
-
-        while True:
-            client_socket, _ = server_socket.accept()
-            print("Client connected.")
-            client_thread = threading.Thread(target=handle_client, args=(client_socket, inventory))
-            client_thread.start()
-    except Exception as e:
-        print(f"Server error: {e}")
-    finally:
-        server_socket.close()
-
-if __name__ == "__main__":
-    server_program()
-# constructor __main__ method 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+import socket
+import json
+import sys
+import threading
+import asyncio
+import argparse
+from collections import deque
+
+import columnar
+from catalog import CatalogIndex, parse_query
+from changefeed import ChangeFeed
+from flash_sale import FlashSale
+from Import_sqlite3 import InventoryDatabase
+from metrics import METRICS, configure_logging, log
+from protocol import MAGIC, FrameDecoder, encode_frame
+from reservations import ReservationManager
+from sessions import SessionStore
+from traffic import RECORDER
+from worker_pool import PooledPusher, PooledServer
+from write_behind import WriteBehindStore
+
+# Product class to represent inventory items
+class Product:
+    # Fixed attributes and no per-instance __dict__: at millions of SKUs the dict
+    # overhead would dominate the memory use of the catalog.
+    __slots__ = ('id', 'name', 'price', 'stock', 'lock')
+
+    def __init__(self, product_id, name, price, stock):
+        # Initialise a product with ID, name, price, and stock.
+        self.id = product_id
+        self.name = sys.intern(name)
+        self.price = price
+        self.stock = stock
+        self.lock = threading.Lock()  # Guards stock; see Inventory.process_checkout for lock order
+
+    def to_dict(self):
+        # Convert the product instance to a dictionary for JSON serialization.
+        return {
+            'id': self.id,
+            'name': self.name,
+            'price': self.price,
+            'stock': self.stock
+        }
+
+    def update_stock(self, quantity):
+        # Update stock by reducing the given quantity.
+        # Returns True if the stock is sufficient, otherwise False.
+        with self.lock:
+            if self.stock >= quantity:
+                self.stock -= quantity
+                return True
+            return False
+
+# Inventory class to manage all products
+class Inventory:
+    def __init__(self, store=None, hold_seconds=None):
+        # Initialise the inventory and populate it with default products.
+        # store: optional write_behind.WriteBehindStore. When given, products are loaded
+        # from it and completed checkouts are persisted through it.
+        # hold_seconds: when set, ADD_TO_CART reserves stock for this long (see reservations.py).
+        self.products = {}  # Dictionary to store products by ID
+        self.store = store
+        self.version = 0  # Bumped whenever stock or prices change
+        self.price_version = 0  # Bumped only when a price changes (carts cache totals against it)
+        self._version_lock = threading.Lock()
+        self._snapshot = None  # (version, list payload, versioned payload), see catalog_snapshot
+        self._columnar = None  # (version, columnar payload), see catalog_columnar
+        self._initialise_products()
+        self.index = CatalogIndex(self.products.values())  # Sorted indexes for QUERY_PRODUCTS
+        self._index_lock = threading.Lock()
+        self.reservations = ReservationManager(self, hold_seconds) if hold_seconds else None
+        self.changes = ChangeFeed(self.products)  # Stock and price changes for SUBSCRIBE
+        self.flash_sales = {}  # Product ID -> FlashSale, see enable_flash_sale
+
+    def _initialise_products(self):
+        # Populates inventory with predefined products.
+        product_data = [
+            (1, "Python Programming eBook", 10.99, 25),
+            (2, "Photo Editing License", 29.99, 17),
+            (3, "Study Playlist MP3", 5.99, 17),
+            (4, "Adobe Photoshop", 19.99, 25),
+            (5, "Mystery Gift", 20.99, 10),
+            (6, "Amazon Gift Card", 10.99, 20),
+        ]
+        if self.store:
+            product_data = self.store.load_products(product_data)
+        for data in product_data:
+            product = Product(*data)
+            self.products[product.id] = product
+
+    def get_product_list(self):
+        # Return a list of all products as dictionaries.
+        return [product.to_dict() for product in self.products.values()]
+
+    def query_products(self, params):
+        # Paginated, filtered catalog query. params is a dict with optional keys
+        # sort ('id', 'price' or 'name'), limit, min_price, max_price, prefix and cursor.
+        # Returns {'products': [...], 'next_cursor': ...}; cost grows with the page size,
+        # not with the size of the catalog.
+        query = parse_query(params)
+        with self._index_lock:  # set_price moves rows within the price index
+            page, next_cursor = self.index.query(self.products, **query)
+        return {'products': [product.to_dict() for product in page], 'next_cursor': next_cursor}
+
+    def _changed(self, product_ids=()):
+        # Record that stock or prices of product_ids changed: cached catalog payloads get
+        # rebuilt and subscribers are sent the new values.
+        with self._version_lock:
+            self.version += 1
+        self.changes.record(product_ids)
+
+    def catalog_snapshot(self):
+        # Return (version, list_payload, versioned_payload) for the current catalog.
+        # list_payload is the JSON product list sent for a plain VIEW_PRODUCTS and
+        # versioned_payload is {"version": ..., "products": [...]}. Both are encoded
+        # once per version and then shared by every reader.
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot[0] == self.version:
+            return snapshot
+        version = self.version  # Read before building: the payload is never older than its tag
+        products = json.dumps(self.get_product_list())
+        snapshot = (version, products.encode('utf-8'),
+                    f'{{"version": {version}, "products": {products}}}'.encode('utf-8'))
+        self._snapshot = snapshot
+        return snapshot
+
+    def catalog_columnar(self):
+        # Return (version, payload) with the catalog in the columnar encoding (see columnar.py),
+        # built once per version like catalog_snapshot.
+        cached = self._columnar
+        if cached is not None and cached[0] == self.version:
+            return cached
+        version = self.version
+        rows = [(product.id, product.name, product.price, product.stock) for product in self.products.values()]
+        cached = (version, columnar.encode(rows, version))
+        self._columnar = cached
+        return cached
+
+    def set_price(self, product_id, price):
+        # Change the price of a product. Returns False if the product does not exist.
+        product = self.products.get(product_id)
+        if not product:
+            return False
+        with product.lock, self._index_lock:
+            old_price = product.price
+            product.price = price
+            self.index.reprice(product, old_price)
+        if self.store:
+            self.store.record_price(product_id, price)
+        with self._version_lock:
+            self.price_version += 1
+        self._changed((product_id,))
+        return True
+
+    def process_checkout(self, cart):
+        # Process the checkout for a client's cart.
+        # cart: mapping of product ID to quantity, or iterable of (product_id, quantity) pairs.
+        # Updates stock if sufficient inventory is available.
+        # Returns a tuple
+        success, message, quantities = self.take_stock(cart)
+        if success:
+            self.record_sale(quantities)
+        return success, message
+
+    def take_stock(self, cart):
+        # Remove stock for every line of cart (same forms as process_checkout), all or nothing.
+        # Returns (success, message, quantities merged per product ID).
+        quantities, error = self.merge_lines(cart)
+        if error:
+            return False, error, quantities
+        success, message = self.take_quantities(quantities)
+        if success:
+            self._changed(quantities)
+        return success, message, quantities
+
+    def merge_lines(self, cart):
+        # Merge cart lines per product and validate them. Returns (quantities, error message or None).
+        quantities = {}  # Merge repeated lines so each lock is taken once
+        for product_id, quantity in (cart.items() if isinstance(cart, dict) else cart):
+            if quantity <= 0:
+                return quantities, f"Invalid quantity for Product ID {product_id}."
+            quantities[product_id] = quantities.get(product_id, 0) + quantity
+        for product_id in quantities:
+            if product_id not in self.products:
+                return quantities, f"Product ID {product_id} not found."
+        return quantities, None
+
+    def enable_flash_sale(self, product_id):
+        # Sell product_id through a single-writer FlashSale lane (see flash_sale.py).
+        # For hot items that many customers try to buy at the same moment.
+        if product_id not in self.products:
+            raise ValueError(f"Product ID {product_id} not found.")
+        if product_id not in self.flash_sales:
+            self.flash_sales[product_id] = FlashSale(self.products[product_id])
+
+    def sold_out(self, product_id):
+        # True if product_id is on flash sale and has none left. Takes no locks, so
+        # the crowd arriving after the last unit is refused at almost no cost.
+        flash_sale = self.flash_sales.get(product_id)
+        if flash_sale is None or not flash_sale.sold_out:
+            return False
+        flash_sale.turned_away += 1
+        return True
+
+    def take_quantities(self, quantities):
+        # Take merged quantities (product ID -> quantity) from the local products.
+        # Returns (success, message). Flash sale products go through their lanes first.
+        if self.flash_sales:
+            hot = sorted(product_id for product_id in quantities if product_id in self.flash_sales)
+            if hot:
+                return self._take_flash_sale(quantities, hot)
+        return self._take_locked(quantities)
+
+    def _take_flash_sale(self, quantities, hot):
+        for product_id in hot:
+            if self.sold_out(product_id):
+                return False, f"Insufficient stock for {self.products[product_id].name}."
+        granted = {}
+        for product_id in hot:
+            if not self.flash_sales[product_id].take(quantities[product_id]):
+                if granted:
+                    Inventory.return_stock(self, granted)
+                return False, f"Insufficient stock for {self.products[product_id].name}."
+            granted[product_id] = quantities[product_id]
+        rest = {product_id: quantity for product_id, quantity in quantities.items() if product_id not in granted}
+        if rest:
+            success, message = self._take_locked(rest)
+            if not success:
+                Inventory.return_stock(self, granted)  # The rest of the cart is not available after all
+                return success, message
+        return True, "successful"
+
+    def _take_locked(self, quantities):
+        # take_quantities for products that are not on flash sale.
+        #
+        # The lock of every product is taken in ascending product ID order (so two
+        # callers can never deadlock), all stock levels are checked, and only then is
+        # anything decremented. Carts that share no products never wait for each other.
+        products = [self.products[product_id] for product_id in sorted(quantities)]
+        started = METRICS.start()
+        for product in products:
+            product.lock.acquire()
+        METRICS.observe('checkout.lock_wait', started)
+        try:
+            for product in products:
+                if product.stock < quantities[product.id]:
+                    return False, f"Insufficient stock for {product.name}."
+            for product in products:
+                product.stock -= quantities[product.id]
+        finally:
+            for product in reversed(products):
+                product.lock.release()
+        return True, "successful"
+
+    def return_stock(self, quantities):
+        # Give stock back, e.g. when a reservation is released. quantities: product ID -> quantity.
+        for product_id, quantity in quantities.items():
+            product = self.products.get(product_id)
+            if product:
+                with product.lock:
+                    product.stock += quantity
+                    if product_id in self.flash_sales:
+                        self.flash_sales[product_id].sold_out = False
+        self._changed(quantities)
+
+    def record_sale(self, quantities):
+        # Make a completed sale durable. The stock has already been taken.
+        if self.store:
+            self.store.record_checkout([(product_id, quantity, self.products[product_id].price)
+                                        for product_id, quantity in sorted(quantities.items())])
+
+    def checkout_cart(self, cart):
+        # Check out a Cart: through its reservations when holds are enabled, otherwise
+        # by taking all the stock now.
+        if self.reservations:
+            return self.reservations.checkout(cart, cart.items)
+        return self.process_checkout(cart.items)
+
+# Cart class to hold a client's selections
+class Cart:
+    # Product ID -> quantity with O(1) add, update and remove. The total is kept up to
+    # date as lines change, and the encoded views sent for VIEW_CART are cached until the
+    # cart (or a price) changes.
+    def __init__(self, inventory):
+        self.inventory = inventory
+        self.items = {}  # Product ID -> quantity
+        self._total = 0.0
+        self._view = None  # Encoded VIEW_CART reply
+        self._compact_view = None  # The same in the columnar encoding
+        self._price_version = inventory.price_version  # Prices the total and view were built with
+        self.lock = threading.Lock()  # A resumed session's cart can be reached from several connections
+
+    def _price(self, product_id):
+        return self.inventory.products[product_id].price
+
+    def _changed(self):
+        self._view = None
+        self._compact_view = None
+
+    def _check_prices(self):
+        # A price change makes the running total and cached view stale; rebuild them once.
+        if self._price_version != self.inventory.price_version:
+            self._price_version = self.inventory.price_version
+            self._total = sum(self._price(product_id) * quantity for product_id, quantity in self.items.items())
+            self._changed()
+
+    def add(self, product_id, quantity):
+        # Add quantity of a product, merging with an existing line. Returns the new quantity,
+        # or None if the stock could not be reserved.
+        return self.set_quantity(product_id, self.items.get(product_id, 0) + quantity)
+
+    def set_quantity(self, product_id, quantity):
+        # Set the quantity of a line; zero or less removes it. Returns the new quantity,
+        # or None (cart unchanged) if the extra stock could not be reserved.
+        self._check_prices()
+        old_quantity = self.items.get(product_id, 0)
+        reservations = self.inventory.reservations
+        if reservations and not reservations.hold(self, product_id, max(quantity, 0)):
+            return None
+        if quantity <= 0:
+            self.items.pop(product_id, None)
+            quantity = 0
+        else:
+            self.items[product_id] = quantity
+        self._total += (quantity - old_quantity) * self._price(product_id)
+        self._changed()
+        return quantity
+
+    def remove(self, product_id):
+        # Remove a line. Returns False if the product was not in the cart.
+        if product_id not in self.items:
+            return False
+        self.set_quantity(product_id, 0)
+        return True
+
+    def clear(self):
+        # Empty the cart, giving back any stock still held for it.
+        if self.inventory.reservations:
+            self.inventory.reservations.release(self)
+        self.items.clear()
+        self._total = 0.0
+        self._changed()
+
+    @property
+    def total(self):
+        self._check_prices()
+        if not self.items:
+            self._total = 0.0  # Drop accumulated float error once the cart is empty
+        return round(self._total, 2)
+
+    def view(self, compact=False):
+        # Encoded list of line items for VIEW_CART, rebuilt only after a change.
+        # compact selects the columnar encoding instead of JSON.
+        self._check_prices()
+        if compact:
+            if self._compact_view is None:
+                rows = []
+                for product_id, quantity in self.items.items():
+                    product = self.inventory.products[product_id]
+                    rows.append((product_id, product.name, product.price, quantity))
+                self._compact_view = columnar.encode(rows, kind=columnar.CART)
+            return self._compact_view
+        if self._view is None:
+            lines = []
+            for product_id, quantity in self.items.items():
+                product = self.inventory.products[product_id]
+                lines.append({'id': product_id, 'name': product.name, 'quantity': quantity, 'price': product.price})
+            self._view = json.dumps(lines).encode('utf-8')
+        return self._view
+
+    def __len__(self):
+        return len(self.items)
+
+
+class ClientState:
+    # Per-connection state: the cart in use and, after SESSION or RESUME, the token of
+    # the server-side session that owns it.
+    def __init__(self, inventory, sessions=None):
+        self.inventory = inventory
+        self.sessions = sessions
+        self.token = None
+        self.local_cart = Cart(inventory)
+        self.encoding = 'json'  # Changed with the ENCODING command
+        self.make_pusher = None  # Set by framed connections: returns the pusher SUBSCRIBE sends through
+        self.pusher = None
+        self.subscription = None
+        self.connection_id = RECORDER.opened()  # 0 unless traffic is being recorded
+        METRICS.increment('connections')
+
+    @property
+    def cart(self):
+        if self.token:
+            cart = self.sessions.resume(self.token)  # Also keeps the session from expiring
+            if cart is not None:
+                return cart
+            self.token = None  # Session expired: continue with an empty connection cart
+            self.local_cart = Cart(self.inventory)
+        return self.local_cart
+
+    def close(self):
+        # The connection is gone: a cart not kept in a session gives back its held stock.
+        if self.subscription:
+            self.inventory.changes.unsubscribe(self.subscription)
+        if self.pusher:
+            self.pusher.close()
+        with self.local_cart.lock:
+            self.local_cart.clear()
+        RECORDER.closed(self.connection_id)
+
+
+class SocketPusher:
+    # Sends SUBSCRIBE updates on a threaded connection. The change feed only queues
+    # frames here; a thread of the connection's own writes them, sharing send_lock with
+    # the replies so frames never interleave. A client that lets `limit` frames pile up
+    # is too slow and gets dropped (see changefeed.py).
+    def __init__(self, client_socket, send_lock, limit=1000):
+        self.client_socket = client_socket
+        self.send_lock = send_lock
+        self.limit = limit
+        self._frames = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        threading.Thread(target=self._run, name="subscription-push", daemon=True).start()
+
+    def push(self, frame):
+        with self._condition:
+            if len(self._frames) >= self.limit:
+                return False
+            self._frames.append(frame)
+            self._condition.notify()
+            return True
+
+    def force(self, frame):
+        # Queue frame even when full, dropping whatever is still waiting.
+        with self._condition:
+            if len(self._frames) >= self.limit:
+                self._frames.clear()
+            self._frames.append(frame)
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._frames or self._closed)
+                if self._closed:
+                    return
+                frames = b''.join(self._frames)
+                self._frames.clear()
+            try:
+                with self.send_lock:
+                    self.client_socket.sendall(frames)
+            except OSError:
+                return  # Connection gone; handle_client cleans up
+
+
+class StreamPusher:
+    # asyncio counterpart of SocketPusher: frames are handed to the event loop, and a
+    # client whose transport buffer is over limit bytes is dropped.
+    def __init__(self, loop, writer, limit=1024 * 1024):
+        self.loop = loop
+        self.writer = writer
+        self.limit = limit
+
+    def _write(self, frame):
+        if not self.writer.is_closing():
+            self.writer.write(frame)
+
+    def push(self, frame):
+        if self.writer.transport.get_write_buffer_size() > self.limit:
+            return False
+        self.loop.call_soon_threadsafe(self._write, frame)
+        return True
+
+    def force(self, frame):
+        self.loop.call_soon_threadsafe(self._write, frame)
+
+    def close(self):
+        pass
+
+
+# Commands timed under their own name; anything else is timed as 'command.other'
+TIMED_COMMANDS = {
+    'VIEW_PRODUCTS', 'QUERY_PRODUCTS', 'ADD_TO_CART', 'REMOVE_FROM_CART', 'UPDATE_QTY', 'VIEW_CART',
+    'HOLD_STATS', 'GET_PRODUCT_DETAILS', 'CHECKOUT', 'SESSION', 'RESUME', 'STATS', 'ENCODING',
+    'SUBSCRIBE', 'UNSUBSCRIBE', 'BATCH',
+}
+
+# Commands a BATCH may contain, with the reply prefix that means the command worked.
+# CHECKOUT worked when its JSON reply says so; the read-only commands always do.
+BATCH_COMMANDS = {
+    'ADD_TO_CART': b'Added ', 'REMOVE_FROM_CART': b'Removed ', 'UPDATE_QTY': b'Quantity of ',
+    'CHECKOUT': None, 'VIEW_CART': None, 'VIEW_PRODUCTS': None, 'QUERY_PRODUCTS': None,
+    'GET_PRODUCT_DETAILS': None, 'HOLD_STATS': None,
+}
+MAX_BATCH = 1000  # Commands per BATCH
+
+# Reply encodings a client can select with ENCODING <name>. Only VIEW_PRODUCTS and
+# VIEW_CART change; every other reply stays text/JSON.
+ENCODINGS = ('json', 'columnar')
+
+
+def process_request(request, inventory, client, request_id=None):
+    # Handle a single client command against the inventory and the client's state.
+    # Shared by the threaded and asyncio engines so both speak the same command set.
+    # request_id: the frame's request id (framed connections only).
+    # Returns the encoded response, or None when the reply is pushed instead (SUBSCRIBE).
+    log.debug("Received request: %s", request)
+    if RECORDER.file:
+        RECORDER.request(client.connection_id, request_id, request)
+    METRICS.request_started()
+    started = METRICS.start()
+    try:
+        if request == 'STATS':
+            return json.dumps(server_stats(inventory, client.sessions)).encode('utf-8')
+        if request == 'SESSION' or request.startswith('RESUME'):
+            return session_request(request, inventory, client)
+        if request.startswith('SUBSCRIBE') or request == 'UNSUBSCRIBE':
+            return subscribe_request(request, inventory, client, request_id)
+        if request.startswith('ENCODING'):
+            parts = request.split()
+            if len(parts) != 2 or parts[1] not in ENCODINGS:
+                return f"Unknown encoding. Supported: {', '.join(ENCODINGS)}".encode('utf-8')
+            client.encoding = parts[1]
+            return f"ENCODING {client.encoding}".encode('utf-8')
+        cart = client.cart
+        with cart.lock:
+            if request.startswith('BATCH'):
+                return batch_request(request, inventory, cart)
+            return dispatch_request(request, inventory, cart, client.encoding)
+    finally:
+        METRICS.request_finished()
+        if started is not None:
+            command = request.split(' ', 1)[0]
+            METRICS.observe('command.' + (command if command in TIMED_COMMANDS else 'other'), started)
+
+
+def session_request(request, inventory, client):
+    # SESSION and RESUME <token>: move the connection's cart into a session or pick one up.
+    if client.sessions is None:
+        return b"Sessions are not enabled on this server."
+    if request == 'SESSION':
+        # Move the connection's cart into a new server-side session
+        client.token = client.sessions.create(client.local_cart)
+        client.local_cart = Cart(inventory)  # The old one now belongs to the session
+        RECORDER.session(client.connection_id, client.token)  # Lets a replay map the token to its own
+        return f"SESSION {client.token}".encode('utf-8')
+    parts = request.split()
+    cart = client.sessions.resume(parts[1]) if len(parts) == 2 else None
+    if cart is None:
+        return b"Session not found or expired."
+    client.token = parts[1]
+    return f"Resumed session with {len(cart)} item(s) in the cart.".encode('utf-8')
+
+
+def subscribe_request(request, inventory, client, request_id):
+    # SUBSCRIBE [seq epoch]: push catalog changes on this connection, starting after seq
+    # if given and the epoch says it came from this server's feed (see changefeed.py).
+    # The first update (a snapshot or the missed changes) is the reply; later ones
+    # arrive as extra frames with the same request id. UNSUBSCRIBE stops them.
+    if request == 'UNSUBSCRIBE':
+        if client.subscription:
+            inventory.changes.unsubscribe(client.subscription)
+            client.subscription = None
+        return b"Unsubscribed."
+    if client.make_pusher is None or request_id is None:
+        return b"SUBSCRIBE needs the framed protocol."
+    parts = request.split()
+    try:
+        since = int(parts[1]) if len(parts) >= 2 else None
+    except ValueError:
+        return b"Invalid request format for SUBSCRIBE."
+    epoch = parts[2] if len(parts) == 3 else None  # Clients that send no epoch get a snapshot
+    if client.pusher is None:
+        client.pusher = client.make_pusher()
+    if client.subscription:
+        inventory.changes.unsubscribe(client.subscription)
+    client.subscription = inventory.changes.subscribe(client.pusher, request_id, since, epoch)
+    return None
+
+
+def batch_request(request, inventory, cart):
+    # BATCH ["ADD_TO_CART 1 2", "ADD_TO_CART 4 1", "CHECKOUT"]: run the commands in order
+    # in one critical section (the caller holds the cart lock) and answer once:
+    #     {"ok": true, "committed": 3, "replies": ["Added 2 of ...", "Added 1 of ...", "{\"success\": true, ...}"]}
+    # The batch stops at the first command that fails, whose reply is the last one, and
+    # the cart changes made since the batch's last successful CHECKOUT are undone. So a
+    # kiosk's adds followed by CHECKOUT either all go through or leave the cart as it was.
+    # A placed order cannot be undone, though: "committed" counts the leading commands
+    # whose effects stand (all of them when ok is true), so a failure after a successful
+    # CHECKOUT answers ok false with committed covering that CHECKOUT.
+    # Replies are always JSON/text: the connection's ENCODING does not apply inside a batch.
+    try:
+        commands = json.loads(request[len('BATCH'):])
+        if not isinstance(commands, list) or not all(isinstance(command, str) for command in commands):
+            raise ValueError("expected a JSON array of commands")
+        if len(commands) > MAX_BATCH:
+            raise ValueError(f"at most {MAX_BATCH} commands")
+    except ValueError as e:  # Also covers json.JSONDecodeError
+        return json.dumps({'ok': False, 'error': f"Invalid BATCH request: {e}"}).encode('utf-8')
+    original = dict(cart.items)  # Cart lines to restore if a command fails
+    replies = []
+    ok = True
+    committed = 0
+    for command in commands:
+        name = command.split(' ', 1)[0]
+        if name not in BATCH_COMMANDS:
+            replies.append(f"{name} is not allowed in a BATCH.")
+            ok = False
+            break
+        reply = dispatch_request(command, inventory, cart)
+        replies.append(reply.decode('utf-8'))
+        if name == 'CHECKOUT':
+            ok = json.loads(reply)['success']
+            if ok:
+                original = {}  # Sold: there is nothing to undo before this point
+                committed = len(replies)
+        elif BATCH_COMMANDS[name] is not None:
+            ok = reply.startswith(BATCH_COMMANDS[name])
+        if not ok:
+            break
+    if ok:
+        committed = len(replies)
+    else:
+        for product_id in set(original) | set(cart.items):
+            quantity = original.get(product_id, 0)
+            if cart.items.get(product_id, 0) != quantity and cart.set_quantity(product_id, quantity) is None:
+                # Only with stock holds: stock given back by the batch was taken meanwhile
+                log.warning("BATCH could not restore %d of product %d to the cart", quantity, product_id)
+    return json.dumps({'ok': ok, 'committed': committed, 'replies': replies}).encode('utf-8')
+
+
+def server_stats(inventory, sessions=None):
+    # Everything the STATS command reports: request metrics plus session and hold counts.
+    stats = METRICS.snapshot()
+    stats['catalog_version'] = inventory.version
+    stats['subscribers'] = len(inventory.changes)
+    if sessions is not None:
+        stats['sessions'] = sessions.stats()
+    if inventory.reservations:
+        stats['holds'] = inventory.reservations.stats()
+    if inventory.flash_sales:
+        stats['flash_sales'] = {product_id: flash_sale.stats()
+                                for product_id, flash_sale in inventory.flash_sales.items()}
+    return stats
+
+
+def dispatch_request(request, inventory, cart, encoding='json'):
+    # Run one command against the inventory and a cart. Returns the encoded response.
+    # encoding: 'json' or 'columnar' for the VIEW_PRODUCTS and VIEW_CART replies.
+    if request == 'VIEW_PRODUCTS':
+        if encoding == 'columnar':
+            return inventory.catalog_columnar()[1]
+        return inventory.catalog_snapshot()[1]  # Pre-encoded, shared by every reader
+
+    elif request.startswith('VIEW_PRODUCTS '):
+        # VIEW_PRODUCTS <version>: the client already holds that catalog version
+        if encoding == 'columnar':
+            version, versioned = inventory.catalog_columnar()  # The version is inside the payload
+        else:
+            version, _, versioned = inventory.catalog_snapshot()
+        try:
+            known_version = int(request.split()[1])
+        except ValueError:
+            known_version = None
+        if known_version == version:
+            response = f"NOT_MODIFIED {version}"
+        else:
+            return versioned
+
+    elif request.startswith('QUERY_PRODUCTS'):
+        # QUERY_PRODUCTS {"sort": "price", "min_price": 5, "prefix": "py", "limit": 20, "cursor": ...}
+        try:
+            params = json.loads(request[len('QUERY_PRODUCTS'):] or '{}')
+            response = json.dumps(inventory.query_products(params))
+        except ValueError as e:  # Also covers json.JSONDecodeError and QueryError
+            response = json.dumps({"error": f"Invalid QUERY_PRODUCTS request: {e}"})
+
+    elif request.startswith('ADD_TO_CART'):
+        try:
+            _, product_id, quantity = request.split()
+            product_id = int(product_id)
+            quantity = int(quantity)
+            product = inventory.products.get(product_id)
+
+            if quantity <= 0:
+                response = "Quantity must be a positive integer."
+            elif product:
+                if cart.add(product_id, quantity) is None:
+                    response = f"Insufficient stock for {product.name}."
+                else:
+                    response = f"Added {quantity} of {product.name} to cart."
+            else:
+                response = "Product not found."
+        except ValueError:
+            response = "Invalid request format for ADD_TO_CART."
+
+    elif request.startswith('REMOVE_FROM_CART'):
+        try:
+            _, product_id = request.split()
+            product_id = int(product_id)
+            if cart.remove(product_id):
+                response = f"Removed Product ID {product_id} from cart."
+            else:
+                response = "Product not in cart."
+        except ValueError:
+            response = "Invalid request format for REMOVE_FROM_CART."
+
+    elif request.startswith('UPDATE_QTY'):
+        try:
+            _, product_id, quantity = request.split()
+            product_id = int(product_id)
+            quantity = int(quantity)
+            if product_id not in inventory.products:
+                response = "Product not found."
+            else:
+                new_quantity = cart.set_quantity(product_id, quantity)
+                if new_quantity is None:
+                    response = f"Insufficient stock for Product ID {product_id}."
+                else:
+                    response = f"Quantity of Product ID {product_id} set to {new_quantity}."
+        except ValueError:
+            response = "Invalid request format for UPDATE_QTY."
+
+    elif request == 'VIEW_CART':
+        return cart.view(encoding == 'columnar')  # Cached until the cart changes
+
+    elif request == 'HOLD_STATS':
+        if inventory.reservations:
+            response = json.dumps(inventory.reservations.stats())
+        else:
+            response = json.dumps({"error": "Stock holds are not enabled on this server"})
+
+    elif request.startswith('GET_PRODUCT_DETAILS'):
+        try:
+            _, product_id = request.split()
+            product_id = int(product_id)
+            product = inventory.products.get(product_id)
+            if product:
+                response = json.dumps(product.to_dict())
+            else:
+                response = json.dumps({"error": f"Product ID {product_id} not found"})
+        except ValueError:
+            response = json.dumps({"error": "Invalid request format for GET_PRODUCT_DETAILS"})
+        log.debug("Sent response: %s", response)
+
+    elif request == 'CHECKOUT':
+        success, message = inventory.checkout_cart(cart)
+        if success:
+            cart.clear()
+        response = json.dumps({'success': success, 'message': message})
+
+    else:
+        response = "Invalid command"
+
+    return response.encode('utf-8')
+
+
+def read_preamble(data, read_more):
+    # The first bytes of a connection decide the protocol. Framed clients start with
+    # MAGIC; anything else is a legacy plain-text command. Keeps reading while what
+    # we have so far could still be the start of MAGIC.
+    while data and len(data) < len(MAGIC) and MAGIC.startswith(data):
+        more = read_more()
+        if not more:
+            break
+        data += more
+    return data
+
+
+def serve_framed(client_socket, inventory, client, initial=b''):
+    # Serve a framed connection. Every complete frame in the buffer is handled and
+    # the replies go back in a single sendall, so a pipelined burst of requests costs
+    # one read and one write.
+    send_lock = threading.Lock()  # Shared with the SUBSCRIBE pusher
+    client.make_pusher = lambda: SocketPusher(client_socket, send_lock)
+    decoder = FrameDecoder(initial)
+    while True:
+        frames = decoder.frames()
+        if frames:
+            replies = []
+            for request_id, payload in frames:
+                reply = process_request(payload.decode('utf-8'), inventory, client, request_id)
+                if reply is not None:
+                    replies.append(encode_frame(request_id, reply))
+            with send_lock:
+                client_socket.sendall(b''.join(replies))
+        data = client_socket.recv(65536)
+        if not data:
+            break  # Exit if the client disconnects
+        decoder.feed(data)
+
+
+def handle_client(client_socket, inventory, sessions=None):
+    client = ClientState(inventory, sessions)  # Cart and session specific to the client
+    try:
+        request = read_preamble(client_socket.recv(1024), lambda: client_socket.recv(1024))
+        if request.startswith(MAGIC):
+            serve_framed(client_socket, inventory, client, request[len(MAGIC):])
+            return
+
+        while request:
+            client_socket.sendall(process_request(request.decode('utf-8'), inventory, client))
+            request = client_socket.recv(1024)  # Empty when the client disconnects
+
+    except Exception as e:
+        log.warning("Error handling client: %s", e)
+    finally:
+        client.close()
+        client_socket.close()
+
+
+async def serve_framed_async(reader, writer, inventory, client, initial=b''):
+    # asyncio counterpart of serve_framed.
+    loop = asyncio.get_running_loop()
+    client.make_pusher = lambda: StreamPusher(loop, writer)
+    decoder = FrameDecoder(initial)
+    while True:
+        frames = decoder.frames()
+        if frames:
+            for request_id, payload in frames:
+                reply = process_request(payload.decode('utf-8'), inventory, client, request_id)
+                if reply is not None:
+                    writer.write(encode_frame(request_id, reply))
+            await writer.drain()
+        data = await reader.read(65536)
+        if not data:
+            break  # Exit if the client disconnects
+        decoder.feed(data)
+
+
+async def handle_client_async(reader, writer, inventory, sessions=None):
+    # asyncio counterpart of handle_client. An idle connection costs a coroutine
+    # and a transport rather than a whole OS thread.
+    client = ClientState(inventory, sessions)  # Cart and session specific to the client
+    try:
+        data = await reader.read(1024)
+        while data and len(data) < len(MAGIC) and MAGIC.startswith(data):
+            more = await reader.read(1024)
+            if not more:
+                break
+            data += more
+        if data.startswith(MAGIC):
+            await serve_framed_async(reader, writer, inventory, client, data[len(MAGIC):])
+            return
+
+        while data:
+            writer.write(process_request(data.decode('utf-8'), inventory, client))
+            await writer.drain()
+            data = await reader.read(1024)  # Empty when the client disconnects
+
+    except Exception as e:
+        log.warning("Error handling client: %s", e)
+    finally:
+        client.close()
+        writer.close()
+
+
+# Main server function remains unchanged
+
+
+def create_inventory(db_path=None, hold_seconds=None, flash_sale=()):
+    # In-memory inventory, optionally backed by SQLite through the write-behind store.
+    # hold_seconds enables stock holds at ADD_TO_CART time; flash_sale lists hot product IDs.
+    store = WriteBehindStore(InventoryDatabase(db_path), db_path + '.log') if db_path else None
+    inventory = Inventory(store, hold_seconds)
+    for product_id in flash_sale:
+        inventory.enable_flash_sale(product_id)
+    if inventory.reservations:
+        inventory.reservations.start_expiry_thread()
+    return inventory
+
+
+def create_sessions(inventory, db_path=None, ttl=1800.0, max_sessions=100000):
+    # Session store for SESSION/RESUME. Carts beyond max_sessions spill to the database if there is one.
+    spill_db = InventoryDatabase(db_path) if db_path else None
+    on_evict = inventory.reservations.release if inventory.reservations else None  # Evicted carts free their holds
+    sessions = SessionStore(lambda: Cart(inventory), ttl, max_sessions, spill_db, on_evict)
+    sessions.start_sweeper(min(30.0, ttl))
+    return sessions
+
+
+def accept_loop(server_socket, inventory, sessions=None, workers=32, **limits):
+    # Accept connections on a listening socket and serve them with a pool of `workers`
+    # threads (see worker_pool.py; limits are passed on to PooledServer). workers=0
+    # keeps the old model of one thread per connection, without admission control.
+    if not workers:
+        while True:
+            client_socket, _ = server_socket.accept()
+            log.debug("Client connected.")
+            client_thread = threading.Thread(target=handle_client, args=(client_socket, inventory, sessions))
+            client_thread.start()
+
+    def open_client(connection):
+        client = ClientState(inventory, sessions)  # Cart and session specific to the client
+        client.make_pusher = lambda: PooledPusher(server, connection)
+        return client
+
+    server = PooledServer(
+        server_socket, open_client,
+        handle=lambda client, payload, request_id: process_request(payload.decode('utf-8'), inventory, client,
+                                                                   request_id),
+        close_client=ClientState.close,
+        keep_alive=lambda client: client.subscription is not None,
+        workers=workers, **limits)
+    server.serve_forever()
+
+
+def server_program(host='localhost', port=5000, db_path=None, session_ttl=1800.0, max_sessions=100000,
+                   hold_seconds=600.0, backlog=1024, flash_sale=(), record=None, **pool_options):
+    # Main server function to accept client connections and handle requests.
+    # pool_options (workers, max_queue, rate, idle_timeout, ...) configure the worker pool.
+    # record: capture every request to this file (see traffic.py).
+    inventory = create_inventory(db_path, hold_seconds, flash_sale)
+    sessions = create_sessions(inventory, db_path, session_ttl, max_sessions)
+    if record:
+        RECORDER.start(record, inventory.get_product_list())
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        server_socket.bind((host, port))
+        server_socket.listen(backlog)
+        log.info("Server is running and waiting for the connection...")
+        accept_loop(server_socket, inventory, sessions, **pool_options)
+    except Exception as e:
+        log.error("Server error: %s", e)
+    finally:
+        RECORDER.stop()
+        server_socket.close()
+
+
+async def async_server_main(host='localhost', port=5000, backlog=1024, db_path=None,
+                            session_ttl=1800.0, max_sessions=100000, hold_seconds=600.0, flash_sale=(), record=None):
+    # Event-loop server: every connection is served by handle_client_async on a single thread.
+    inventory = create_inventory(db_path, hold_seconds, flash_sale)
+    sessions = create_sessions(inventory, db_path, session_ttl, max_sessions)
+    if record:
+        RECORDER.start(record, inventory.get_product_list())
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_client_async(reader, writer, inventory, sessions),
+        host, port, backlog=backlog)
+    log.info("Async server is running and waiting for the connection...")
+    async with server:
+        await server.serve_forever()
+
+
+def async_server_program(host='localhost', port=5000, db_path=None, session_ttl=1800.0, max_sessions=100000,
+                         hold_seconds=600.0, backlog=1024, flash_sale=(), record=None):
+    # Entry point for the asyncio engine.
+    try:
+        asyncio.run(async_server_main(host, port, backlog, db_path=db_path, session_ttl=session_ttl,
+                                      max_sessions=max_sessions, hold_seconds=hold_seconds,
+                                      flash_sale=flash_sale, record=record))
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        log.error("Server error: %s", e)
+    finally:
+        RECORDER.stop()
+
+
+def main():
+    # Choose the serving engine from the command line so the two can be compared.
+    parser = argparse.ArgumentParser(description="Vending machine server")
+    parser.add_argument('--engine', choices=['threaded', 'async', 'sharded'], default='threaded',
+                        help="threaded: bounded worker thread pool with admission control, "
+                             "async: single asyncio event loop, "
+                             "sharded: one process per core, stock partitioned between them")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="worker processes for the sharded engine (default: one per core)")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--db', default=None,
+                        help="persist stock and transactions to this SQLite file (write-behind)")
+    parser.add_argument('--session-ttl', type=float, default=1800.0,
+                        help="seconds an idle cart session is kept")
+    parser.add_argument('--max-sessions', type=int, default=100000,
+                        help="number of cart sessions kept in memory (about 500 bytes each plus cart lines) "
+                             "before the least recently used is spilled or dropped")
+    parser.add_argument('--hold-seconds', type=float, default=600.0,
+                        help="how long ADD_TO_CART reserves stock for a cart (0 disables holds)")
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="DEBUG logs every request and response")
+    parser.add_argument('--metrics-sample', type=float, default=0.01,
+                        help="fraction of requests timed for STATS (0 disables timing)")
+    parser.add_argument('--flash-sale', type=int, nargs='+', default=[], metavar='PRODUCT_ID',
+                        help="sell these hot products through a single-writer flash sale lane")
+    parser.add_argument('--backlog', type=int, default=1024, help="listen() backlog of pending connections")
+    parser.add_argument('--pool-workers', type=int, default=32,
+                        help="threaded/sharded: request worker threads (0: one thread per connection, no limits)")
+    parser.add_argument('--max-queue', type=int, default=1024,
+                        help="threaded/sharded: requests waiting for a worker before new ones get BUSY")
+    parser.add_argument('--max-wait', type=float, default=2.0,
+                        help="threaded/sharded: seconds a request may wait for a worker before it gets BUSY")
+    parser.add_argument('--rate-limit', type=float, default=0.0,
+                        help="threaded/sharded: requests per second per connection (0: unlimited)")
+    parser.add_argument('--burst', type=float, default=None,
+                        help="threaded/sharded: requests a connection may send at once (default: the rate limit)")
+    parser.add_argument('--idle-timeout', type=float, default=300.0,
+                        help="threaded/sharded: close connections idle this many seconds (0: never)")
+    parser.add_argument('--record', default=None, metavar='PATH',
+                        help="capture all traffic to PATH for replay.py (sharded: one PATH.<shard> per worker)")
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+    METRICS.configure(args.metrics_sample)
+    pool_options = dict(workers=args.pool_workers, max_queue=args.max_queue, max_wait=args.max_wait,
+                        rate=args.rate_limit, burst=args.burst, idle_timeout=args.idle_timeout)
+
+    if args.engine == 'sharded':
+        if args.db:
+            log.error("--db is not supported by the sharded engine; its stock lives in the worker processes.")
+            return
+        from sharded_server import sharded_server_program  # Imported here: sharded_server builds on this module
+        sharded_server_program(args.host, args.port, args.workers, args.hold_seconds, args.session_ttl,
+                               args.max_sessions, args.flash_sale, args.record, pool_options)
+    elif args.engine == 'async':
+        async_server_program(args.host, args.port, args.db, args.session_ttl, args.max_sessions,
+                             args.hold_seconds, args.backlog, args.flash_sale, args.record)
+    else:
+        server_program(args.host, args.port, args.db, args.session_ttl, args.max_sessions,
+                       args.hold_seconds, args.backlog, args.flash_sale, args.record, **pool_options)
+
+if __name__ == "__main__":
+    main()
+# constructor __main__ method 
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
@@ -0,0 +1,262 @@
+import math
+import time
+
+try:
+    import numpy as np
+except ImportError:  # Optional: sales_series bins in plain Python without it
+    np = None
+
+# Sales analytics over the transactions table of Import_sqlite3.InventoryDatabase.
+#
+# Every order line is also added to two rollup tables, sales_hourly and sales_daily
+# (units, revenue and orders per product per time bucket), in the transaction that
+# writes the line. A report over [since, until) reads whole days from sales_daily,
+# whole hours near the ends from sales_hourly and only the leftover minutes from
+# transactions itself, through a covering index. So a report costs about the same
+# whether the window saw a hundred sales or ten million.
+#
+# Buckets are UTC and named by the epoch second they start at.
+#
+#   top_sellers    best products by units or revenue
+#   revenue        units, revenue and orders in total (or for one product)
+#   sell_through   units sold / (units sold + current stock) for the products sold
+#   sales_series   units and revenue per step (any multiple of a second) for charts
+
+HOUR = 3600
+DAY = 86400
+# Bucket width -> (table per product and bucket, table of all products per bucket). Widest first.
+ROLLUPS = {DAY: ('sales_daily', 'sales_daily_total'), HOUR: ('sales_hourly', 'sales_hourly_total')}
+REPORTS = ('top_sellers', 'revenue', 'sell_through', 'sales_series')
+RANK_BY = ('units', 'revenue')
+DEFAULT_WINDOW = DAY
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 1000
+MAX_POINTS = 10000  # sales_series points per request
+
+CREATE_ROLLUP_SQL = tuple(
+    statement for table, total in ROLLUPS.values() for statement in (
+        f'CREATE TABLE IF NOT EXISTS {table} ('
+        'bucket INTEGER NOT NULL, product_id INTEGER NOT NULL, units INTEGER NOT NULL, '
+        'revenue REAL NOT NULL, orders INTEGER NOT NULL, PRIMARY KEY (bucket, product_id)) WITHOUT ROWID',
+        # One product's history without reading every other product's buckets
+        f'CREATE INDEX IF NOT EXISTS idx_{table}_product ON {table} (product_id, bucket)',
+        f'CREATE TABLE IF NOT EXISTS {total} ('
+        'bucket INTEGER PRIMARY KEY, units INTEGER NOT NULL, revenue REAL NOT NULL, orders INTEGER NOT NULL)',
+    )
+)
+# Covers the raw edge reads: time range, product, amounts and order all come from the index
+CREATE_TRANSACTIONS_TIME_INDEX_SQL = (
+    'CREATE INDEX IF NOT EXISTS idx_transactions_time ON transactions (created_at, product_id, quantity, price, order_id)'
+)
+UPSERT_ROLLUP_SQL = {
+    width: (f'INSERT INTO {table} (bucket, product_id, units, revenue, orders) VALUES (?, ?, ?, ?, 1) '
+            'ON CONFLICT (bucket, product_id) DO UPDATE SET '
+            'units = units + excluded.units, revenue = revenue + excluded.revenue, orders = orders + 1',
+            f'INSERT INTO {total} (bucket, units, revenue, orders) VALUES (?, ?, ?, 1) '
+            'ON CONFLICT (bucket) DO UPDATE SET '
+            'units = units + excluded.units, revenue = revenue + excluded.revenue, orders = orders + 1')
+    for width, (table, total) in ROLLUPS.items()
+}
+REBUILD_ROLLUP_SQL = tuple(
+    statement for width, (table, total) in ROLLUPS.items() for statement in (
+        f'DELETE FROM {table}',
+        f'INSERT INTO {table} (bucket, product_id, units, revenue, orders) '
+        f'SELECT CAST(created_at / {width} AS INTEGER) * {width}, product_id, SUM(quantity), '
+        'SUM(quantity * price), COUNT(DISTINCT order_id) FROM transactions '
+        'WHERE created_at IS NOT NULL GROUP BY 1, 2',
+        f'DELETE FROM {total}',
+        f'INSERT INTO {total} (bucket, units, revenue, orders) '
+        f'SELECT CAST(created_at / {width} AS INTEGER) * {width}, SUM(quantity), '
+        'SUM(quantity * price), COUNT(DISTINCT order_id) FROM transactions '
+        'WHERE created_at IS NOT NULL GROUP BY 1',
+    )
+)
+# (bucket width or None for raw transactions, scope) -> rows of one piece of a split
+# window as (time, product_id, units, revenue, orders). Scopes: 'products' gives a row
+# per product, 'product' only the product passed as the last parameter, 'total' sums
+# all products. Raw rows are grouped per order so orders are counted as the rollups count them.
+RAW_SQL = ('SELECT MIN(created_at) AS time, {product} AS product_id, SUM(quantity) AS units, '
+           'SUM(quantity * price) AS revenue, 1 AS orders FROM transactions '
+           'WHERE created_at >= ? AND created_at < ?{where} GROUP BY order_id{group}')
+ROLLUP_SQL = 'SELECT bucket AS time, product_id, units, revenue, orders FROM {table} WHERE bucket >= ? AND bucket < ?'
+SOURCE_SQL = {
+    (None, 'products'): RAW_SQL.format(product='product_id', where='', group=', product_id'),
+    (None, 'product'): RAW_SQL.format(product='product_id', where=' AND product_id = ?', group=''),
+    (None, 'total'): RAW_SQL.format(product='NULL', where='', group=''),
+    **{(width, scope): sql for width, (table, total) in ROLLUPS.items() for scope, sql in (
+        ('products', ROLLUP_SQL.format(table=table)),
+        ('product', ROLLUP_SQL.format(table=table) + ' AND product_id = ?'),
+        ('total', ROLLUP_SQL.format(table=total).replace('product_id', 'NULL AS product_id')),
+    )},
+}
+
+
+class AnalyticsError(ValueError):
+    pass
+
+
+def create_schema(connection):
+    # Create the rollup tables and the covering index, filling the rollups from
+    # existing transactions the first time. Must run inside a transaction.
+    for statement in CREATE_ROLLUP_SQL:
+        connection.execute(statement)
+    connection.execute(CREATE_TRANSACTIONS_TIME_INDEX_SQL)
+    empty = connection.execute(f'SELECT 1 FROM {ROLLUPS[HOUR][1]} LIMIT 1').fetchone() is None
+    if empty and connection.execute('SELECT 1 FROM transactions WHERE created_at IS NOT NULL LIMIT 1').fetchone():
+        rebuild_rollups(connection)
+
+
+def rebuild_rollups(connection):
+    # Recompute the rollups from transactions. Must run inside a transaction.
+    for statement in REBUILD_ROLLUP_SQL:
+        connection.execute(statement)
+
+
+def record_sales(connection, lines, created_at):
+    # Add an order's (product_id, quantity, price) lines to the rollups. Runs in the
+    # transaction that inserts the lines, so the rollups never disagree with them.
+    if not lines:
+        return
+    totals = {}
+    for product_id, quantity, price in lines:
+        units, revenue = totals.get(product_id, (0, 0.0))
+        totals[product_id] = (units + quantity, revenue + quantity * price)
+    order_units = sum(units for units, _ in totals.values())
+    order_revenue = sum(revenue for _, revenue in totals.values())
+    for width, (product_sql, total_sql) in UPSERT_ROLLUP_SQL.items():
+        bucket = int(created_at // width) * width
+        connection.executemany(product_sql, [(bucket, product_id, units, revenue)
+                                             for product_id, (units, revenue) in totals.items()])
+        connection.execute(total_sql, (bucket, order_units, order_revenue))
+
+
+def split_window(since, until, widths=tuple(ROLLUPS)):
+    # Cover [since, until) with as few rows as possible: yields (width, start, end) with
+    # the widest whole buckets in the middle, narrower ones towards the edges and
+    # width None for the seconds that only transactions can answer.
+    if since >= until:
+        return
+    if not widths:
+        yield None, since, until
+        return
+    width = widths[0]
+    start = math.ceil(since / width) * width
+    end = until // width * width
+    if start >= end:
+        yield from split_window(since, until, widths[1:])
+        return
+    yield from split_window(since, start, widths[1:])
+    yield width, start, end
+    yield from split_window(end, until, widths[1:])
+
+
+def window_sql(since, until, product_id=None, total=False, widths=tuple(ROLLUPS)):
+    # (sql, params) for the rows of [since, until) as (time, product_id, units, revenue,
+    # orders): one row per product and bucket, only product_id's rows, or with total
+    # one row per bucket for all products together.
+    scope = 'product' if product_id is not None else 'total' if total else 'products'
+    parts = list(split_window(since, until, widths)) or [(None, since, since)]
+    extra = (product_id,) if product_id is not None else ()
+    return (' UNION ALL '.join(SOURCE_SQL[width, scope] for width, _, _ in parts),
+            [value for _, start, end in parts for value in (start, end) + extra])
+
+
+def top_sellers(connection, since, until, limit=DEFAULT_LIMIT, by='units'):
+    sql, params = window_sql(since, until)
+    rows = connection.execute(
+        f'SELECT s.product_id, p.name, s.units, s.revenue, s.orders FROM ('
+        f'SELECT product_id, SUM(units) AS units, SUM(revenue) AS revenue, SUM(orders) AS orders FROM ({sql}) '
+        f'GROUP BY product_id ORDER BY {by} DESC, product_id LIMIT ?'
+        f') s LEFT JOIN products p ON p.id = s.product_id ORDER BY s.{by} DESC, s.product_id',
+        params + [limit]).fetchall()
+    return [{'id': row[0], 'name': row[1], 'units': row[2], 'revenue': round(row[3], 2), 'orders': row[4]}
+            for row in rows]
+
+
+def revenue(connection, since, until, product_id=None):
+    sql, params = window_sql(since, until, product_id, total=True)
+    units, total, orders = connection.execute(
+        f'SELECT COALESCE(SUM(units), 0), COALESCE(SUM(revenue), 0), COALESCE(SUM(orders), 0) FROM ({sql})',
+        params).fetchone()
+    return {'units': units, 'revenue': round(total, 2), 'orders': orders}
+
+
+def sell_through(connection, since, until, limit=DEFAULT_LIMIT):
+    # Sell-through of the products sold in the window, highest first. What was on the
+    # shelf is taken as what sold plus what is left, so restocks during the window are
+    # not accounted for.
+    sql, params = window_sql(since, until)
+    rows = connection.execute(
+        f'SELECT s.product_id, p.name, s.units, p.stock, '
+        f'CAST(s.units AS REAL) / (s.units + p.stock) AS rate FROM ('
+        f'SELECT product_id, SUM(units) AS units FROM ({sql}) GROUP BY product_id'
+        f') s JOIN products p ON p.id = s.product_id ORDER BY rate DESC, s.product_id LIMIT ?',
+        params + [limit]).fetchall()
+    return [{'id': row[0], 'name': row[1], 'units': row[2], 'stock': row[3], 'sell_through': round(row[4], 4)}
+            for row in rows]
+
+
+def sales_series(connection, since, until, step=HOUR, product_id=None):
+    # Units and revenue per step-long bin, bins aligned to multiples of step (the
+    # first and last are clipped to the window). Only rollups whose buckets fit
+    # whole into a bin are read; the bins are filled with one vectorised pass.
+    first = since // step * step
+    count = max(0, math.ceil((until - first) / step))
+    widths = tuple(width for width in ROLLUPS if step % width == 0)
+    sql, params = window_sql(since, until, product_id, total=True, widths=widths)
+    rows = connection.execute(f'SELECT time, units, revenue FROM ({sql})', params).fetchall()
+    if np is not None and rows:
+        times, units, revenues = np.array(rows, dtype=float).T
+        bins = ((times - first) // step).astype(np.int64)
+        units = np.bincount(bins, weights=units, minlength=count).tolist()
+        revenues = np.bincount(bins, weights=revenues, minlength=count).tolist()
+    else:
+        units = [0] * count
+        revenues = [0.0] * count
+        for time_, unit_count, total in rows:
+            index = int((time_ - first) // step)
+            units[index] += unit_count
+            revenues[index] += total
+    return [{'start': max(since, first + index * step), 'units': int(units[index]),
+             'revenue': round(revenues[index], 2)} for index in range(count)]
+
+
+def parse_report(params, now=None):
+    # Validate a report request (a dict, e.g. from an "analytics" action) and return
+    # (report, keyword arguments for InventoryDatabase.sales_report).
+    if not isinstance(params, dict):
+        raise AnalyticsError("Report request must be a JSON object")
+    report = params.get('report')
+    if report not in REPORTS:
+        raise AnalyticsError(f"report must be one of {', '.join(REPORTS)}")
+    try:
+        until = float(params['until']) if params.get('until') is not None else (now or time.time())
+        since = float(params['since']) if params.get('since') is not None else until - DEFAULT_WINDOW
+        limit = int(params.get('limit', DEFAULT_LIMIT))
+        step = int(params.get('step', HOUR))
+        product_id = int(params['product_id']) if params.get('product_id') is not None else None
+    except (TypeError, ValueError):
+        raise AnalyticsError("since, until, limit, step and product_id must be numbers")
+    if since >= until:
+        raise AnalyticsError("since must be before until")
+    options = {'since': since, 'until': until}
+    if report in ('top_sellers', 'sell_through'):
+        options['limit'] = max(1, min(limit, MAX_LIMIT))
+    if report == 'top_sellers':
+        by = params.get('by', 'units')
+        if by not in RANK_BY:
+            raise AnalyticsError(f"by must be one of {', '.join(RANK_BY)}")
+        options['by'] = by
+    if report in ('revenue', 'sales_series'):
+        options['product_id'] = product_id
+    if report == 'sales_series':
+        if step < 1 or (until - since) / step > MAX_POINTS:
+            raise AnalyticsError(f"step must be at least 1 and give at most {MAX_POINTS} points")
+        options['step'] = step
+    return report, options
+
+
+def run_report(connection, report, **options):
+    # Dispatch a report parsed by parse_report.
+    return {'top_sellers': top_sellers, 'revenue': revenue, 'sell_through': sell_through,
+            'sales_series': sales_series}[report](connection, **options)
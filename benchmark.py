@@ -0,0 +1,391 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import columnar
+from Server_Code import Inventory, Product
+from Import_sqlite3 import InventoryDatabase
+
+# Benchmarks and stress checks for the vending server components.
+# Run with: python benchmark.py <name> [options]
+
+
+def stress_checkout(threads, attempts_per_thread, hot_products=(5, 1), stock=None, seed=0):
+    # Hammer Inventory.process_checkout from many threads at once.
+    # Every thread checks out small random carts drawn mostly from the hot products.
+    # Returns a result dict with throughput and the consistency check outcome.
+    inventory = Inventory()
+    if stock is not None:
+        for product in inventory.products.values():
+            product.stock = stock
+    initial = {product.id: product.stock for product in inventory.products.values()}
+    product_ids = list(inventory.products)
+    sold = {product_id: 0 for product_id in product_ids}
+    sold_lock = threading.Lock()
+    successes = [0]
+    start_barrier = threading.Barrier(threads + 1)
+
+    def worker(worker_id):
+        rng = random.Random(seed + worker_id)
+        local_sold = {}
+        local_successes = 0
+        start_barrier.wait()
+        for _ in range(attempts_per_thread):
+            cart = []
+            for _ in range(rng.randint(1, 3)):
+                product_id = rng.choice(hot_products) if rng.random() < 0.8 else rng.choice(product_ids)
+                cart.append((product_id, rng.randint(1, 2)))
+            success, _ = inventory.process_checkout(cart)
+            if success:
+                local_successes += 1
+                for product_id, quantity in cart:
+                    local_sold[product_id] = local_sold.get(product_id, 0) + quantity
+        with sold_lock:
+            successes[0] += local_successes
+            for product_id, quantity in local_sold.items():
+                sold[product_id] += quantity
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    start_barrier.wait()
+    started = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    violations = []
+    for product in inventory.products.values():
+        if product.stock < 0:
+            violations.append(f"{product.name}: negative stock {product.stock}")
+        if initial[product.id] - product.stock != sold[product.id]:
+            violations.append(f"{product.name}: stock moved by {initial[product.id] - product.stock}"
+                              f" but {sold[product.id]} were sold")
+    total_attempts = threads * attempts_per_thread
+    return {
+        'threads': threads,
+        'attempts': total_attempts,
+        'successful_checkouts': successes[0],
+        'seconds': elapsed,
+        'checkouts_per_sec': total_attempts / elapsed if elapsed else 0.0,
+        'violations': violations,
+    }
+
+
+def run_stress(args):
+    for threads in args.threads:
+        result = stress_checkout(threads, args.attempts, stock=args.stock)
+        status = "OK" if not result['violations'] else "OVERSOLD"
+        print(f"{threads:>4} threads | {result['attempts']:>8} attempts | "
+              f"{result['successful_checkouts']:>7} succeeded | "
+              f"{result['checkouts_per_sec']:>10.0f} checkouts/sec | {status}")
+        for violation in result['violations']:
+            print(f"    {violation}")
+
+
+def flash_sale_run(threads, attempts_per_thread, stock, flash, product_id=5):
+    # Many threads trying to buy one unit of the same product, with or without its FlashSale lane.
+    # Every attempt draws an arrival ticket just before it is made, so the grants can be
+    # compared with the order in which the attempts arrived.
+    inventory = Inventory()
+    inventory.products[product_id].stock = stock
+    if flash:
+        inventory.enable_flash_sale(product_id)
+    tickets = itertools.count()
+    outcomes = []  # (ticket, granted, seconds) per attempt
+    outcomes_lock = threading.Lock()
+    start_barrier = threading.Barrier(threads + 1)
+
+    def worker():
+        local = []
+        start_barrier.wait()
+        for _ in range(attempts_per_thread):
+            ticket = next(tickets)
+            started = time.perf_counter()
+            granted, _ = inventory.process_checkout({product_id: 1})
+            local.append((ticket, granted, time.perf_counter() - started))
+        with outcomes_lock:
+            outcomes.extend(local)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    start_barrier.wait()
+    started = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    granted = sorted(ticket for ticket, ok, _ in outcomes if ok)
+    # Fairness: attempts refused although they arrived before the last attempt that got a unit
+    overtaken = sum(1 for ticket, ok, _ in outcomes if not ok and granted and ticket < granted[-1])
+    grant_latency = sorted(seconds for _, ok, seconds in outcomes if ok)
+    reject_latency = sorted(seconds for _, ok, seconds in outcomes if not ok)
+
+    def ms(samples, fraction):
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000 if samples else None
+
+    return {
+        'attempts': len(outcomes),
+        'granted': len(granted),
+        'oversold': inventory.products[product_id].stock < 0 or len(granted) != stock,
+        'overtaken': overtaken,
+        'attempts_per_sec': len(outcomes) / elapsed if elapsed else 0.0,
+        'grant_p50_ms': ms(grant_latency, 0.5), 'grant_p99_ms': ms(grant_latency, 0.99),
+        'reject_p50_ms': ms(reject_latency, 0.5), 'reject_p99_ms': ms(reject_latency, 0.99),
+        'flash_sale': inventory.flash_sales[product_id].stats() if flash else None,
+    }
+
+
+def run_flash_sale(args):
+    def cell(value):
+        return f"{value:>8.3f}" if value is not None else f"{'-':>8}"
+
+    print(f"{args.stock} units of product 5, one unit per attempt\n"
+          f"{'mode':<6} | {'threads':>7} | {'attempts/s':>10} | {'granted':>7} | {'overtaken':>9} | "
+          f"{'grant p50':>9} | {'grant p99':>9} | {'reject p50':>10} | {'reject p99':>10}")
+    for threads in args.threads:
+        for mode in args.modes:
+            result = flash_sale_run(threads, args.attempts, args.stock, mode == 'flash')
+            status = " OVERSOLD" if result['oversold'] else ""
+            print(f"{mode:<6} | {threads:>7} | {result['attempts_per_sec']:>10.0f} | {result['granted']:>7} | "
+                  f"{result['overtaken']:>9} | {cell(result['grant_p50_ms'])} ms | {cell(result['grant_p99_ms'])} ms | "
+                  f" {cell(result['reject_p50_ms'])} ms |  {cell(result['reject_p99_ms'])} ms{status}")
+            if result['flash_sale'] and args.verbose:
+                print(f"         {result['flash_sale']}")
+
+
+class LegacyInventoryDatabase:
+    # The original InventoryDatabase: a fresh sqlite3 connection for every call.
+    # Kept here only as the baseline for the sqlite benchmark.
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def update_inventory_in_db(self, product_id, quantity):
+        connection = sqlite3.connect(self.db_path)
+        cursor = connection.cursor()
+        cursor.execute('UPDATE products SET stock = stock - ? WHERE id = ? AND stock >= ?', (quantity, product_id, quantity))
+        updated = cursor.rowcount > 0
+        connection.commit()
+        connection.close()
+        return updated
+
+    def save_transaction_in_db(self, cart):
+        connection = sqlite3.connect(self.db_path)
+        cursor = connection.cursor()
+        for item in cart:
+            cursor.execute('INSERT INTO transactions (product_id, quantity, price) VALUES (?, ?, ?)',
+                           (item['id'], item['quantity'], item['price']))
+        connection.commit()
+        connection.close()
+
+    def checkout(self, cart):
+        # Checkout as the original Import_sqlite3.handle_client did it: one commit per item
+        for item in cart:
+            if not self.update_inventory_in_db(item['id'], item['quantity']):
+                return False, f"Insufficient stock for Product ID {item['id']}."
+        self.save_transaction_in_db(cart)
+        return True, "Checkout successful."
+
+    def close(self):
+        pass
+
+
+def create_benchmark_db(db_path, products, stock):
+    # Create a database with the standard schema (rollups included) and products 1..products.
+    db = InventoryDatabase(db_path)
+    try:
+        db.create_schema()
+    finally:
+        db.close()
+    connection = sqlite3.connect(db_path)
+    connection.executemany('INSERT INTO products (id, name, price, stock) VALUES (?, ?, ?, ?)',
+                           [(i, f"Product {i}", 9.99, stock) for i in range(1, products + 1)])
+    connection.commit()
+    connection.close()
+
+
+def sqlite_checkouts(db, threads, checkouts_per_thread, products, seed=0):
+    # Run random checkouts through db.checkout from several threads.
+    # Returns (checkouts/sec, failed checkouts); stock is unlimited, so any failure is a bug.
+    start_barrier = threading.Barrier(threads + 1)
+    failures = [0]
+    failures_lock = threading.Lock()
+
+    def worker(worker_id):
+        rng = random.Random(seed + worker_id)
+        local_failures = 0
+        start_barrier.wait()
+        for _ in range(checkouts_per_thread):
+            cart = [{'id': rng.randint(1, products), 'quantity': 1, 'price': 9.99}
+                    for _ in range(rng.randint(1, 3))]
+            try:
+                success, _ = db.checkout(cart)
+            except sqlite3.Error:
+                success = False
+            if not success:
+                local_failures += 1
+        with failures_lock:
+            failures[0] += local_failures
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    start_barrier.wait()
+    started = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return threads * checkouts_per_thread / elapsed, failures[0]
+
+
+def run_sqlite(args):
+    with tempfile.TemporaryDirectory() as directory:
+        engines = [
+            ('per-call connections', lambda path: LegacyInventoryDatabase(path)),
+            ('pooled + WAL', lambda path: InventoryDatabase(path, pool_size=args.pool_size)),
+            ('group commit', lambda path: InventoryDatabase(path, pool_size=args.pool_size, group_commit=True)),
+        ]
+        for label, factory in engines:
+            db_path = os.path.join(directory, label.replace(' ', '_') + '.db')
+            create_benchmark_db(db_path, args.products, stock=10 ** 9)
+            db = factory(db_path)
+            try:
+                rate, failures = sqlite_checkouts(db, args.threads, args.checkouts, args.products)
+            finally:
+                db.close()
+            status = f"{failures} FAILED" if failures else "OK"
+            print(f"{label:<22} | {args.threads:>3} threads | {rate:>10.0f} checkouts/sec | {status}")
+
+
+class LegacyProduct:
+    # The original Product layout (per-instance __dict__, no interning), for comparison.
+    def __init__(self, product_id, name, price, stock):
+        self.id = product_id
+        self.name = name
+        self.price = price
+        self.stock = stock
+        self.lock = threading.Lock()
+
+
+def measure_memory(build):
+    # Return (bytes allocated, result) for the objects built by build().
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return after - before, result
+
+
+def run_memory(args):
+    names = [f"Product family {i % 1000}" for i in range(args.products)]  # Repeated names, as in real catalogs
+
+    def legacy_catalog():
+        # Names arrive as fresh strings (e.g. parsed from a feed), so copies are not shared
+        return {i: LegacyProduct(i, ''.join(names[i]), 9.99, 10) for i in range(args.products)}
+
+    def compact_catalog():
+        return {i: Product(i, ''.join(names[i]), 9.99, 10) for i in range(args.products)}
+
+    rng = random.Random(0)
+    carts = [[rng.randrange(args.products) for _ in range(args.lines)] for _ in range(args.carts)]
+
+    def legacy_carts():
+        # The old handle_client cart: a list of dicts copying name and price into every line
+        return [[{'id': product_id, 'name': names[product_id], 'quantity': 1, 'price': 9.99}
+                 for product_id in cart] for cart in carts]
+
+    def compact_carts():
+        return [{product_id: 1 for product_id in cart} for cart in carts]
+
+    for label, legacy, compact in (('catalog', legacy_catalog, compact_catalog),
+                                   ('carts', legacy_carts, compact_carts)):
+        legacy_bytes, legacy_objects = measure_memory(legacy)
+        compact_bytes, compact_objects = measure_memory(compact)
+        print(f"{label:<8} | legacy {legacy_bytes / 2 ** 20:>8.1f} MiB | "
+              f"compact {compact_bytes / 2 ** 20:>8.1f} MiB | "
+              f"saved {100 * (1 - compact_bytes / legacy_bytes):>5.1f}%")
+        del legacy_objects, compact_objects
+
+
+def run_encoding(args):
+    # Size and speed of the JSON and columnar VIEW_PRODUCTS payloads for a large catalog.
+    rng = random.Random(0)
+    rows = [(i, f"Product family {i % 1000}", round(rng.uniform(1, 100), 2), rng.randint(0, 500))
+            for i in range(1, args.products + 1)]
+
+    def json_encode():
+        return json.dumps([{'id': i, 'name': n, 'price': p, 'stock': s} for i, n, p, s in rows]).encode('utf-8')
+
+    def timed(function, *arguments):
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            result = function(*arguments)
+        return result, (time.perf_counter() - started) / args.repeat * 1000
+
+    json_payload, json_encode_ms = timed(json_encode)
+    _, json_decode_ms = timed(json.loads, json_payload)
+    compact_payload, compact_encode_ms = timed(columnar.encode, rows, 1)
+    _, rows_decode_ms = timed(columnar.decode, compact_payload)
+    _, columns_decode_ms = timed(columnar.decode_columns, compact_payload)
+    print(f"{'json':<18} | {len(json_payload) / 2 ** 20:>7.2f} MiB | encode {json_encode_ms:>8.1f} ms | "
+          f"decode {json_decode_ms:>8.1f} ms")
+    print(f"{'columnar (rows)':<18} | {len(compact_payload) / 2 ** 20:>7.2f} MiB | encode {compact_encode_ms:>8.1f} ms | "
+          f"decode {rows_decode_ms:>8.1f} ms")
+    print(f"{'columnar (columns)':<18} | {len(compact_payload) / 2 ** 20:>7.2f} MiB | encode {compact_encode_ms:>8.1f} ms | "
+          f"decode {columns_decode_ms:>8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vending server benchmarks")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    stress = subparsers.add_parser('stress', help="concurrent checkout stress test on hot products")
+    stress.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16, 64, 256])
+    stress.add_argument('--attempts', type=int, default=2000, help="checkout attempts per thread")
+    stress.add_argument('--stock', type=int, default=None,
+                        help="starting stock for every product (default: the built-in levels)")
+    stress.set_defaults(func=run_stress)
+
+    sqlite = subparsers.add_parser('sqlite', help="checkouts/sec of the SQLite persistence layer")
+    sqlite.add_argument('--threads', type=int, default=4)
+    sqlite.add_argument('--checkouts', type=int, default=500, help="checkouts per thread")
+    sqlite.add_argument('--products', type=int, default=100)
+    sqlite.add_argument('--pool-size', type=int, default=4)
+    sqlite.set_defaults(func=run_sqlite)
+
+    memory = subparsers.add_parser('memory', help="memory use of the product and cart layouts")
+    memory.add_argument('--products', type=int, default=200000)
+    memory.add_argument('--carts', type=int, default=20000)
+    memory.add_argument('--lines', type=int, default=5, help="line items per cart")
+    memory.set_defaults(func=run_memory)
+
+    encoding = subparsers.add_parser('encoding', help="JSON vs columnar catalog payloads")
+    encoding.add_argument('--products', type=int, default=100000)
+    encoding.add_argument('--repeat', type=int, default=5)
+    encoding.set_defaults(func=run_encoding)
+
+    flash_sale = subparsers.add_parser('flash-sale', help="contention on one hot product, with and without its lane")
+    flash_sale.add_argument('--threads', type=int, nargs='+', default=[16, 64, 256])
+    flash_sale.add_argument('--attempts', type=int, default=200, help="purchase attempts per thread")
+    flash_sale.add_argument('--stock', type=int, default=1000, help="units on sale")
+    flash_sale.add_argument('--modes', nargs='+', choices=['lock', 'flash'], default=['lock', 'flash'],
+                            help="lock: the per-product lock path, flash: the FlashSale lane")
+    flash_sale.add_argument('--verbose', action='store_true', help="also print the lane's own counters")
+    flash_sale.set_defaults(func=run_flash_sale)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
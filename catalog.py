@@ -0,0 +1,189 @@
+import base64
+import bisect
+import heapq
+import json
+import string
+
+# Catalog queries for large SKU counts.
+#
+# CatalogIndex keeps sorted secondary indexes over the in-memory products so a
+# browse request only touches the page it returns: a bisect finds the first row
+# (O(log n)) and the page is read off the sorted list. Pages are chained with
+# opaque keyset cursors that encode the sort key of the last row returned, so
+# page N costs the same as page 1 and stays stable while stock changes.
+#
+# Names sort and match case-insensitively the way SQLite's NOCASE collation does,
+# which folds only ASCII letters, so the in-memory and SQLite stores return the
+# same pages for any name (see name_key).
+
+SORT_KEYS = ('id', 'price', 'name')
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+class QueryError(ValueError):
+    pass
+
+
+def name_key(name):
+    # Case-folded name as SQLite NOCASE compares it: A-Z lowered, everything else as is.
+    return name.translate(ASCII_LOWER)
+
+
+def encode_cursor(sort, key):
+    # Turn the sort key of the last row on a page into an opaque cursor string.
+    return base64.urlsafe_b64encode(json.dumps([sort, list(key)]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, sort):
+    # Inverse of encode_cursor. The cursor must come from a query with the same sort.
+    try:
+        cursor_sort, key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        raise QueryError("Invalid cursor")
+    if cursor_sort != sort:
+        raise QueryError("Cursor belongs to a query with a different sort")
+    return tuple(key)
+
+
+def parse_query(params):
+    # Validate query parameters (a dict, e.g. decoded from a QUERY_PRODUCTS request)
+    # and return the keyword arguments for CatalogIndex.query / InventoryDatabase.query_products.
+    if not isinstance(params, dict):
+        raise QueryError("Query must be a JSON object")
+    sort = params.get('sort', 'id')
+    if sort not in SORT_KEYS:
+        raise QueryError(f"sort must be one of {', '.join(SORT_KEYS)}")
+    try:
+        limit = int(params.get('limit', DEFAULT_PAGE_SIZE))
+        min_price = params.get('min_price')
+        max_price = params.get('max_price')
+        min_price = float(min_price) if min_price is not None else None
+        max_price = float(max_price) if max_price is not None else None
+    except (TypeError, ValueError):
+        raise QueryError("limit, min_price and max_price must be numbers")
+    prefix = params.get('prefix')
+    if prefix is not None and not isinstance(prefix, str):
+        raise QueryError("prefix must be a string")
+    cursor = params.get('cursor')
+    return {
+        'sort': sort,
+        'limit': max(1, min(limit, MAX_PAGE_SIZE)),
+        'min_price': min_price,
+        'max_price': max_price,
+        'prefix': name_key(prefix) if prefix else None,
+        'after': decode_cursor(cursor, sort) if cursor else None,
+    }
+
+
+class CatalogIndex:
+    def __init__(self, products=()):
+        # Build the indexes in one sort each; afterwards they are maintained incrementally.
+        products = list(products)
+        self.ids = sorted(product.id for product in products)
+        self.by_price = sorted((product.price, product.id) for product in products)
+        self.by_name = sorted((name_key(product.name), product.id) for product in products)
+
+    def add(self, product):
+        bisect.insort(self.ids, product.id)
+        bisect.insort(self.by_price, (product.price, product.id))
+        bisect.insort(self.by_name, (name_key(product.name), product.id))
+
+    def reprice(self, product, old_price):
+        # Move a product within the price index after its price changed.
+        position = bisect.bisect_left(self.by_price, (old_price, product.id))
+        if position < len(self.by_price) and self.by_price[position] == (old_price, product.id):
+            del self.by_price[position]
+        bisect.insort(self.by_price, (product.price, product.id))
+
+    def query(self, products, sort='id', limit=DEFAULT_PAGE_SIZE, min_price=None, max_price=None,
+              prefix=None, after=None):
+        # Return (page, next_cursor). page is a list of Product objects from the products dict.
+        # Rows are walked in index order starting at the cursor; the filter that matches
+        # the sort order bounds the walk, the other one is checked row by row.
+        # Callers must keep the indexes from changing meanwhile (Inventory._index_lock).
+        if sort == 'id':
+            return self._query_ids(products, limit, min_price, max_price, prefix, after)
+        if sort == 'price':
+            keys = self.by_price
+            start = (min_price if min_price is not None else float('-inf'),)
+            stop = (lambda key: key[0] > max_price) if max_price is not None else None
+        else:
+            keys = self.by_name
+            start = (prefix,) if prefix else ()
+            stop = (lambda key: not key[0].startswith(prefix)) if prefix else None
+
+        position = bisect.bisect_left(keys, start)
+        if after is not None:
+            position = max(position, bisect.bisect_right(keys, after))
+        page = []
+        last_key = None
+        while position < len(keys) and len(page) < limit:
+            key = keys[position]
+            position += 1
+            if stop and stop(key):
+                position = len(keys)
+                break
+            product = products[key[1]]
+            if self._matches(product, min_price, max_price, prefix):
+                page.append(product)
+                last_key = key
+        more = position < len(keys) and not (stop and stop(keys[position]))
+        return page, encode_cursor(sort, last_key) if more and last_key else None
+
+    def _price_range(self, min_price, max_price):
+        # (start, end) positions in by_price of the products priced within the bounds.
+        start = bisect.bisect_left(self.by_price, (min_price,)) if min_price is not None else 0
+        end = len(self.by_price)
+        if max_price is not None:
+            end = bisect.bisect_left(self.by_price, (max_price, float('inf')))
+        return start, max(start, end)
+
+    def _prefix_range(self, prefix):
+        # (start, end) positions in by_name of the names starting with prefix.
+        start = bisect.bisect_left(self.by_name, (prefix,))
+        return start, bisect.bisect_left(self.by_name, (prefix + chr(0x10FFFF),))
+
+    def _query_ids(self, products, limit, min_price, max_price, prefix, after):
+        # The price and name indexes narrow a filtered query to the rows in range. Those
+        # are only sorted by ID when that is cheaper than walking the ID index until a
+        # page has matched, which takes about limit * len(ids) / matches rows.
+        candidates = []
+        if min_price is not None or max_price is not None:
+            candidates.append((self.by_price, *self._price_range(min_price, max_price)))
+        if prefix:
+            candidates.append((self.by_name, *self._prefix_range(prefix)))
+        if candidates:
+            keys, start, end = min(candidates, key=lambda candidate: candidate[2] - candidate[1])
+            if (end - start) ** 2 <= limit * len(self.ids):
+                return self._query_range(products, limit, min_price, max_price, prefix, after, keys[start:end])
+
+        position = bisect.bisect_right(self.ids, after[0]) if after is not None else 0
+        page = []
+        while position < len(self.ids) and len(page) < limit:
+            product = products[self.ids[position]]
+            position += 1
+            if self._matches(product, min_price, max_price, prefix):
+                page.append(product)
+        more = position < len(self.ids)
+        return page, encode_cursor('id', (page[-1].id,)) if more and page else None
+
+    def _query_range(self, products, limit, min_price, max_price, prefix, after, keys):
+        # _query_ids over the index entries keys, which cover every row that can match.
+        first = after[0] if after is not None else None
+        ids = heapq.nsmallest(limit + 1, (product_id for _, product_id in keys
+                                           if (first is None or product_id > first)
+                                           and self._matches(products[product_id], min_price, max_price, prefix)))
+        page = [products[product_id] for product_id in ids[:limit]]
+        return page, encode_cursor('id', (page[-1].id,)) if len(ids) > limit else None
+
+    @staticmethod
+    def _matches(product, min_price, max_price, prefix):
+        if min_price is not None and product.price < min_price:
+            return False
+        if max_price is not None and product.price > max_price:
+            return False
+        if prefix and not name_key(product.name).startswith(prefix):
+            return False
+        return True
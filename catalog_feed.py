@@ -0,0 +1,180 @@
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+import time
+
+from Import_sqlite3 import IMPORT_MODES, InventoryDatabase
+from metrics import configure_logging, log
+
+# Streaming catalog import and export for Import_sqlite3.InventoryDatabase.
+#
+# Every stage is a generator, so a multi-gigabyte feed flows through in constant
+# memory: lines are read from the file (gzip-compressed if it ends in .gz), turned
+# into records, validated into (id, name, price, stock) tuples and handed to
+# InventoryDatabase.import_products, which writes them with executemany in large
+# transactions.
+#
+# CSV feeds need a header naming the columns; JSONL feeds have one object per line.
+# Columns besides id, name, price and stock are ignored. Rows that cannot be
+# parsed are counted as rejected (the first few are logged); in update mode rows
+# whose product does not exist are counted as skipped.
+#
+#   python catalog_feed.py import nightly.csv.gz --db store.db
+#   python catalog_feed.py import prices.jsonl --db store.db --mode update
+#   python catalog_feed.py export catalog.jsonl --db store.db
+
+FIELDS = ('id', 'name', 'price', 'stock')
+FORMATS = ('csv', 'jsonl')
+LOGGED_ERRORS = 10
+
+
+class FeedStats:
+    def __init__(self):
+        self.read = 0
+        self.rejected = 0  # Could not be parsed
+        self.skipped = 0  # Parsed, but changed nothing (update mode: unknown product ID)
+
+
+def feed_format(path, format=None):
+    # The explicit format, or the one the file name suggests.
+    if format:
+        return format
+    name = path[:-3] if path.endswith('.gz') else path
+    return 'csv' if name.endswith('.csv') else 'jsonl'
+
+
+def open_feed(path, mode):
+    # Text file handle for path ('-' is stdin/stdout); .gz files are (de)compressed on the fly.
+    if path == '-':
+        stream = sys.stdin if mode == 'r' else sys.stdout
+        return io.TextIOWrapper(stream.buffer, encoding='utf-8', newline='')
+    if path.endswith('.gz'):
+        # Level 6 instead of gzip's default 9: nearly as small, several times faster to write
+        return gzip.open(path, mode + 't', compresslevel=6, encoding='utf-8', newline='')
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+def read_records(file, format):
+    # Yield (line number, record) with record a list matching FIELDS; None marks a missing value.
+    if format == 'csv':
+        reader = csv.reader(file)
+        header = [name.strip().lower() for name in next(reader, [])]
+        if 'id' not in header:
+            raise ValueError("CSV header has no id column")
+        columns = [header.index(field) if field in header else None for field in FIELDS]
+        for line, row in enumerate(reader, 2):
+            if row:
+                yield line, [row[column] if column is not None and column < len(row) and row[column] != '' else None
+                             for column in columns]
+    else:
+        for line, text in enumerate(file, 1):
+            if text.strip():
+                try:
+                    record = json.loads(text)
+                except ValueError:
+                    yield line, None
+                    continue
+                yield line, [record.get(field) for field in FIELDS] if isinstance(record, dict) else None
+
+
+def parse_rows(records, stats, partial=False):
+    # Yield validated (id, name, price, stock) tuples. With partial, name, price and
+    # stock may be missing (None keeps the stored value, see import_products).
+    for line, record in records:
+        stats.read += 1
+        try:
+            if record is None:
+                raise ValueError("not a valid record")
+            product_id, name, price, stock = record
+            product_id = int(product_id)
+            name = str(name) if name is not None else None
+            price = float(price) if price is not None else None
+            stock = int(stock) if stock is not None else None
+            if not partial and (name is None or price is None or stock is None):
+                raise ValueError("name, price and stock are required")
+            if (price is not None and price < 0) or (stock is not None and stock < 0):
+                raise ValueError("negative price or stock")
+        except (TypeError, ValueError) as e:
+            stats.rejected += 1
+            if stats.rejected <= LOGGED_ERRORS:
+                log.warning("Skipping line %d: %s", line, e)
+            continue
+        yield product_id, name, price, stock
+
+
+def write_rows(file, rows, format):
+    # Write (id, name, price, stock) rows to file. Returns how many were written.
+    count = 0
+    if format == 'csv':
+        writer = csv.writer(file)
+        writer.writerow(FIELDS)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    else:
+        for product_id, name, price, stock in rows:
+            # Only the name needs JSON escaping; numbers are written as they are
+            file.write(f'{{"id": {product_id}, "name": {json.dumps(name)}, "price": {price!r}, "stock": {stock}}}\n')
+            count += 1
+    return count
+
+
+def import_feed(db, path, format=None, mode='upsert', chunk_size=10000, commit_every=500000):
+    # Load the feed at path into db. Returns (rows written, FeedStats, seconds).
+    stats = FeedStats()
+    started = time.perf_counter()
+
+    def progress(total):
+        log.info("%d rows imported (%.0f rows/sec)", total, total / (time.perf_counter() - started))
+
+    with open_feed(path, 'r') as file:
+        rows = parse_rows(read_records(file, feed_format(path, format)), stats, partial=mode == 'update')
+        written = db.import_products(rows, mode, chunk_size, commit_every, progress)
+    stats.skipped = stats.read - stats.rejected - written
+    return written, stats, time.perf_counter() - started
+
+
+def export_feed(db, path, format=None, chunk_size=10000):
+    # Write every product of db to path. Returns (rows written, seconds).
+    started = time.perf_counter()
+    with open_feed(path, 'w') as file:
+        written = write_rows(file, db.export_products(chunk_size), feed_format(path, format))
+    return written, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk catalog import and export for the SQLite inventory")
+    parser.add_argument('command', choices=['import', 'export'])
+    parser.add_argument('path', help="CSV or JSONL file, optionally .gz; - for stdin/stdout")
+    parser.add_argument('--db', default='store.db')
+    parser.add_argument('--format', choices=FORMATS, default=None, help="default: from the file name")
+    parser.add_argument('--mode', choices=IMPORT_MODES, default='upsert',
+                        help="upsert: add or overwrite whole products, update: change fields of existing products")
+    parser.add_argument('--chunk-size', type=int, default=10000, help="rows per executemany call")
+    parser.add_argument('--commit-every', type=int, default=500000, help="rows per transaction")
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    db = InventoryDatabase(args.db, pool_size=1)
+    db.create_schema()
+    try:
+        if args.command == 'import':
+            written, stats, seconds = import_feed(db, args.path, args.format, args.mode, args.chunk_size,
+                                                  args.commit_every)
+            print(f"Imported {written} rows ({stats.rejected} rejected, {stats.skipped} skipped) in {seconds:.1f}s, "
+                  f"{written / seconds if seconds else 0:.0f} rows/sec")
+        else:
+            written, seconds = export_feed(db, args.path, args.format, args.chunk_size)
+            if args.path != '-':
+                print(f"Exported {written} rows ({os.path.getsize(args.path) / 2 ** 20:.1f} MiB) in {seconds:.1f}s, "
+                      f"{written / seconds if seconds else 0:.0f} rows/sec")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
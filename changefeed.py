@@ -0,0 +1,155 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from metrics import log
+from protocol import encode_frame
+
+# Catalog change feed for SUBSCRIBE.
+#
+# Every stock or price change appends (sequence number, product ID) to a bounded
+# change log. A broadcaster thread wakes at most every `interval` seconds, takes
+# everything logged since each subscriber's last sequence and pushes one delta
+# with the current price and stock of the products involved. Deltas carry state,
+# not differences, so several changes to one product in a tick collapse into one
+# entry and applying a delta twice is harmless.
+#
+# Subscribers at the same sequence (normally all of them) share one encoded delta.
+# A client that reconnects sends the last sequence and epoch it saw and gets what it
+# missed as a delta. Sequences restart with every feed, so the epoch (random, one per
+# feed) tells whether the sequence belongs to this feed's history at all; if it does
+# not, or the sequence has already fallen out of the log, the client gets a full
+# snapshot instead. Messages (JSON, pushed as frames with the SUBSCRIBE request id):
+#
+#     {"type": "snapshot", "epoch": "9c1f...", "seq": 120, "products": [{"id", "name", "price", "stock"}, ...]}
+#     {"type": "delta", "epoch": "9c1f...", "from": 120, "seq": 123, "changes": [{"id", "price", "stock"}, ...]}
+#     {"type": "resync"}    the client fell too far behind; subscribe again without a sequence
+#
+# Pushing never blocks the broadcaster: a push target that cannot keep up is
+# sent a resync and dropped.
+
+RESYNC = json.dumps({'type': 'resync'}).encode('utf-8')
+
+
+class Subscription:
+    __slots__ = ('pusher', 'request_id', 'last_seq')
+
+    def __init__(self, pusher, request_id, last_seq):
+        self.pusher = pusher  # push(frame) -> False if it cannot take more; force(frame) always queues
+        self.request_id = request_id
+        self.last_seq = last_seq
+
+
+class ChangeFeed:
+    def __init__(self, products, capacity=100000, interval=0.05, poll=None):
+        # products: the inventory's product ID -> Product dict, read when deltas are built
+        # capacity: changes kept for resuming subscribers
+        # interval: seconds between pushes (changes within one interval are coalesced)
+        # poll: optional callable run before every push, e.g. to pull changes from other shards
+        self.products = products
+        self.interval = interval
+        self.poll = poll
+        self.epoch = os.urandom(8).hex()  # Names this feed's sequence numbers, which restart with it
+        self.seq = 0
+        self._pushed_seq = 0  # Sequence every subscriber had been sent at the last push
+        self._log = deque(maxlen=capacity)  # (seq, product ID), oldest first
+        self._subscriptions = set()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def record(self, product_ids):
+        # Log a change of every product in product_ids.
+        with self._condition:
+            for product_id in product_ids:
+                self.seq += 1
+                self._log.append((self.seq, product_id))
+            if self._subscriptions:
+                self._condition.notify()
+
+    def subscribe(self, pusher, request_id, since=None, epoch=None):
+        # Start pushing changes to pusher. The first message brings the subscriber up to
+        # date: a delta from `since` when it was sent by this feed (epoch) and the log
+        # still covers it, otherwise a snapshot.
+        with self._condition:
+            if since is not None and epoch == self.epoch and since <= self.seq and self._covers(since):
+                payload = self._delta(since, self.seq)
+            else:
+                payload = self._snapshot()
+            pusher.force(encode_frame(request_id, payload))
+            subscription = Subscription(pusher, request_id, self.seq)
+            self._subscriptions.add(subscription)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="change-feed", daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._condition:
+            self._subscriptions.discard(subscription)
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def _covers(self, since):
+        # True if every change after since is still in the log. Caller holds the lock.
+        if since == self.seq:
+            return True
+        return bool(self._log) and self._log[0][0] <= since + 1
+
+    def _changed_ids(self, since):
+        # Product IDs changed after since, each once. Caller holds the lock.
+        changed = {}
+        for seq, product_id in reversed(self._log):
+            if seq <= since:
+                break
+            changed[product_id] = None
+        return changed
+
+    def _delta(self, since, seq):
+        changes = []
+        for product_id in self._changed_ids(since):
+            product = self.products.get(product_id)
+            if product is not None:
+                changes.append({'id': product_id, 'price': product.price, 'stock': product.stock})
+        return json.dumps({'type': 'delta', 'epoch': self.epoch, 'from': since, 'seq': seq,
+                           'changes': changes}).encode('utf-8')
+
+    def _snapshot(self):
+        products = [product.to_dict() for product in self.products.values()]
+        return json.dumps({'type': 'snapshot', 'epoch': self.epoch, 'seq': self.seq,
+                           'products': products}).encode('utf-8')
+
+    def _run(self):
+        while True:
+            with self._condition:
+                # With a poll function, wake regularly: changes may be waiting elsewhere
+                self._condition.wait_for(lambda: self._subscriptions and self.seq > self._pushed_seq,
+                                         timeout=self.interval if self.poll else None)
+                if not self._subscriptions:
+                    continue
+            time.sleep(self.interval)  # Let changes accumulate into one push
+            if self.poll:
+                try:
+                    self.poll()
+                except Exception as e:
+                    log.warning("Change feed poll failed: %s", e)
+            self._push()
+
+    def _push(self):
+        with self._condition:
+            seq = self.seq
+            behind = {}
+            for subscription in self._subscriptions:
+                if subscription.last_seq < seq:
+                    behind.setdefault(subscription.last_seq, []).append(subscription)
+            for since, subscriptions in behind.items():
+                payload = self._delta(since, seq) if self._covers(since) else self._snapshot()  # Once per group
+                for subscription in subscriptions:
+                    if subscription.pusher.push(encode_frame(subscription.request_id, payload)):
+                        subscription.last_seq = seq
+                    else:
+                        subscription.pusher.force(encode_frame(subscription.request_id, RESYNC))
+                        self._subscriptions.discard(subscription)
+            self._pushed_seq = seq
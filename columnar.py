@@ -0,0 +1,98 @@
+import struct
+from itertools import accumulate
+
+# Compact columnar encoding for product lists (VIEW_PRODUCTS) and carts (VIEW_CART).
+#
+# JSON repeats "id", "name", "price" and "stock" for every product and spells
+# every number out in decimal. This format stores each field as one packed
+# little-endian column and every distinct name once in a string table:
+#
+#     header      magic b'VMC1', kind (1 byte), 3 pad bytes, version (i64), row count n (u32)
+#     ids         n x u32
+#     prices      n x f64
+#     counts      n x i32     stock for PRODUCTS, quantity for CART
+#     name refs   n x u32     index into the string table
+#     strings     count m (u32), m x u32 byte lengths, then the UTF-8 bytes back to back
+#
+# Clients opt in with the ENCODING command; everyone else keeps getting JSON.
+
+MAGIC = b'VMC1'
+PRODUCTS = 0
+CART = 1
+COUNT_FIELDS = {PRODUCTS: 'stock', CART: 'quantity'}
+HEADER = struct.Struct('<4sB3xqI')
+U32 = struct.Struct('<I')
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def encode(rows, version=0, kind=PRODUCTS):
+    # rows: iterable of (id, name, price, count). Returns the encoded bytes.
+    ids = []
+    prices = []
+    counts = []
+    refs = []
+    table = {}  # name -> index in the string table
+    for product_id, name, price, count in rows:
+        ids.append(product_id)
+        prices.append(price)
+        counts.append(count)
+        ref = table.get(name)
+        if ref is None:
+            ref = table[name] = len(table)
+        refs.append(ref)
+    names = [name.encode('utf-8') for name in table]  # dicts keep insertion order, i.e. index order
+    n = len(ids)
+    return b''.join((
+        HEADER.pack(MAGIC, kind, version, n),
+        struct.pack(f'<{n}I', *ids),
+        struct.pack(f'<{n}d', *prices),
+        struct.pack(f'<{n}i', *counts),
+        struct.pack(f'<{n}I', *refs),
+        U32.pack(len(names)),
+        struct.pack(f'<{len(names)}I', *map(len, names)),
+        b''.join(names),
+    ))
+
+
+def decode_columns(payload):
+    # Returns (kind, version, columns) where columns maps 'id', 'name', 'price' and
+    # 'stock' or 'quantity' to lists. The cheapest way to read a large catalog.
+    try:
+        magic, kind, version, n = HEADER.unpack_from(payload, 0)
+        if magic != MAGIC or kind not in COUNT_FIELDS:
+            raise DecodeError("Not a columnar payload")
+        offset = HEADER.size
+        ids = struct.unpack_from(f'<{n}I', payload, offset)
+        offset += 4 * n
+        prices = struct.unpack_from(f'<{n}d', payload, offset)
+        offset += 8 * n
+        counts = struct.unpack_from(f'<{n}i', payload, offset)
+        offset += 4 * n
+        refs = struct.unpack_from(f'<{n}I', payload, offset)
+        offset += 4 * n
+        m, = U32.unpack_from(payload, offset)
+        offset += 4
+        lengths = struct.unpack_from(f'<{m}I', payload, offset)
+        offset += 4 * m
+    except struct.error as e:
+        raise DecodeError(f"Truncated columnar payload: {e}")
+    offsets = list(accumulate(lengths, initial=offset))
+    if offsets[-1] > len(payload):
+        raise DecodeError("Truncated string table")
+    names = [payload[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(m)]
+    try:
+        name_column = [names[ref] for ref in refs]
+    except IndexError:
+        raise DecodeError("Name reference outside the string table")
+    return kind, version, {'id': list(ids), 'name': name_column, 'price': list(prices),
+                           COUNT_FIELDS[kind]: list(counts)}
+
+
+def decode(payload):
+    # Returns (version, rows) with rows as dicts, the same shape the JSON replies have.
+    kind, version, columns = decode_columns(payload)
+    keys = list(columns)
+    return version, [dict(zip(keys, row)) for row in zip(*columns.values())]
@@ -0,0 +1,91 @@
+import threading
+from collections import deque
+
+# Single-writer purchase lane for a hot product (flash sale).
+#
+# When thousands of checkouts fight over one Product, every one of them queues on
+# the product's lock and the order in which they get it is up to the scheduler. A
+# FlashSale takes the product's stock away from that free-for-all: attempts are
+# appended to a queue and a single writer grants them in arrival order, a whole
+# batch (everything queued since its last pass) under one acquisition of the
+# product lock. The writer is whichever requesting thread finds the lane idle; it
+# keeps draining until the queue is empty, so no thread hand-off is needed while
+# the lane is quiet and a crowd is served in batches while it is busy.
+#
+# Once the stock is gone, sold_out is set and every later attempt is turned away by
+# Inventory before it queues or takes any lock. Stock coming back (a released hold,
+# a failed multi-product checkout) clears sold_out again.
+
+
+class Attempt:
+    __slots__ = ('quantity', 'granted', 'done')
+
+    def __init__(self, quantity):
+        self.quantity = quantity
+        self.granted = False
+        self.done = threading.Event()
+
+
+class FlashSale:
+    def __init__(self, product):
+        self.product = product
+        self.sold_out = product.stock <= 0  # Read without locks; only written under product.lock
+        # Metrics, see stats()
+        self.granted = 0
+        self.rejected = 0  # Reached the writer, but the stock ran out first
+        self.turned_away = 0  # Refused while sold out (counted without a lock, so approximate)
+        self.batches = 0
+        self.largest_batch = 0
+        self._queue = deque()  # Attempts waiting for the writer, oldest first
+        self._writer = threading.Lock()  # Held by whichever thread is granting attempts
+
+    def take(self, quantity):
+        # Queue an attempt to buy quantity and return once it is decided: True if granted.
+        attempt = Attempt(quantity)
+        self._queue.append(attempt)
+        while True:
+            if not self._writer.acquire(blocking=False):
+                attempt.done.wait()  # The current writer decides it, or hands over to us
+                return attempt.granted
+            try:
+                self._drain()
+            finally:
+                self._writer.release()
+            # An attempt queued just as we finished found the writer busy and is waiting
+            if not self._queue:
+                return attempt.granted
+
+    def _drain(self):
+        # Grant queued attempts in arrival order until the queue is empty. Caller is the writer.
+        product = self.product
+        while self._queue:
+            batch = []
+            while self._queue:
+                batch.append(self._queue.popleft())
+            granted = 0
+            with product.lock:
+                for attempt in batch:
+                    if product.stock >= attempt.quantity:
+                        product.stock -= attempt.quantity
+                        attempt.granted = True
+                        granted += 1
+                if product.stock <= 0:
+                    self.sold_out = True
+            self.granted += granted
+            self.rejected += len(batch) - granted
+            self.batches += 1
+            self.largest_batch = max(self.largest_batch, len(batch))
+            for attempt in batch:
+                attempt.done.set()
+
+    def stats(self):
+        return {
+            'stock': self.product.stock,
+            'sold_out': self.sold_out,
+            'granted': self.granted,
+            'rejected': self.rejected,
+            'turned_away': self.turned_away,
+            'batches': self.batches,
+            'mean_batch': round((self.granted + self.rejected) / self.batches, 1) if self.batches else None,
+            'largest_batch': self.largest_batch,
+        }
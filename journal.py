@@ -0,0 +1,180 @@
+import argparse
+import json
+import mmap
+import os
+import queue
+import threading
+import time
+
+from metrics import log
+
+# Append-only transaction journal.
+#
+# append() only puts the record on a queue; a background thread takes everything
+# queued, writes it as one block of JSON lines and (depending on the fsync policy)
+# syncs it, so callers never wait on the disk:
+#
+#   never   leave syncing to the OS (fastest; a crash can lose the last seconds)
+#   batch   fsync after every block written (default; loses at most the block in flight)
+#   always  append() blocks until its own record has been fsynced
+#
+# When the file would grow past max_bytes it is rotated: journal.jsonl becomes
+# journal.jsonl.1, .1 becomes .2 and so on, keeping `backups` old files.
+#
+# read_journal() replays every file oldest first. It maps each file into memory
+# and only decodes lines that contain the optional `contains` bytes, so scanning
+# a multi-gigabyte journal for e.g. checkouts skips most of the JSON parsing.
+
+FSYNC_POLICIES = ('never', 'batch', 'always')
+
+
+class Journal:
+    def __init__(self, path='transaction.jsonl', fsync='batch', max_bytes=64 * 1024 * 1024, backups=5,
+                 max_batch=1000):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {', '.join(FSYNC_POLICIES)}")
+        self.path = path
+        self.fsync = fsync
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.max_batch = max_batch
+        self.written = 0
+        self._queue = queue.Queue()
+        self._closed = False
+        self._close_lock = threading.Lock()  # So no record is queued behind the stop marker
+        self._file = open(path, 'ab')
+        self._size = self._file.tell()
+        self._thread = threading.Thread(target=self._run, name="journal-writer", daemon=True)
+        self._thread.start()
+
+    def append(self, op, **fields):
+        # Queue a record {"ts": ..., "op": op, **fields}. Returns at once unless fsync='always'.
+        # Raises ValueError once the journal is closed, like a closed file.
+        record = {'ts': time.time(), 'op': op}
+        record.update(fields)
+        done = threading.Event() if self.fsync == 'always' else None
+        with self._close_lock:
+            if self._closed:
+                raise ValueError("Journal is closed")
+            self._queue.put((record, done))
+        if done:
+            done.wait()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                self._write(batch)
+            except Exception as e:
+                log.error("Journal write failed, %d record(s) lost: %s", len(batch), e)
+                for _, done in batch:
+                    if done:
+                        done.set()  # Do not leave fsync='always' callers waiting forever
+            if stop:
+                return
+
+    def _write(self, batch):
+        data = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record, _ in batch).encode('utf-8')
+        if self._size and self._size + len(data) > self.max_bytes:
+            self._rotate()
+        self._file.write(data)
+        self._file.flush()
+        if self.fsync != 'never':
+            os.fsync(self._file.fileno())
+        self._size += len(data)
+        self.written += len(batch)
+        for _, done in batch:
+            if done:
+                done.set()
+
+    def _rotate(self):
+        self._file.close()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{index}'):
+                os.replace(f'{self.path}.{index}', f'{self.path}.{index + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        self._file = open(self.path, 'wb')  # Truncates when no backups are kept
+        self._size = 0
+
+    def close(self):
+        # Write everything still queued, then close the file.
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+
+def journal_files(path):
+    # The journal's files, oldest first.
+    files = []
+    index = 1
+    while os.path.exists(f'{path}.{index}'):
+        files.append(f'{path}.{index}')
+        index += 1
+    files.reverse()
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def read_journal(path, contains=None):
+    # Yield every record of the journal in write order. With contains (bytes), lines
+    # without it are skipped before they are decoded. A torn last line is ignored.
+    for name in journal_files(path):
+        with open(name, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                continue  # mmap refuses empty files
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                start = 0
+                end = len(data)
+                while start < end:
+                    newline = data.find(b'\n', start)
+                    if newline == -1:
+                        break  # Unterminated final line: the write was cut short
+                    if contains is None or data.find(contains, start, newline) != -1:
+                        yield json.loads(data[start:newline])
+                    start = newline + 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarise a transaction journal")
+    parser.add_argument('path', nargs='?', default='transaction.jsonl')
+    parser.add_argument('--op', default=None, help="only count records of this operation")
+    parser.add_argument('--print', action='store_true', help="print the matching records")
+    args = parser.parse_args()
+
+    contains = f'"op":"{args.op}"'.encode('utf-8') if args.op else None
+    size = sum(os.path.getsize(name) for name in journal_files(args.path))
+    started = time.perf_counter()
+    counts = {}
+    for record in read_journal(args.path, contains):
+        if args.op and record.get('op') != args.op:
+            continue
+        counts[record.get('op')] = counts.get(record.get('op'), 0) + 1
+        if args.print:
+            print(json.dumps(record))
+    elapsed = time.perf_counter() - started
+    for op, count in sorted(counts.items(), key=lambda item: str(item[0])):
+        print(f"{op:<15} {count:>10}")
+    print(f"Scanned {size / 2 ** 20:.1f} MiB in {elapsed:.2f}s "
+          f"({size / 2 ** 20 / elapsed if elapsed else 0:.0f} MiB/s)")
+
+if __name__ == "__main__":
+    main()
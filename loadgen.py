@@ -0,0 +1,548 @@
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import columnar
+from protocol import MAGIC, encode_frame, read_frame
+
+# Load generator for the vending servers.
+#
+# Simulates many concurrent shoppers, each on its own connection, all driven by
+# asyncio so thousands of them fit in a few processes. A shopper repeatedly picks
+# VIEW_PRODUCTS, ADD_TO_CART or CHECKOUT according to the configured mix until
+# the run ends, then disconnects (which gives back any stock its cart still holds).
+#
+# Products are picked uniformly by default. --skew makes popularity Zipf-like (the
+# product at rank r is picked in proportion to 1 / r**skew), and --hot sends
+# --hot-share of all ADD_TO_CART requests to a few hot products, e.g. the ones a
+# server runs through its flash sale lane. Adds of hot products are reported
+# separately, so the lane's end-to-end latency and its sold-out refusals show up.
+#
+# Two wire protocols are spoken:
+#   vending  Server_Code (any --engine): framed commands, see protocol.py
+#   sqlite   Import_sqlite3: JSON actions; the cart is kept by the shopper and sent at checkout
+#
+# After the run the catalog is fetched again and every product is checked:
+# stock must not be negative, and stock that left the shelf must equal what the
+# shoppers were told they bought. Anything else is reported as a violation.
+#
+# Run with e.g.:
+#   python loadgen.py --spawn threaded --shoppers 2000 --duration 20 --output threaded.json
+#   python loadgen.py --spawn async --shoppers 2000 --duration 20 --baseline threaded.json
+#   python loadgen.py --spawn threaded --hot 5 --server-args "--flash-sale 5" --baseline no-lane.json
+
+OPERATIONS = ('view', 'add', 'checkout')
+PERCENTILES = (('p50', 0.50), ('p99', 0.99), ('p999', 0.999))
+
+
+class Busy(Exception):
+    # The server shed the request (a BUSY reply) instead of running it.
+    pass
+
+
+def parse_mix(text):
+    # 'view=60,add=30,checkout=10' -> {'view': 60.0, 'add': 30.0, 'checkout': 10.0}
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r} (expected one of {', '.join(OPERATIONS)})")
+        try:
+            mix[name] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid weight for {name}: {weight!r}")
+    if sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError("the mix needs at least one positive weight")
+    return mix
+
+
+def product_weights(product_ids, skew=0.0, hot=(), hot_share=0.5):
+    # Cumulative weights for rng.choices(product_ids, cum_weights=...): hot products
+    # share hot_share of the picks evenly, the rest follow a Zipf law with exponent
+    # skew in catalog order (0: uniform).
+    hot = set(hot)
+    cold = [product_id for product_id in product_ids if product_id not in hot]
+    cold_weights = {product_id: 1.0 / rank ** skew for rank, product_id in enumerate(cold, 1)}
+    cold_total = sum(cold_weights.values())
+    if not hot:
+        hot_share = 0.0
+    elif not cold:
+        hot_share = 1.0
+    weights = [hot_share / len(hot) if product_id in hot else (1 - hot_share) * cold_weights[product_id] / cold_total
+               for product_id in product_ids]
+    return list(itertools.accumulate(weights))
+
+
+def percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return None
+    index = min(len(sorted_samples) - 1, int(fraction * len(sorted_samples)))
+    return sorted_samples[index]
+
+
+class VendingConnection:
+    # One shopper's framed connection to Server_Code.
+    server_cart = True  # ADD_TO_CART is a request to the server
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.next_request_id = 1
+        self.compact = False
+
+    @classmethod
+    async def open(cls, host, port, encoding='json'):
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(MAGIC)
+        connection = cls(reader, writer)
+        if encoding != 'json':
+            if await connection.request(f'ENCODING {encoding}') != f'ENCODING {encoding}'.encode('utf-8'):
+                raise ValueError(f"Server does not support the {encoding} encoding")
+            connection.compact = True
+        return connection
+
+    async def request(self, command):
+        # Send one command and return the raw reply.
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        self.writer.write(encode_frame(request_id, command))
+        frame = await read_frame(self.reader)
+        if frame is None:
+            raise ConnectionError("Server closed the connection")
+        if frame[1].startswith(b'BUSY'):
+            raise Busy(frame[1].decode('utf-8'))
+        return frame[1]
+
+    async def view(self):
+        response = await self.request('VIEW_PRODUCTS')
+        if self.compact:
+            return columnar.decode(response)[1]
+        return json.loads(response)
+
+    async def add(self, product_id, quantity):
+        # Returns True if the server accepted the line.
+        response = await self.request(f'ADD_TO_CART {product_id} {quantity}')
+        return response.startswith(b'Added')
+
+    async def checkout(self, cart):
+        return json.loads(await self.request('CHECKOUT'))['success']
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+class SqliteConnection:
+    # One shopper's connection to Import_sqlite3. That server answers one JSON
+    # message per recv(), so replies are read until they parse.
+    server_cart = False  # Adding to the cart never leaves the shopper
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, host, port, encoding='json'):
+        if encoding != 'json':
+            raise ValueError("The SQLite server only speaks JSON")
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def request(self, message):
+        self.writer.write(json.dumps(message).encode('utf-8'))
+        data = b''
+        while True:
+            chunk = await self.reader.read(65536)
+            if not chunk:
+                raise ConnectionError("Server closed the connection")
+            data += chunk
+            try:
+                return json.loads(data)
+            except ValueError:
+                continue  # Reply not complete yet
+
+    async def view(self):
+        return await self.request({'action': 'get_product_list'})
+
+    async def checkout(self, cart):
+        lines = [{'id': product_id, 'quantity': quantity} for product_id, quantity in cart.items()]
+        response = await self.request({'action': 'checkout', 'cart': lines})
+        return response.get('success', False)
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+PROTOCOLS = {'vending': VendingConnection, 'sqlite': SqliteConnection}
+
+
+class Results:
+    # What one load process measured. Latencies are kept raw so processes can be merged.
+    def __init__(self):
+        self.latencies = {name: [] for name in OPERATIONS}
+        self.failures = {name: 0 for name in OPERATIONS}  # Answered, but refused (e.g. out of stock)
+        self.errors = 0  # Connection failures, timeouts, unreadable replies
+        self.busy = 0  # Requests the server shed with BUSY
+        self.sold = {}  # Product ID -> quantity the server confirmed as sold
+        self.hot_latencies = []  # Adds of --hot products (also counted under 'add')
+        self.hot_failures = 0
+
+    def merge(self, other):
+        for name in OPERATIONS:
+            self.latencies[name].extend(other.latencies[name])
+            self.failures[name] += other.failures[name]
+        self.hot_latencies.extend(other.hot_latencies)
+        self.hot_failures += other.hot_failures
+        self.errors += other.errors
+        self.busy += other.busy
+        for product_id, quantity in other.sold.items():
+            self.sold[product_id] = self.sold.get(product_id, 0) + quantity
+
+
+async def shopper(config, product_ids, cum_weights, rng, deadline, results):
+    # One simulated customer: connect, shop until the deadline, disconnect.
+    # cum_weights: product popularity, see product_weights.
+    connection_class = PROTOCOLS[config['protocol']]
+    names = list(config['mix'])
+    weights = [config['mix'][name] for name in names]
+    hot = set(config['hot'])
+    try:
+        connection = await asyncio.wait_for(
+            connection_class.open(config['host'], config['port'], config['encoding']), config['timeout'])
+    except (OSError, ValueError, Busy, asyncio.TimeoutError):
+        results.errors += 1
+        return
+    cart = {}
+    try:
+        while time.monotonic() < deadline:
+            operation = rng.choices(names, weights)[0]
+            if operation == 'checkout' and not cart:
+                operation = 'add'  # Nothing to buy yet
+            started = time.perf_counter()
+            try:
+                if operation == 'view':
+                    await asyncio.wait_for(connection.view(), config['timeout'])
+                    ok = True
+                elif operation == 'add':
+                    product_id = rng.choices(product_ids, cum_weights=cum_weights)[0]
+                    quantity = rng.randint(1, config['max_quantity'])
+                    if not connection.server_cart:
+                        cart[product_id] = cart.get(product_id, 0) + quantity
+                        continue  # Nothing was sent, so there is no latency to record
+                    ok = await asyncio.wait_for(connection.add(product_id, quantity), config['timeout'])
+                    if ok:
+                        cart[product_id] = cart.get(product_id, 0) + quantity
+                else:
+                    ok = await asyncio.wait_for(connection.checkout(cart), config['timeout'])
+            except Busy:
+                results.busy += 1  # Shed, not run: no latency sample, and the cart is unchanged
+                await asyncio.sleep(rng.uniform(0.01, 0.05))  # Back off before trying again
+                continue
+            if operation == 'checkout':
+                if ok:
+                    for product_id, quantity in cart.items():
+                        results.sold[product_id] = results.sold.get(product_id, 0) + quantity
+                    cart = {}
+                elif config['protocol'] == 'sqlite':
+                    cart = {}  # Nothing was reserved; start over rather than retry the same cart
+            latency = time.perf_counter() - started
+            results.latencies[operation].append(latency)
+            if not ok:
+                results.failures[operation] += 1
+            if operation == 'add' and product_id in hot:
+                results.hot_latencies.append(latency)
+                results.hot_failures += not ok
+            if config['think']:
+                await asyncio.sleep(rng.expovariate(1.0 / config['think']))
+    except (OSError, ValueError, KeyError, asyncio.TimeoutError):
+        results.errors += 1
+    finally:
+        await connection.close()
+
+
+async def run_shoppers(config, first_shopper, shoppers, product_ids, start_at):
+    results = Results()
+    deadline = start_at + config['ramp'] + config['duration']
+    cum_weights = product_weights(product_ids, config['skew'], config['hot'], config['hot_share'])
+    tasks = []
+    for i in range(shoppers):
+        shopper_id = first_shopper + i
+        # Spread connection attempts over the ramp so the accept queue is not flooded at once
+        delay = start_at + config['ramp'] * shopper_id / max(1, config['shoppers']) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        rng = random.Random(config['seed'] + shopper_id)
+        tasks.append(asyncio.ensure_future(shopper(config, product_ids, cum_weights, rng, deadline, results)))
+    await asyncio.gather(*tasks)
+    return results
+
+
+def load_process(args):
+    # Entry point of one load process: run a slice of the shoppers on its own event loop.
+    config, first_shopper, shoppers, product_ids, start_at = args
+    return asyncio.run(run_shoppers(config, first_shopper, shoppers, product_ids, start_at))
+
+
+async def fetch_stock(config):
+    # Current stock of every product as {product ID: stock}.
+    connection = await PROTOCOLS[config['protocol']].open(config['host'], config['port'], config['encoding'])
+    try:
+        products = await connection.view()
+    finally:
+        await connection.close()
+    return {product['id']: product['stock'] for product in products}
+
+
+def check_consistency(initial, final, sold):
+    # Compare the stock that left the shelves with the sales the server confirmed.
+    violations = []
+    for product_id, stock in sorted(final.items()):
+        moved = initial.get(product_id, stock) - stock
+        confirmed = sold.get(product_id, 0)
+        if stock < 0:
+            violations.append(f"Product {product_id}: negative stock {stock}")
+        if moved != confirmed:
+            violations.append(f"Product {product_id}: stock moved by {moved} but {confirmed} were sold")
+    return violations
+
+
+def run_load(config):
+    # Run the configured load and return a report dict (see print_report).
+    initial = asyncio.run(fetch_stock(config))
+    product_ids = sorted(initial)
+    unknown = set(config['hot']) - set(initial)
+    if unknown:
+        raise ValueError(f"--hot products not in the catalog: {', '.join(map(str, sorted(unknown)))}")
+    processes = max(1, min(config['processes'], config['shoppers']))
+    share, extra = divmod(config['shoppers'], processes)
+    slices = []
+    first = 0
+    start_at = time.monotonic() + 0.5  # Give every process time to start before the clock runs
+    for index in range(processes):
+        count = share + (1 if index < extra else 0)
+        slices.append((config, first, count, product_ids, start_at))
+        first += count
+
+    started = time.perf_counter()
+    if processes == 1:
+        parts = [load_process(slices[0])]
+    else:
+        with multiprocessing.get_context('fork').Pool(processes) as pool:
+            parts = pool.map(load_process, slices)
+    elapsed = time.perf_counter() - started - 0.5
+
+    results = Results()
+    for part in parts:
+        results.merge(part)
+    time.sleep(config['settle'])  # Let the server finish releasing the carts of closed connections
+    final = asyncio.run(fetch_stock(config))
+
+    operations = {}
+    for name in OPERATIONS:
+        samples = sorted(results.latencies[name])
+        report = {'count': len(samples), 'failed': results.failures[name],
+                  'per_sec': len(samples) / elapsed if elapsed > 0 else 0.0}
+        for label, fraction in PERCENTILES:
+            value = percentile(samples, fraction)
+            report[label + '_ms'] = value * 1000 if value is not None else None
+        operations[name] = report
+    if config['hot']:
+        samples = sorted(results.hot_latencies)
+        hot = {'products': list(config['hot']), 'count': len(samples), 'failed': results.hot_failures,
+               'per_sec': len(samples) / elapsed if elapsed > 0 else 0.0,
+               'units_sold': sum(results.sold.get(product_id, 0) for product_id in config['hot'])}
+        for label, fraction in PERCENTILES:
+            value = percentile(samples, fraction)
+            hot[label + '_ms'] = value * 1000 if value is not None else None
+        operations['add_hot'] = hot
+    total = sum(report['count'] for name, report in operations.items() if name in OPERATIONS)
+    return {
+        'config': dict(config),
+        'seconds': elapsed,
+        'requests': total,
+        'requests_per_sec': total / elapsed if elapsed > 0 else 0.0,
+        'errors': results.errors,
+        'busy': results.busy,
+        'operations': operations,
+        'units_sold': sum(results.sold.values()),
+        'violations': check_consistency(initial, final, results.sold),
+    }
+
+
+def format_ms(value):
+    return f"{value:>9.2f}" if value is not None else f"{'-':>9}"
+
+
+def print_report(report, baseline=None):
+    config = report['config']
+    print(f"{config['label']}: {config['shoppers']} shoppers, {report['seconds']:.1f}s, "
+          f"{report['requests_per_sec']:.0f} requests/sec, {report['errors']} errors, "
+          f"{report.get('busy', 0)} shed (BUSY), "
+          f"{report['units_sold']} units sold")
+    print(f"{'operation':<10} | {'count':>8} | {'failed':>7} | {'per sec':>9} | "
+          f"{'p50 ms':>9} | {'p99 ms':>9} | {'p999 ms':>9}")
+    for name, stats in report['operations'].items():
+        print(f"{name:<10} | {stats['count']:>8} | {stats['failed']:>7} | {stats['per_sec']:>9.0f} | "
+              f"{format_ms(stats['p50_ms'])} | {format_ms(stats['p99_ms'])} | {format_ms(stats['p999_ms'])}")
+    if 'add_hot' in report['operations']:
+        hot = report['operations']['add_hot']
+        print(f"add_hot: adds of products {', '.join(map(str, hot['products']))} (included in add), "
+              f"{hot['units_sold']} units of them sold")
+    if report['violations']:
+        print(f"CONSISTENCY: {len(report['violations'])} violation(s)")
+        for violation in report['violations']:
+            print(f"    {violation}")
+    else:
+        print("CONSISTENCY: OK")
+
+    if baseline:
+        print(f"\nCompared with {baseline['config']['label']}:")
+        print(f"{'operation':<10} | {'per sec':>9} | {'p50':>9} | {'p99':>9} | {'p999':>9}")
+        for name, stats in report['operations'].items():
+            before = baseline['operations'].get(name)
+            if not before:
+                continue
+            cells = [ratio(stats['per_sec'], before['per_sec'])]
+            cells += [ratio(stats[label + '_ms'], before[label + '_ms']) for label, _ in PERCENTILES]
+            print(f"{name:<10} | " + " | ".join(cells))
+
+
+def ratio(value, before):
+    # Relative change as a fixed-width cell, e.g. '  +12.5%'.
+    if value is None or not before:
+        return f"{'-':>9}"
+    return f"{100 * (value / before - 1):>+8.1f}%"
+
+
+def wait_for_port(host, port, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1.0).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def spawn_server(engine, host, port, directory, hold_seconds, workers, extra_args=()):
+    # Start a server in a subprocess for the run. engine is a Server_Code engine or 'sqlite'.
+    # extra_args are appended to the server's command line.
+    here = os.path.dirname(os.path.abspath(__file__))
+    if engine == 'sqlite':
+        from benchmark import create_benchmark_db
+        db_path = os.path.join(directory, 'loadgen.db')
+        create_benchmark_db(db_path, products=100, stock=10 ** 6)
+        command = [sys.executable, os.path.join(here, 'Import_sqlite3.py'),
+                   '--host', host, '--port', str(port), '--db', db_path]
+    else:
+        command = [sys.executable, os.path.join(here, 'Server_Code.py'), '--engine', engine,
+                   '--host', host, '--port', str(port), '--hold-seconds', str(hold_seconds)]
+        if workers:
+            command += ['--workers', str(workers)]
+    command += list(extra_args)
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if not wait_for_port(host, port):
+        stop_server(server)
+        raise RuntimeError(f"{engine} server did not start: {' '.join(command)}")
+    return server
+
+
+def stop_server(server):
+    # SIGINT, so the sharded supervisor stops its workers on the way out.
+    server.send_signal(signal.SIGINT)
+    try:
+        server.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the vending servers")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--protocol', choices=sorted(PROTOCOLS), default=None,
+                        help="wire protocol of the target (default: sqlite for --spawn sqlite, else vending)")
+    parser.add_argument('--spawn', choices=['threaded', 'async', 'sharded', 'sqlite'], default=None,
+                        help="start this server for the run instead of using one already listening")
+    parser.add_argument('--workers', type=int, default=None, help="workers for --spawn sharded")
+    parser.add_argument('--hold-seconds', type=float, default=600.0, help="stock hold time for spawned servers")
+    parser.add_argument('--server-args', default='',
+                        help="extra options for the spawned server, e.g. \"--pool-workers 8 --max-queue 256\"")
+    parser.add_argument('--shoppers', type=int, default=1000, help="concurrent simulated shoppers")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of full load after the ramp")
+    parser.add_argument('--ramp', type=float, default=2.0, help="seconds over which shoppers connect")
+    parser.add_argument('--encoding', choices=['json', 'columnar'], default='json',
+                        help="reply encoding for VIEW_PRODUCTS (vending protocol only)")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('view=60,add=30,checkout=10'),
+                        help="operation weights, e.g. view=60,add=30,checkout=10")
+    parser.add_argument('--think', type=float, default=0.0, help="mean think time between operations (seconds)")
+    parser.add_argument('--max-quantity', type=int, default=2, help="largest quantity per ADD_TO_CART")
+    parser.add_argument('--skew', type=float, default=0.0,
+                        help="Zipf exponent of product popularity, e.g. 1.2 (0: every product equally likely)")
+    parser.add_argument('--hot', type=int, nargs='+', default=[], metavar='PRODUCT_ID',
+                        help="hot products, e.g. the ones on --flash-sale; their adds are reported as add_hot")
+    parser.add_argument('--hot-share', type=float, default=0.5,
+                        help="fraction of ADD_TO_CART requests that go to the --hot products")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help="load generator processes")
+    parser.add_argument('--timeout', type=float, default=30.0, help="seconds before a request counts as an error")
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help="seconds to wait after the run before the consistency check")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--label', default=None, help="name of this run in reports (default: the target)")
+    parser.add_argument('--output', default=None, help="write the report as JSON to this file")
+    parser.add_argument('--baseline', default=None, help="JSON report of an earlier run to compare against")
+    args = parser.parse_args()
+
+    protocol = args.protocol or ('sqlite' if args.spawn == 'sqlite' else 'vending')
+    config = {
+        'label': args.label or args.spawn or f"{protocol}@{args.host}:{args.port}",
+        'protocol': protocol, 'encoding': args.encoding, 'host': args.host, 'port': args.port, 'shoppers': args.shoppers,
+        'duration': args.duration, 'ramp': args.ramp, 'mix': args.mix, 'think': args.think,
+        'max_quantity': args.max_quantity, 'processes': args.processes, 'timeout': args.timeout,
+        'settle': args.settle, 'seed': args.seed, 'skew': args.skew, 'hot': args.hot,
+        'hot_share': max(0.0, min(1.0, args.hot_share)),
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    with tempfile.TemporaryDirectory() as directory:
+        server = None
+        if args.spawn:
+            server = spawn_server(args.spawn, args.host, args.port, directory, args.hold_seconds, args.workers,
+                                  shlex.split(args.server_args))
+        try:
+            report = run_load(config)
+        finally:
+            if server:
+                stop_server(server)
+
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import bisect
+import logging
+import random
+import threading
+import time
+
+# Low-overhead server instrumentation.
+#
+# Latencies go into fixed log-scale histograms (about 10% wide buckets from 1µs
+# to ~100s), so recording is one bisect and a counter increment and memory does
+# not grow with traffic. Timings are sampled: with sample_rate 0.01 only one
+# request in a hundred reads the clock, and with 0 (the default) timing is off
+# and start() is a single comparison. Counters such as requests in flight are
+# always exact: every thread counts its own requests without a lock and
+# snapshot() adds the threads up.
+#
+# Usage on a hot path:
+#     started = METRICS.start()
+#     ...
+#     METRICS.observe('command.CHECKOUT', started)
+#
+# METRICS.snapshot() returns everything as a JSON-ready dict (see the STATS command).
+
+log = logging.getLogger('vending')
+
+BUCKET_BOUNDS = [1e-6 * 1.1 ** i for i in range(194)]  # Upper bounds in seconds, 1µs .. ~105s
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)  # Last bucket catches everything slower
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        index = bisect.bisect_left(BUCKET_BOUNDS, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the given fraction of samples (within ~10%).
+        with self.lock:
+            if not self.count:
+                return None
+            rank = fraction * self.count
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank and count:
+                    return min(BUCKET_BOUNDS[index], self.max) if index < len(BUCKET_BOUNDS) else self.max
+            return self.max
+
+    def summary(self):
+        # Milliseconds, rounded for readability.
+        def ms(seconds):
+            return round(seconds * 1000, 3) if seconds is not None else None
+
+        return {
+            'count': self.count,
+            'mean_ms': ms(self.total / self.count) if self.count else None,
+            'p50_ms': ms(self.percentile(0.50)),
+            'p90_ms': ms(self.percentile(0.90)),
+            'p99_ms': ms(self.percentile(0.99)),
+            'p999_ms': ms(self.percentile(0.999)),
+            'max_ms': ms(self.max),
+        }
+
+
+class ThreadCounts:
+    # Requests started and finished on one thread. Only that thread writes them.
+    __slots__ = ('thread', 'started', 'finished')
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.started = 0
+        self.finished = 0
+
+
+class Metrics:
+    def __init__(self, sample_rate=0.0):
+        self.sample_rate = sample_rate
+        self.histograms = {}
+        self.counters = {}
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._random = random.random
+        self._local = threading.local()  # .counts: this thread's ThreadCounts
+        self._thread_counts = []  # ThreadCounts of every thread that has served a request
+        self._retired = (0, 0)  # (started, finished) of threads that have exited
+        self._compact_at = 64  # List length that triggers the next _compact
+
+    def configure(self, sample_rate):
+        # Fraction of operations to time, 0 (off) .. 1 (every one).
+        self.sample_rate = max(0.0, min(1.0, sample_rate))
+
+    def start(self):
+        # perf_counter() for a sampled operation, None for one that is not timed.
+        if self.sample_rate and (self.sample_rate >= 1.0 or self._random() < self.sample_rate):
+            return time.perf_counter()
+        return None
+
+    def observe(self, name, started):
+        # Record the time since started (from start()) under name. Unsampled calls do nothing.
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        histogram.record(elapsed)
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def _counts(self):
+        counts = getattr(self._local, 'counts', None)
+        if counts is None:  # First request on this thread
+            counts = self._local.counts = ThreadCounts(threading.current_thread())
+            with self._lock:
+                if len(self._thread_counts) >= self._compact_at:  # e.g. one thread per connection
+                    self._compact()
+                self._thread_counts.append(counts)
+        return counts
+
+    def _compact(self):
+        # Fold threads that have exited into one total, so the list stays about as long as
+        # the number of live threads. Caller holds the lock.
+        started, finished = self._retired
+        live = []
+        for counts in self._thread_counts:
+            if counts.thread.is_alive():
+                live.append(counts)
+            else:
+                started += counts.started
+                finished += counts.finished
+        self._retired = (started, finished)
+        self._thread_counts = live
+        self._compact_at = max(64, 2 * len(live))
+
+    def request_started(self):
+        self._counts().started += 1
+
+    def request_finished(self):
+        self._counts().finished += 1
+
+    def snapshot(self):
+        with self._lock:
+            histograms = dict(self.histograms)
+            counters = dict(self.counters)
+            self._compact()
+            started, finished = self._retired
+            for counts in self._thread_counts:
+                started += counts.started
+                finished += counts.finished
+        requests = started
+        in_flight = started - finished
+        return {
+            'uptime_seconds': round(time.time() - self.started_at, 1),
+            'sample_rate': self.sample_rate,
+            'requests': requests,
+            'in_flight': in_flight,
+            'counters': counters,
+            'latency': {name: histograms[name].summary() for name in sorted(histograms)},
+        }
+
+
+METRICS = Metrics()
+
+
+def configure_logging(level='WARNING'):
+    # Send the 'vending' logger to stderr at the given level (e.g. 'DEBUG' for per-request traces).
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    log.setLevel(level.upper())
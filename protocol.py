@@ -0,0 +1,101 @@
+import asyncio
+import struct
+
+# Wire protocol shared by the server and the clients.
+#
+# A framed client opens the connection by sending MAGIC once. After that every
+# message in either direction is a frame:
+#
+#     +----------------+----------------+-----------------+
+#     | length (4, BE) | request id (4) | payload (length) |
+#     +----------------+----------------+-----------------+
+#
+# The request payload is the command text (e.g. b'ADD_TO_CART 1 2') and the
+# response payload is exactly what the legacy protocol would have sent back.
+# Responses carry the id of the request they answer, so a client can write many
+# requests before reading any replies (pipelining). Connections that do not
+# start with MAGIC keep the old one-command-per-recv behaviour.
+
+MAGIC = b'VMP1'
+HEADER = struct.Struct('!II')
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # Refuse frames larger than 16 MB
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(request_id, payload):
+    # Build a frame for the given request id. payload may be str or bytes.
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    return HEADER.pack(len(payload), request_id) + payload
+
+
+def recv_exact(sock, size):
+    # Read exactly size bytes from a blocking socket.
+    # Returns None if the peer closes the connection first.
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = sock.recv(remaining)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_frame(sock):
+    # Read one frame from a blocking socket.
+    # Returns (request_id, payload) or None when the connection is closed.
+    header = recv_exact(sock, HEADER.size)
+    if header is None:
+        return None
+    length, request_id = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {length} bytes exceeds the limit")
+    payload = recv_exact(sock, length)
+    if payload is None:
+        return None
+    return request_id, payload
+
+
+async def read_frame(reader):
+    # asyncio version of recv_frame for an asyncio.StreamReader.
+    try:
+        header = await reader.readexactly(HEADER.size)
+        length, request_id = HEADER.unpack(header)
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError(f"Frame of {length} bytes exceeds the limit")
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+    return request_id, payload
+
+
+class FrameDecoder:
+    # Incremental decoder: feed it whatever recv() returned and collect every
+    # complete frame. Lets the server drain a whole pipelined burst from one read.
+    def __init__(self, data=b''):
+        self.buffer = bytearray(data)
+
+    def feed(self, data):
+        self.buffer += data
+
+    def frames(self):
+        # Return the list of (request_id, payload) frames that are complete.
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            length, request_id = HEADER.unpack_from(self.buffer, offset)
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError(f"Frame of {length} bytes exceeds the limit")
+            end = offset + HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            frames.append((request_id, bytes(self.buffer[offset + HEADER.size:end])))
+            offset = end
+        if offset:
+            del self.buffer[:offset]
+        return frames
@@ -0,0 +1,431 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+from collections import deque
+
+from loadgen import PERCENTILES, fetch_stock, format_ms, percentile, ratio, spawn_server, stop_server
+from protocol import MAGIC, encode_frame, read_frame
+from traffic import CLOSE, LEGACY, OPEN, REQUEST, SESSION, read_capture
+
+# Replays traffic captured with Server_Code.py --record against a server and
+# measures how it copes.
+#
+# Every captured connection is opened when it was opened originally and sends its
+# requests at their original times (divided by --speed), without waiting for
+# replies, so the server sees the same concurrency and the same request order on
+# each connection. Session tokens in RESUME are swapped for the ones this server
+# handed out. Legacy (unframed) connections are replayed over the framed protocol,
+# which runs the same commands. Like loadgen.py, the connections can be spread
+# over several processes; connections sharing a session stay in one process.
+#
+# The report has throughput, latency per command, and the final stock of every
+# product. Given a baseline report it prints the differences and exits with status 1
+# on a regression: throughput down by more than --tolerance percent, p99 latency up
+# by more than --latency-tolerance percent, more errors, or a different final inventory.
+#
+#   python Server_Code.py --record shop.vmr                                       # capture
+#   python replay.py shop.vmr --spawn threaded --output before.json               # baseline
+#   python replay.py shop.vmr --spawn threaded --speed 4 --baseline before.json   # after a change
+#
+# Start each run from the catalog the capture started from (a fresh server, or
+# --db with a copy of the same database); otherwise the final stock cannot match.
+#
+# Only the Server_Code.py engines (threaded, async, sharded) can be captured and
+# replayed. The Import_sqlite3.py server speaks its own JSON action protocol, one
+# unframed request at a time, and has no --record.
+
+MIN_SAMPLES = 50  # Commands with fewer replies are not checked for latency regressions
+
+
+class ConnectionPlan:
+    # What one captured connection did, with times relative to the start of the capture.
+    def __init__(self, opened_at):
+        self.opened_at = opened_at
+        self.closed_at = None
+        self.requests = []  # (time, request id, payload)
+        self.tokens = deque()  # Tokens its SESSION requests were given, in order
+
+
+def load_plans(paths):
+    # Merge captures (the sharded engine writes one per worker) into a list of
+    # ConnectionPlans. Returns (plans, catalog or None, seconds covered).
+    records = []
+    catalog = None
+    for index, path in enumerate(paths):
+        started_at, file_catalog, file_records = read_capture(path)
+        catalog = catalog or file_catalog
+        records += [(started_at + seconds, kind, (index, connection_id), request_id, payload)
+                    for kind, seconds, connection_id, request_id, payload in file_records]
+    records.sort(key=lambda record: record[0])
+    first = records[0][0] if records else 0.0
+    plans = {}
+    for at, kind, key, request_id, payload in records:
+        at -= first
+        plan = plans.get(key)
+        if plan is None:
+            plan = plans[key] = ConnectionPlan(at)  # Also covers connections opened before recording began
+        if kind in (REQUEST, LEGACY):
+            plan.requests.append((at, request_id, payload))
+        elif kind == SESSION:
+            plan.tokens.append(payload.decode('utf-8'))
+        elif kind == CLOSE:
+            plan.closed_at = at
+        elif kind != OPEN:
+            raise ValueError(f"Unknown record kind {kind}")
+    return list(plans.values()), catalog, (records[-1][0] - first if records else 0.0)
+
+
+def group_plans(plans, processes):
+    # Split plans into at most `processes` lists of similar request counts. Connections
+    # linked by a session token (SESSION on one, RESUME on another) share a list.
+    parent = list(range(len(plans)))
+
+    def root(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    owner = {}  # Token -> index of a plan that uses it
+    for index, plan in enumerate(plans):
+        tokens = list(plan.tokens) + [payload[7:].decode('utf-8') for _, _, payload in plan.requests
+                                      if payload.startswith(b'RESUME ')]
+        for token in tokens:
+            parent[root(index)] = root(owner.setdefault(token, index))
+    groups = {}
+    for index, plan in enumerate(plans):
+        groups.setdefault(root(index), []).append(plan)
+    shares = [[] for _ in range(max(1, processes))]
+    loads = [0] * len(shares)
+    for group in sorted(groups.values(), key=lambda group: -sum(len(plan.requests) for plan in group)):
+        lightest = loads.index(min(loads))
+        shares[lightest] += group
+        loads[lightest] += sum(len(plan.requests) for plan in group)
+    return [share for share in shares if share]
+
+
+def peak_concurrency(plans, end):
+    # Most connections the capture had open at once.
+    events = sorted([(plan.opened_at, 1) for plan in plans] +
+                    [(plan.closed_at if plan.closed_at is not None else end, -1) for plan in plans],
+                    key=lambda event: (event[0], event[1]))
+    peak = current = 0
+    for _, change in events:
+        current += change
+        peak = max(peak, current)
+    return peak
+
+
+class Results:
+    def __init__(self):
+        self.latencies = {}  # Command -> seconds from send to reply
+        self.errors = 0  # Connections that failed or replies that never came
+        self.busy = 0  # Requests the server shed with BUSY
+        self.max_lag = 0.0  # Furthest the replayer fell behind the schedule
+        self.last_reply = 0.0  # time.monotonic() of the last reply
+
+    def merge(self, other):
+        for command, latencies in other.latencies.items():
+            self.latencies.setdefault(command, []).extend(latencies)
+        self.errors += other.errors
+        self.busy += other.busy
+        self.max_lag = max(self.max_lag, other.max_lag)
+        self.last_reply = max(self.last_reply, other.last_reply)
+
+
+class Replay:
+    def __init__(self, config, plans, start):
+        # start: time.monotonic() at which the capture's first moment is replayed
+        self.config = config
+        self.plans = plans
+        self.results = Results()
+        self.issued = {token for plan in plans for token in plan.tokens}  # Tokens created during the capture
+        self.tokens = {}  # Captured token -> Future of the token this server gave instead
+        self.start = start
+
+    async def run(self):
+        # asyncio's clock is time.monotonic(), so every process keeps the same schedule
+        await asyncio.gather(*(self.connection(plan) for plan in self.plans))
+        return self.results
+
+    def due(self, at):
+        return self.start + at / self.config['speed']
+
+    async def wait_until(self, at):
+        loop = asyncio.get_running_loop()
+        delay = self.due(at) - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            self.results.max_lag = max(self.results.max_lag, -delay)
+
+    def token_future(self, token):
+        future = self.tokens.get(token)
+        if future is None:
+            future = self.tokens[token] = asyncio.get_running_loop().create_future()
+        return future
+
+    async def connection(self, plan):
+        # Replay one captured connection.
+        config = self.config
+        await self.wait_until(plan.opened_at)
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(config['host'], config['port']),
+                                                    config['timeout'])
+        except (OSError, asyncio.TimeoutError):
+            self.results.errors += 1
+            return
+        writer.write(MAGIC)
+        pending = {}  # Request id -> deque of [command, sent at, captured token for SESSION]
+        drained = asyncio.Event()
+        drained.set()
+        replies = asyncio.ensure_future(self.read_replies(reader, pending, drained))
+        tokens = deque(plan.tokens)
+        try:
+            for at, request_id, payload in plan.requests:
+                await self.wait_until(at)
+                if payload.startswith(b'RESUME ') and payload[7:].decode('utf-8') in self.issued:
+                    try:
+                        token = await asyncio.wait_for(asyncio.shield(self.token_future(payload[7:].decode('utf-8'))),
+                                                       config['timeout'])
+                        payload = b'RESUME ' + token.encode('utf-8')
+                    except asyncio.TimeoutError:
+                        pass  # The SESSION reply never came; the server will report the session as unknown
+                command = payload.split(b' ', 1)[0].decode('utf-8', 'replace')
+                token = tokens.popleft() if payload == b'SESSION' and tokens else None
+                pending.setdefault(request_id, deque()).append([command, asyncio.get_running_loop().time(), token])
+                drained.clear()
+                writer.write(encode_frame(request_id, payload))
+            if plan.closed_at is not None:
+                await self.wait_until(plan.closed_at)
+            try:
+                await asyncio.wait_for(drained.wait(), config['timeout'])
+            except asyncio.TimeoutError:
+                self.results.errors += sum(len(waiting) for waiting in pending.values())
+        except OSError:
+            self.results.errors += 1
+        finally:
+            replies.cancel()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (OSError, asyncio.CancelledError):
+                pass
+
+    async def read_replies(self, reader, pending, drained):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                frame = await read_frame(reader)
+            except OSError:
+                frame = None
+            if frame is None:
+                return
+            request_id, reply = frame
+            waiting = pending.get(request_id)
+            if not waiting:
+                continue  # A change pushed after a SUBSCRIBE reply
+            command, sent_at, token = waiting.popleft()
+            if not waiting:
+                del pending[request_id]
+                if not pending:
+                    drained.set()
+            now = loop.time()
+            self.results.last_reply = max(self.results.last_reply, now)
+            if reply.startswith(b'BUSY'):
+                self.results.busy += 1
+                continue
+            self.results.latencies.setdefault(command, []).append(now - sent_at)
+            if token is not None and reply.startswith(b'SESSION '):
+                future = self.token_future(token)
+                if not future.done():
+                    future.set_result(reply[8:].decode('utf-8'))
+
+
+def replay_process(args):
+    # Entry point of one replay process: replay its share of the connections.
+    config, plans, start = args
+    return asyncio.run(Replay(config, plans, start).run())
+
+
+def run_replay(config, plans, catalog):
+    # Replay plans against the configured server and return a report dict.
+    stock_config = {'protocol': 'vending', 'host': config['host'], 'port': config['port'], 'encoding': 'json'}
+    initial = asyncio.run(fetch_stock(stock_config))
+    matches_capture = None
+    if catalog is not None:
+        matches_capture = initial == {product['id']: product['stock'] for product in catalog}
+        if not matches_capture:
+            print("WARNING: the server does not start from the captured catalog; "
+                  "final stock will not be comparable", file=sys.stderr)
+
+    shares = group_plans(plans, config['processes'])
+    start = time.monotonic() + 0.5  # Time for every process to start and create its tasks
+    jobs = [(config, share, start) for share in shares]
+    if len(jobs) == 1:
+        parts = [replay_process(jobs[0])]
+    else:
+        with multiprocessing.get_context('fork').Pool(len(jobs)) as pool:
+            parts = pool.map(replay_process, jobs)
+    results = Results()
+    for part in parts:
+        results.merge(part)
+    elapsed = results.last_reply - start
+    time.sleep(config['settle'])  # Let the server release the carts of closed connections
+    final = asyncio.run(fetch_stock(stock_config))
+
+    commands = {}
+    for command, latencies in sorted(results.latencies.items()):
+        samples = sorted(latencies)
+        report = {'count': len(samples), 'per_sec': len(samples) / elapsed if elapsed > 0 else 0.0}
+        for label, fraction in PERCENTILES:
+            report[label + '_ms'] = percentile(samples, fraction) * 1000
+        commands[command] = report
+    total = sum(report['count'] for report in commands.values())
+    return {
+        'config': dict(config),
+        'seconds': elapsed,
+        'requests': total,
+        'requests_per_sec': total / elapsed if elapsed > 0 else 0.0,
+        'errors': results.errors,
+        'busy': results.busy,
+        'max_lag_ms': results.max_lag * 1000,
+        'commands': commands,
+        'initial_matches_capture': matches_capture,
+        'final_stock': {str(product_id): stock for product_id, stock in sorted(final.items())},
+    }
+
+
+def compare(report, baseline, tolerance, latency_tolerance):
+    # Regressions of report against baseline, as a list of messages.
+    problems = []
+    if report['requests_per_sec'] < baseline['requests_per_sec'] * (1 - tolerance / 100):
+        problems.append(f"throughput {report['requests_per_sec']:.0f}/s vs {baseline['requests_per_sec']:.0f}/s")
+    for command, stats in report['commands'].items():
+        before = baseline['commands'].get(command)
+        if not before or min(stats['count'], before['count']) < MIN_SAMPLES:
+            continue
+        if stats['p99_ms'] > before['p99_ms'] * (1 + latency_tolerance / 100):
+            problems.append(f"{command} p99 {stats['p99_ms']:.2f} ms vs {before['p99_ms']:.2f} ms")
+    if report['errors'] > baseline['errors']:
+        problems.append(f"{report['errors']} errors vs {baseline['errors']}")
+    changed = sorted((product_id for product_id in set(report['final_stock']) | set(baseline['final_stock'])
+                      if report['final_stock'].get(product_id) != baseline['final_stock'].get(product_id)), key=int)
+    if changed:
+        shown = ', '.join(f"{product_id}: {report['final_stock'].get(product_id)} vs "
+                          f"{baseline['final_stock'].get(product_id)}" for product_id in changed[:10])
+        problems.append(f"final stock differs for {len(changed)} product(s) ({shown})")
+    return problems
+
+
+def print_report(report, baseline=None, tolerance=10.0, latency_tolerance=25.0):
+    # Print the report, and the comparison with baseline if given. Returns the regressions found.
+    config = report['config']
+    print(f"{config['label']}: {config['connections']} connections (peak {config['peak_concurrency']} at once), "
+          f"speed {config['speed']}x, {report['seconds']:.1f}s, {report['requests_per_sec']:.0f} requests/sec, "
+          f"{report['errors']} errors, {report['busy']} shed (BUSY), "
+          f"replayer lag up to {report['max_lag_ms']:.1f} ms")
+    print(f"{'command':<16} | {'count':>8} | {'per sec':>9} | {'p50 ms':>9} | {'p99 ms':>9} | {'p999 ms':>9}")
+    for command, stats in report['commands'].items():
+        print(f"{command:<16} | {stats['count']:>8} | {stats['per_sec']:>9.0f} | {format_ms(stats['p50_ms'])} | "
+              f"{format_ms(stats['p99_ms'])} | {format_ms(stats['p999_ms'])}")
+    if not baseline:
+        return []
+
+    print(f"\nCompared with {baseline['config']['label']}:")
+    print(f"{'command':<16} | {'per sec':>9} | {'p50':>9} | {'p99':>9} | {'p999':>9}")
+    for command, stats in report['commands'].items():
+        before = baseline['commands'].get(command)
+        if not before:
+            continue
+        cells = [ratio(stats['per_sec'], before['per_sec'])]
+        cells += [ratio(stats[label + '_ms'], before[label + '_ms']) for label, _ in PERCENTILES]
+        print(f"{command:<16} | " + " | ".join(cells))
+    problems = compare(report, baseline, tolerance, latency_tolerance)
+    if problems:
+        print(f"REGRESSION (throughput tolerance {tolerance}%, p99 tolerance {latency_tolerance}%):")
+        for problem in problems:
+            print(f"    {problem}")
+    else:
+        print(f"No regression (throughput tolerance {tolerance}%, p99 tolerance {latency_tolerance}%), "
+              "final inventory identical.")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured traffic against a vending server")
+    parser.add_argument('captures', nargs='+', help="capture file(s) from Server_Code.py --record")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--spawn', choices=['threaded', 'async', 'sharded'], default=None,
+                        help="start this server for the replay instead of using one already listening")
+    parser.add_argument('--workers', type=int, default=None, help="workers for --spawn sharded")
+    parser.add_argument('--hold-seconds', type=float, default=600.0, help="stock hold time for the spawned server")
+    parser.add_argument('--db', default=None,
+                        help="SQLite-backed run: the spawned server gets a fresh copy of this database")
+    parser.add_argument('--server-args', default='', help="extra options for the spawned server")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay this many times faster than captured")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="replay processes; use more when the replayer cannot keep to the schedule")
+    parser.add_argument('--timeout', type=float, default=30.0, help="seconds to wait for a connection or reply")
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help="seconds to wait after the replay before reading the final stock")
+    parser.add_argument('--label', default=None, help="name of this run in reports")
+    parser.add_argument('--output', default=None, help="write the report as JSON to this file")
+    parser.add_argument('--baseline', default=None, help="JSON report of an earlier replay to compare against")
+    parser.add_argument('--tolerance', type=float, default=10.0,
+                        help="percent of throughput loss accepted before failing")
+    parser.add_argument('--latency-tolerance', type=float, default=25.0,
+                        help="percent of p99 latency growth accepted before failing")
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+
+    plans, catalog, seconds = load_plans(args.captures)
+    requests = sum(len(plan.requests) for plan in plans)
+    config = {
+        'label': args.label or args.spawn or f"{args.host}:{args.port}",
+        'captures': args.captures, 'host': args.host, 'port': args.port, 'speed': args.speed,
+        'timeout': args.timeout, 'settle': args.settle, 'processes': args.processes, 'connections': len(plans),
+        'peak_concurrency': peak_concurrency(plans, seconds), 'captured_requests': requests,
+        'captured_seconds': seconds,
+    }
+    print(f"Replaying {requests} requests on {len(plans)} connections, "
+          f"{seconds:.1f}s captured ({seconds / args.speed:.1f}s at {args.speed}x)")
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    with tempfile.TemporaryDirectory() as directory:
+        server = None
+        if args.spawn:
+            extra_args = shlex.split(args.server_args)
+            if args.db:
+                db_path = os.path.join(directory, 'replay.db')
+                shutil.copyfile(args.db, db_path)
+                extra_args += ['--db', db_path]
+            server = spawn_server(args.spawn, args.host, args.port, directory, args.hold_seconds, args.workers,
+                                  extra_args)
+        try:
+            report = run_replay(config, plans, catalog)
+        finally:
+            if server:
+                stop_server(server)
+
+    problems = print_report(report, baseline, args.tolerance, args.latency_tolerance)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if problems:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import log
+
+# Stock reservations with expiring holds.
+#
+# ADD_TO_CART takes the stock out of the inventory straight away and records a
+# hold for the cart, so a customer learns about a sold-out item when they pick it
+# rather than at checkout. CHECKOUT turns the cart's holds into a sale. Holds that
+# are not checked out within hold_seconds give their stock back.
+#
+# Expiry uses a min-heap ordered by deadline: finding due holds is a peek at the
+# top and each expiry costs O(log n), however many carts are open. Refreshing a
+# hold pushes a new heap entry; the old one is recognised as stale when it
+# surfaces (its deadline no longer matches the hold) and skipped.
+#
+# Stock is taken and given back outside the manager's lock, which only guards the
+# hold table and the heap. Changes to holds on the same product are serialised by
+# one of LOCK_STRIPES stripe locks, so holds and checkouts on different products
+# run in parallel, as checkouts without holds do.
+
+LOCK_STRIPES = 64
+
+
+class Hold:
+    __slots__ = ('quantity', 'expires_at')
+
+    def __init__(self, quantity, expires_at):
+        self.quantity = quantity
+        self.expires_at = expires_at
+
+
+class ReservationManager:
+    def __init__(self, inventory, hold_seconds=600.0):
+        # inventory: the Server_Code.Inventory whose stock is held
+        self.inventory = inventory
+        self.hold_seconds = hold_seconds
+        self._holds = {}  # owner (a Cart) -> {product ID: Hold}
+        self._heap = []  # (expires_at, tiebreak, owner, product ID)
+        self._tiebreak = itertools.count()  # Owners are not orderable, so heap ties need a key
+        self._lock = threading.Lock()  # Guards _holds, _heap and the metrics; never held while stock moves
+        self._stripes = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        # Metrics, see stats()
+        self.placed = 0
+        self.rejected = 0
+        self.converted = 0
+        self.expired = 0
+        self.released = 0
+
+    @contextmanager
+    def _locked(self, product_ids):
+        # Serialise hold changes on product_ids. A hold's quantity and the stock taken for
+        # it only change under the stripe lock of its product; stripes are taken in
+        # ascending order (so callers never deadlock) and carts that share no stripe
+        # never wait for each other, even while stock is taken from a remote shard.
+        stripes = [self._stripes[index] for index in sorted({product_id % LOCK_STRIPES
+                                                             for product_id in product_ids})]
+        for stripe in stripes:
+            stripe.acquire()
+        try:
+            yield
+        finally:
+            for stripe in reversed(stripes):
+                stripe.release()
+
+    def hold(self, owner, product_id, quantity):
+        # Set owner's hold on a product to quantity, taking or giving back the difference
+        # and restarting the hold's timer. Returns False (hold unchanged) if there is not
+        # enough stock.
+        if self.inventory.flash_sales:
+            holds = self._holds.get(owner)
+            current = holds.get(product_id) if holds else None
+            if quantity > (current.quantity if current else 0) and self.inventory.sold_out(product_id):
+                return False  # Flash sale is over: refuse without queueing on the lock
+        now = time.monotonic()
+        self._expire_due(now)
+        with self._locked((product_id,)):
+            with self._lock:
+                holds = self._holds.get(owner)
+                current = holds.get(product_id) if holds else None
+            held = current.quantity if current else 0
+            if quantity > held:
+                success, _, _ = self.inventory.take_stock({product_id: quantity - held})
+                if not success:
+                    with self._lock:
+                        self.rejected += 1
+                    return False
+            elif quantity < held:
+                self.inventory.return_stock({product_id: held - quantity})
+
+            with self._lock:
+                if quantity > held:
+                    self.placed += 1
+                if quantity == 0:
+                    if current:
+                        self.released += 1
+                        self._forget(owner, (product_id,))
+                    return True
+                expires_at = now + self.hold_seconds
+                if current:
+                    current.quantity = quantity
+                    current.expires_at = expires_at
+                else:
+                    self._holds.setdefault(owner, {})[product_id] = Hold(quantity, expires_at)
+                heapq.heappush(self._heap, (expires_at, next(self._tiebreak), owner, product_id))
+            return True
+
+    def _forget(self, owner, product_ids):
+        # Drop owner's holds on product_ids and return them. Caller holds the lock.
+        holds = self._holds.get(owner, {})
+        dropped = {product_id: holds.pop(product_id) for product_id in product_ids if product_id in holds}
+        if not holds:
+            self._holds.pop(owner, None)
+        return dropped
+
+    def release(self, owner):
+        # Give back everything held for owner (cart emptied, connection or session gone).
+        while True:
+            with self._lock:
+                product_ids = list(self._holds.get(owner, ()))
+            if not product_ids:
+                return
+            with self._locked(product_ids):
+                with self._lock:
+                    dropped = self._forget(owner, product_ids)
+                    self.released += len(dropped)
+                if dropped:
+                    self.inventory.return_stock({product_id: hold.quantity for product_id, hold in dropped.items()})
+            # Loops only if a hold on another product was placed meanwhile
+
+    def checkout(self, owner, items):
+        # Turn owner's holds into a sale of items (product ID -> quantity).
+        # Lines whose hold expired (or was smaller) get their stock taken again now;
+        # if that fails nothing changes and the remaining holds stay in place.
+        # Returns (success, message).
+        self._expire_due(time.monotonic())
+        with self._lock:
+            product_ids = set(items) | set(self._holds.get(owner, ()))
+        with self._locked(product_ids):
+            with self._lock:
+                holds = {product_id: hold.quantity for product_id, hold in self._holds.get(owner, {}).items()
+                         if product_id in product_ids}
+            shortfall = {}
+            surplus = {}
+            for product_id, quantity in items.items():
+                held = holds.get(product_id, 0)
+                if quantity > held:
+                    shortfall[product_id] = quantity - held
+                elif quantity < held:
+                    surplus[product_id] = held - quantity
+            for product_id, held in holds.items():
+                if product_id not in items:
+                    surplus[product_id] = held
+            if shortfall:
+                success, message, _ = self.inventory.take_stock(shortfall)
+                if not success:
+                    return False, message
+            if surplus:
+                self.inventory.return_stock(surplus)
+            with self._lock:
+                self.converted += sum(1 for product_id in holds if product_id in items)
+                self._forget(owner, holds)
+        self.inventory.record_sale(dict(items))
+        return True, "successful"
+
+    def expire_due(self):
+        # Expire every hold past its deadline. Returns how many expired.
+        return self._expire_due(time.monotonic())
+
+    def _expire_due(self, now):
+        # Pop due heap entries and give their stock back.
+        with self._lock:
+            if not self._heap or self._heap[0][0] > now:
+                return 0
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                expires_at, _, owner, product_id = heapq.heappop(self._heap)
+                due.append((owner, product_id, expires_at))
+        returned = {}
+        expired = 0
+        with self._locked({product_id for _, product_id, _ in due}):
+            with self._lock:
+                for owner, product_id, expires_at in due:
+                    holds = self._holds.get(owner)
+                    hold = holds.get(product_id) if holds else None
+                    if hold is None or hold.expires_at != expires_at:
+                        continue  # Stale entry: the hold was refreshed, released or converted
+                    self._forget(owner, (product_id,))
+                    returned[product_id] = returned.get(product_id, 0) + hold.quantity
+                    expired += 1
+                self.expired += expired
+            if returned:
+                self.inventory.return_stock(returned)
+        return expired
+
+    def start_expiry_thread(self, interval=1.0):
+        # Expire holds in the background so stock comes back even when no requests arrive.
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.expire_due()
+                except Exception as e:
+                    log.warning("Hold expiry failed: %s", e)
+
+        threading.Thread(target=run, name="hold-expiry", daemon=True).start()
+
+    def stats(self):
+        # Counters for monitoring. hit_rate is the share of finished holds that became sales.
+        with self._lock:
+            active = sum(len(holds) for holds in self._holds.values())
+            finished = self.converted + self.expired + self.released
+            return {
+                'active_holds': active,
+                'placed': self.placed,
+                'rejected': self.rejected,
+                'converted': self.converted,
+                'expired': self.expired,
+                'released': self.released,
+                'hit_rate': self.converted / finished if finished else None,
+            }
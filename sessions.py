@@ -0,0 +1,195 @@
+import json
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from Import_sqlite3 import transaction
+from metrics import log
+
+# Server-side cart sessions.
+#
+# A client that sends SESSION gets a token; its cart then lives in the SessionStore
+# rather than in the connection, and RESUME <token> on any later connection picks
+# it up again. Sessions are kept in least-recently-used order, so expiring idle
+# ones only ever looks at the front of the list. When the store is full the least
+# recently used session is spilled to SQLite (if a database is configured) or
+# dropped. Every cart that leaves memory is handed to on_evict, under the cart's
+# lock, so anything it holds (e.g. reserved stock) can be given back.
+#
+# "Full" is a count, max_sessions, not a number of bytes. An empty session takes
+# about 500 bytes and every cart line adds a little, so the default of 100000 keeps
+# carts to roughly 50 MB plus their lines.
+
+CREATE_SESSIONS_SQL = (
+    'CREATE TABLE IF NOT EXISTS sessions ('
+    'token TEXT PRIMARY KEY, cart TEXT NOT NULL, last_seen REAL NOT NULL)'
+)
+
+
+class Session:
+    __slots__ = ('token', 'cart', 'last_seen')
+
+    def __init__(self, token, cart, last_seen):
+        self.token = token
+        self.cart = cart
+        self.last_seen = last_seen
+
+
+class SessionStore:
+    def __init__(self, cart_factory, ttl=1800.0, max_sessions=100000, spill_db=None, on_evict=None):
+        # cart_factory: returns a new empty Cart
+        # ttl: seconds a session may stay idle before it expires
+        # max_sessions: number of sessions kept in memory; beyond that the LRU one is spilled or dropped
+        # spill_db: optional Import_sqlite3.InventoryDatabase that receives spilled carts
+        # on_evict: called with the cart of every session that expires, is dropped or is spilled
+        self.cart_factory = cart_factory
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.spill_db = spill_db
+        self.on_evict = on_evict
+        self._sessions = OrderedDict()  # token -> Session, least recently used first
+        self._lock = threading.Lock()  # Guards _sessions and the counters below
+        self.hits = 0  # RESUMEs that found their session, in memory or spilled
+        self.misses = 0  # RESUMEs of unknown or expired tokens
+        self.expired = 0  # Idle for longer than ttl
+        self.evicted = 0  # Dropped from a full store without a database to spill to
+        self.spilled = 0
+        if spill_db:
+            with spill_db.pool.connection() as connection:
+                with transaction(connection):
+                    connection.execute(CREATE_SESSIONS_SQL)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def create(self, cart=None):
+        # Start a session, adopting cart if given. Returns the session token.
+        token = secrets.token_urlsafe(16)
+        self._add(Session(token, cart if cart is not None else self.cart_factory(), time.monotonic()))
+        return token
+
+    def _add(self, session):
+        # Put a session in memory, spilling or dropping the least recently used ones
+        # while there are more than max_sessions.
+        with self._lock:
+            dropped = self._sweep(session.last_seen)
+            self._sessions[session.token] = session
+            evicted = []
+            while len(self._sessions) > self.max_sessions:
+                evicted.append(self._sessions.popitem(last=False)[1])
+            self.expired += len(dropped)
+            if not self.spill_db:
+                self.evicted += len(evicted)
+        self._release(dropped)
+        if self.spill_db:
+            for oldest in evicted:
+                self._spill(oldest)
+        else:
+            self._release(evicted)
+
+    def resume(self, token):
+        # Return the cart of a live session and mark it as used, or None if the
+        # token is unknown or expired.
+        now = time.monotonic()
+        with self._lock:
+            dropped = self._sweep(now)
+            session = self._sessions.get(token)
+            if session is not None:
+                session.last_seen = now
+                self._sessions.move_to_end(token)
+                self.hits += 1
+            self.expired += len(dropped)
+        self._release(dropped)
+        if session is None:
+            if self.spill_db:
+                session = self._unspill(token, now)
+            with self._lock:
+                if session is not None:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        return session.cart if session is not None else None
+
+    def expire(self):
+        # Drop every session idle for longer than ttl. Returns how many were dropped.
+        with self._lock:
+            dropped = self._sweep(time.monotonic())
+            self.expired += len(dropped)
+        self._release(dropped)
+        if self.spill_db:
+            with self.spill_db.pool.connection() as connection:
+                connection.execute('DELETE FROM sessions WHERE last_seen < ?', (time.time() - self.ttl,))
+        return len(dropped)
+
+    def stats(self):
+        # Counters for monitoring (the STATS command).
+        with self._lock:
+            return {
+                'active_sessions': len(self._sessions),
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evicted': self.evicted,
+                'spilled': self.spilled,
+            }
+
+    def start_sweeper(self, interval=30.0):
+        # Expire idle sessions in the background, so an idle server still frees them.
+        def sweep():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.expire()
+                except Exception as e:
+                    log.warning("Session sweep failed: %s", e)
+
+        threading.Thread(target=sweep, name="session-sweeper", daemon=True).start()
+
+    def _sweep(self, now):
+        # Pop expired sessions off the LRU front. Caller holds the lock.
+        dropped = []
+        deadline = now - self.ttl
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.last_seen > deadline:
+                break
+            del self._sessions[session.token]
+            dropped.append(session)
+        return dropped
+
+    def _release(self, sessions):
+        # Hand dropped carts back outside the store's lock. The cart's own lock waits
+        # for a request still working on it, so on_evict sees the cart's final lines.
+        if self.on_evict:
+            for session in sessions:
+                with session.cart.lock:
+                    self.on_evict(session.cart)
+
+    def _spill(self, session):
+        # Move a session to SQLite. Wall-clock time is stored so it can expire there too.
+        idle = time.monotonic() - session.last_seen
+        with session.cart.lock:
+            lines = json.dumps(list(session.cart.items.items()))
+            if self.on_evict:
+                self.on_evict(session.cart)  # The in-memory cart is gone; only its contents survive
+        with self.spill_db.pool.connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO sessions (token, cart, last_seen) VALUES (?, ?, ?)',
+                               (session.token, lines, time.time() - idle))
+        with self._lock:
+            self.spilled += 1
+
+    def _unspill(self, token, now):
+        with self.spill_db.pool.connection() as connection:
+            with transaction(connection):
+                row = connection.execute('SELECT cart, last_seen FROM sessions WHERE token = ?', (token,)).fetchone()
+                connection.execute('DELETE FROM sessions WHERE token = ?', (token,))
+        if row is None or row[1] < time.time() - self.ttl:
+            return None
+        cart = self.cart_factory()
+        for product_id, quantity in json.loads(row[0]):
+            if product_id in cart.inventory.products:  # Skip products removed since the spill
+                cart.set_quantity(product_id, quantity)
+        session = Session(token, cart, now)
+        self._add(session)  # Back in memory under its original token, within max_sessions
+        return session
@@ -0,0 +1,332 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Client as RpcClient, Listener
+
+from Server_Code import Inventory, accept_loop, create_sessions
+from traffic import RECORDER
+from metrics import log
+
+# Multi-process sharded server, started with `python Server_Code.py --engine sharded`
+# (which passes on its session, hold, flash sale, capture and worker pool options).
+#
+# A supervisor forks one worker process per core. Every worker opens its own
+# listening socket on the same port with SO_REUSEPORT, so the kernel spreads
+# incoming connections over the workers and no process is limited by another's GIL.
+#
+# Stock is partitioned: product P is owned by shard P % N, and only the owner
+# changes its stock. Every worker keeps a replica of the whole catalog for names,
+# prices and browsing; the stock figures for products it does not own are pulled
+# from their owners at most every max_age seconds, so VIEW_PRODUCTS never waits on
+# other processes for longer than one refresh. Taking stock always goes to the owner.
+#
+# A checkout that touches several shards uses two-phase reserve/commit: every
+# owner is asked, in shard order, to take its part of the cart and remember it
+# under a transaction ID (prepare); if all succeed they are told to commit
+# (forget it), otherwise the ones that prepared are told to abort (put it back).
+# A prepared transaction that hears nothing for PREPARE_TIMEOUT seconds is treated
+# as committed: at worst some stock stays sold, it is never sold twice.
+
+PREPARE_TIMEOUT = 30.0
+
+
+class ShardClient:
+    # RPC connections to one remote shard. A Connection is not thread-safe, so each
+    # call borrows one from the pool for its round trip.
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self._idle = queue.LifoQueue()
+
+    def _connect(self, timeout=10.0):
+        # The owner may still be starting up; retry until its socket appears.
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return RpcClient(self.address, family='AF_UNIX', authkey=self.authkey)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def call(self, *message):
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            connection = self._connect()
+        try:
+            connection.send(message)
+            reply = connection.recv()
+        except Exception:
+            connection.close()
+            raise
+        self._idle.put(connection)
+        return reply
+
+
+class ShardedInventory(Inventory):
+    def __init__(self, shard_index, shard_count, addresses, authkey, hold_seconds=None, max_age=0.1):
+        # shard_index: the shard this process owns; addresses: RPC socket path of every shard
+        # max_age: seconds a replica of another shard's stock may be served before refreshing
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.max_age = max_age
+        self.local_version = 0
+        self.remote_versions = {shard: 0 for shard in range(shard_count) if shard != shard_index}
+        self._fetched_at = 0.0
+        self._remote_lock = threading.Lock()
+        self._prepared = {}  # Transaction ID -> (quantities, deadline) prepared for a remote coordinator
+        self._prepared_lock = threading.Lock()
+        self._txids = itertools.count(1)
+        super().__init__(hold_seconds=hold_seconds)
+        self.shards = {shard: ShardClient(addresses[shard], authkey) for shard in self.remote_versions}
+        self.changes.poll = self._refresh_remote  # Subscribers also see other shards' changes
+
+    def shard_of(self, product_id):
+        return product_id % self.shard_count
+
+    def _changed(self, product_ids=()):
+        # Only stock owned by this shard changes here; remote changes arrive via _refresh_remote.
+        with self._version_lock:
+            self.local_version += 1
+            self.version = self.local_version + sum(self.remote_versions.values())
+        self.changes.record(product_ids)
+
+    # Coordinator side
+
+    def take_stock(self, cart):
+        quantities, error = self.merge_lines(cart)
+        if error:
+            return False, error, quantities
+        groups = {}
+        for product_id, quantity in quantities.items():
+            groups.setdefault(self.shard_of(product_id), {})[product_id] = quantity
+
+        if len(groups) == 1:
+            (shard, items), = groups.items()
+            success, message = self._take_on(shard, items, None)
+            return success, message, quantities
+
+        txid = f"{self.shard_index}-{next(self._txids)}"
+        prepared = []
+        for shard in sorted(groups):
+            success, message = self._take_on(shard, groups[shard], txid)
+            if not success:
+                for done in prepared:
+                    self._finish(done, txid, groups[done], commit=False)
+                return False, message, quantities
+            prepared.append(shard)
+        for shard in prepared:
+            self._finish(shard, txid, groups[shard], commit=True)
+        return True, "successful", quantities
+
+    def _take_on(self, shard, items, txid):
+        if shard == self.shard_index:
+            success, message = self.take_quantities(items)
+            if success:
+                self._changed(items)
+            return success, message
+        try:
+            return self.shards[shard].call('take', txid, items)
+        except Exception as e:  # A dead or unreachable peer fails the checkout, not the request
+            return False, f"Shard {shard} is unavailable: {e}"
+
+    def _finish(self, shard, txid, items, commit):
+        if shard == self.shard_index:
+            if not commit:
+                Inventory.return_stock(self, items)
+            return
+        try:
+            self.shards[shard].call('commit' if commit else 'abort', txid)
+        except Exception as e:
+            log.warning("Could not %s %s on shard %d: %s", 'commit' if commit else 'abort', txid, shard, e)
+
+    def return_stock(self, quantities):
+        groups = {}
+        for product_id, quantity in quantities.items():
+            groups.setdefault(self.shard_of(product_id), {})[product_id] = quantity
+        for shard, items in groups.items():
+            if shard == self.shard_index:
+                Inventory.return_stock(self, items)
+                continue
+            try:
+                self.shards[shard].call('return', items)
+            except Exception as e:  # The stock stays taken; the request carries on
+                log.warning("Could not return %s to shard %d: %s", items, shard, e)
+
+    def catalog_snapshot(self):
+        self._refresh_remote()
+        return super().catalog_snapshot()
+
+    def catalog_columnar(self):
+        self._refresh_remote()
+        return super().catalog_columnar()
+
+    def _refresh_remote(self):
+        # Pull stock of other shards' products into the local replica if it is older than max_age.
+        if time.monotonic() - self._fetched_at < self.max_age:
+            return
+        with self._remote_lock:
+            if time.monotonic() - self._fetched_at < self.max_age:
+                return  # Another thread refreshed while we waited
+            for shard, client in self.shards.items():
+                try:
+                    version, rows = client.call('snapshot', self.remote_versions[shard])
+                except Exception as e:
+                    log.warning("Could not refresh shard %d: %s", shard, e)
+                    continue
+                if rows is not None:
+                    changed = []
+                    for product_id, stock in rows:
+                        product = self.products[product_id]
+                        if product.stock != stock:
+                            product.stock = stock
+                            changed.append(product_id)
+                    self.remote_versions[shard] = version
+                    self.changes.record(changed)
+            self._fetched_at = time.monotonic()
+            with self._version_lock:
+                self.version = self.local_version + sum(self.remote_versions.values())
+
+    # Participant side
+
+    def serve_shard(self, address, authkey):
+        # Answer RPCs from the other workers. Runs forever; start it on a thread.
+        listener = Listener(address, family='AF_UNIX', authkey=authkey)
+        threading.Thread(target=self._forget_stale_prepares, name="shard-reaper", daemon=True).start()
+        while True:
+            connection = listener.accept()
+            threading.Thread(target=self._serve_peer, args=(connection,), daemon=True).start()
+
+    def _serve_peer(self, connection):
+        try:
+            while True:
+                connection.send(self._handle_rpc(connection.recv()))
+        except EOFError:
+            pass  # The peer closed the connection
+        finally:
+            connection.close()
+
+    def _handle_rpc(self, message):
+        op = message[0]
+        if op == 'take':
+            _, txid, items = message
+            success, response = self.take_quantities(items)
+            if success:
+                self._changed(items)
+                if txid:
+                    with self._prepared_lock:
+                        self._prepared[txid] = (items, time.monotonic() + PREPARE_TIMEOUT)
+            return success, response
+        if op == 'commit':
+            with self._prepared_lock:
+                self._prepared.pop(message[1], None)
+            return True
+        if op == 'abort':
+            with self._prepared_lock:
+                prepared = self._prepared.pop(message[1], None)
+            if prepared:
+                Inventory.return_stock(self, prepared[0])
+            return True
+        if op == 'return':
+            Inventory.return_stock(self, message[1])
+            return True
+        if op == 'snapshot':
+            version = self.local_version
+            if message[1] == version:
+                return version, None
+            return version, [(product.id, product.stock) for product in self.products.values()
+                             if self.shard_of(product.id) == self.shard_index]
+        raise ValueError(f"Unknown shard operation {op!r}")
+
+    def _forget_stale_prepares(self):
+        while True:
+            time.sleep(PREPARE_TIMEOUT / 3)
+            now = time.monotonic()
+            with self._prepared_lock:
+                stale = [txid for txid, (_, deadline) in self._prepared.items() if deadline < now]
+                for txid in stale:
+                    del self._prepared[txid]
+            for txid in stale:
+                log.warning("No decision for %s within %ss; keeping it as sold", txid, PREPARE_TIMEOUT)
+
+
+def run_worker(shard_index, shard_count, host, port, addresses, authkey, hold_seconds, session_ttl, max_sessions,
+               flash_sale=(), record=None, pool_options=None):
+    # Body of one worker process: own one shard and serve clients on the shared port.
+    # record: capture this worker's traffic to record.<shard index> (see traffic.py).
+    # pool_options: worker pool and admission limits for accept_loop.
+    inventory = ShardedInventory(shard_index, shard_count, addresses, authkey, hold_seconds)
+    for product_id in flash_sale:
+        if inventory.shard_of(product_id) == shard_index:  # The owning shard runs the product's lane
+            inventory.enable_flash_sale(product_id)
+    threading.Thread(target=inventory.serve_shard, args=(addresses[shard_index], authkey),
+                     name="shard-rpc", daemon=True).start()
+    if inventory.reservations:
+        inventory.reservations.start_expiry_thread()
+    sessions = create_sessions(inventory, None, session_ttl, max_sessions)
+    if record:
+        RECORDER.start(f'{record}.{shard_index}')  # The catalog lives across shards, so none is stored
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # terminate() still runs the cleanup below
+
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)  # The kernel balances accepts
+    try:
+        server_socket.bind((host, port))
+        server_socket.listen(1024)
+        log.info("Shard %d/%d (pid %d) waiting for connections...", shard_index, shard_count, os.getpid())
+        accept_loop(server_socket, inventory, sessions, **(pool_options or {}))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        RECORDER.stop()
+        server_socket.close()
+
+
+def sharded_server_program(host='localhost', port=5000, workers=None, hold_seconds=600.0,
+                           session_ttl=1800.0, max_sessions=100000, flash_sale=(), record=None, pool_options=None):
+    # Supervisor: start one worker per shard and wait for them. Stopping it with Ctrl+C
+    # or SIGTERM stops the workers too and removes their sockets.
+    # Sessions live in the worker that created them, so RESUME only finds a cart if the
+    # new connection lands on the same worker.
+    # pool_options: worker pool and admission limits (see accept_loop) for every worker.
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        log.error("The sharded engine needs SO_REUSEPORT (Linux).")
+        return
+    workers = workers or os.cpu_count() or 1
+    socket_dir = tempfile.mkdtemp(prefix='vending-shards-')
+    addresses = [os.path.join(socket_dir, f'shard-{shard}.sock') for shard in range(workers)]
+    authkey = os.urandom(16)  # Only our own workers can talk to the shard sockets
+    context = multiprocessing.get_context('fork')
+    processes = [
+        context.Process(target=run_worker, name=f'shard-{shard}',
+                        args=(shard, workers, host, port, addresses, authkey, hold_seconds,
+                              session_ttl, max_sessions, tuple(flash_sale), record, pool_options))
+        for shard in range(workers)
+    ]
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # Leaves through the finally below
+    try:
+        for process in processes:
+            process.start()
+        log.info("Sharded server running %d worker(s) on %s:%d", workers, host, port)
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)  # A second SIGTERM must not cut the cleanup short
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join(timeout=5)  # Workers clean up their shard sockets on the way out
+        shutil.rmtree(socket_dir, ignore_errors=True)
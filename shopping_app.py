@@ -1,37 +1,190 @@
 import tkinter as tk
 from tkinter import messagebox
 from tkinter import ttk
-import socket
+import itertools
 import json
+import queue
+import threading
+
+from Client_Code import Client
+
+ROW_CHUNK = 200  # Product rows inserted at a time; more follow only as the list is scrolled to its end
+FILL_AT = 0.9  # Insert the next chunk once the bottom of the view passes this fraction of the rows
+POLL_MS = 50  # How often the Tk loop picks up results from the network thread
+
+
+def copy_products(products):
+    return [dict(product) for product in products]
+
+
+def resubscribe(client):
+    # Subscribe to the change feed; its snapshot reaches the window as an update. Returns
+    # the product list only for a server without SUBSCRIBE, None otherwise.
+    if client.subscribe():
+        return None
+    return copy_products(client.fetch_products())
+
+
+class NetworkWorker:
+    # Owns the connection to the server. All socket I/O runs on this thread: the window
+    # submits jobs and picks up their results from a queue, so a slow server never
+    # blocks the Tk mainloop. While idle it applies the catalog updates the server pushes.
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()  # (kind, result) for the Tk side
+        self._thread = threading.Thread(target=self._run, name="network", daemon=True)
+        self._thread.start()
+
+    def submit(self, kind, function):
+        # Run function(client) on the network thread; its return value arrives as (kind, value).
+        self.jobs.put((kind, function))
+
+    def close(self):
+        self.jobs.put(None)
+
+    def _on_update(self, update):
+        # The client applies deltas to its own product dicts on this thread, so the
+        # window gets copies it can keep.
+        if update['type'] == 'snapshot':
+            update = dict(update, products=copy_products(update['products']))
+        self.results.put(('update', update))
+        if update['type'] == 'resync':
+            self.submit('products', resubscribe)
+
+    def _run(self):
+        try:
+            client = Client(self.host, self.port)
+            client.on_update = self._on_update
+            self.results.put(('products', resubscribe(client)))
+        except Exception as e:
+            self.results.put(('error', f"Could not connect to the server: {e}"))
+            return
+        try:
+            while True:
+                try:
+                    job = self.jobs.get(timeout=0.1)
+                except queue.Empty:
+                    if client.subscription_id is not None:
+                        client.poll_updates()
+                    continue
+                if job is None:
+                    break
+                kind, function = job
+                try:
+                    self.results.put((kind, function(client)))
+                except (OSError, ValueError) as e:
+                    self.results.put(('error', f"Request failed: {e}"))
+        except OSError as e:
+            self.results.put(('error', f"Lost the connection to the server: {e}"))
+        finally:
+            client.close()
 
-# Inventory data
-inventory = [
-    {'id': 1, 'name': 'Python Programming eBook', 'price': 10.99, 'stock': 25},
-    {'id': 2, 'name': 'Photo Editing License', 'price': 29.99, 'stock': 17},
-    {'id': 3, 'name': 'Study Playlist MP3', 'price': 5.99, 'stock': 17},
-    {'id': 4, 'name': 'Adobe Photoshop', 'price': 19.99, 'stock': 25},
-    {'id': 5, 'name': 'Mystery Gift', 'price': 20.99, 'stock': 15},
-    {'id': 6, 'name': 'Amazon Gift Card', 'price': 10.99, 'stock': 20}
-]
 
 class ShoppingClient:
-    def __init__(self, client_socket):
-        self.client_socket = client_socket
-        self.cart = {}  # Dictionary to store products added to the cart
+    def __init__(self, network):
+        self.network = network
+        self.cart = {}  # Dictionary of products added to the cart, as confirmed by the server
+        self.products = {}  # Product ID -> product dict, kept current by the server's change feed
+        self._row_ids = []  # Product IDs in list order; the first _inserted of them are in the Treeview
+        self._inserted = 0
+        self._fill_scheduled = False
         self.root = tk.Tk()
         self.root.title("Shopping System")
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
         self.display_products()  # Display the available products
+        self.root.after(POLL_MS, self.process_results)
 
     def display_products(self):
         #Displays the products available in the inventory.
         tk.Label(self.root, text="Available Products", font=("Arial", 16)).pack(pady=10)
-        for product in inventory:
-            frame = tk.Frame(self.root)
-            frame.pack(pady=5, padx=10, fill="x")
-            product_info = f"ID: {product['id']} | Name: {product['name']} | Price: £{product['price']} | Stock: {product['stock']}"
-            tk.Label(frame, text=product_info, font=("Arial", 12)).pack(side="left")
-            tk.Button(frame, text="Add to Cart", command=lambda p=product: self.prompt_quantity(p['id'], p['name'])).pack(side="right")
-        tk.Button(self.root, text="View Cart", command=self.show_cart, bg="green", fg="white").pack(pady=10)
+        self.status = tk.Label(self.root, text="Connecting to the server...", font=("Arial", 10))
+        self.status.pack()
+
+        frame = tk.Frame(self.root)
+        frame.pack(pady=5, padx=10, fill="both", expand=True)
+        # One Treeview instead of a Frame and Labels per product: rows are cheap items, not widgets
+        self.tree = ttk.Treeview(frame, columns=("id", "name", "price", "stock"), show="headings", height=15)
+        for column, heading, width in (("id", "ID", 60), ("name", "Name", 260), ("price", "Price", 80),
+                                       ("stock", "Stock", 70)):
+            self.tree.heading(column, text=heading)
+            self.tree.column(column, width=width, anchor="w" if column == "name" else "e")
+        scrollbar = ttk.Scrollbar(frame, orient="vertical", command=self.tree.yview)
+        self.tree.configure(yscrollcommand=lambda first, last: self._on_scroll(scrollbar, first, last))
+        self.tree.pack(side="left", fill="both", expand=True)
+        scrollbar.pack(side="right", fill="y")
+        self.tree.bind("<Double-1>", lambda event: self.add_selected())
+
+        buttons = tk.Frame(self.root)
+        buttons.pack(pady=10)
+        tk.Button(buttons, text="Add to Cart", command=self.add_selected).pack(side="left", padx=5)
+        tk.Button(buttons, text="View Cart", command=self.show_cart, bg="green", fg="white").pack(side="left", padx=5)
+
+    def process_results(self):
+        # Apply everything the network thread has produced since the last tick.
+        try:
+            while True:
+                kind, result = self.network.results.get_nowait()
+                handler = getattr(self, f'on_{kind}')
+                handler(result)
+        except queue.Empty:
+            pass
+        self.root.after(POLL_MS, self.process_results)
+
+    def on_error(self, message):
+        self.status.config(text=message)
+        messagebox.showerror("Server Error", message)
+
+    def on_products(self, products):
+        # A full product list: replace the rows. Only the first chunk becomes Treeview
+        # items now; the rest are inserted as the user scrolls down (see _on_scroll).
+        if products is None:
+            return  # Subscribed: the list arrives as a snapshot update
+        self.tree.delete(*self.tree.get_children())
+        self.products = {product['id']: product for product in products}
+        self._row_ids = list(self.products)
+        self._inserted = 0
+        self.status.config(text=f"{len(self.products)} products")
+        self._insert_rows()
+
+    def on_update(self, update):
+        # A message from the change feed: a snapshot, or new prices and stock levels.
+        if update['type'] == 'snapshot':
+            self.on_products(update['products'])
+        elif update['type'] == 'delta':
+            for change in update['changes']:
+                product = self.products.get(change['id'])
+                if product is None:
+                    continue
+                product['price'] = change['price']
+                product['stock'] = change['stock']
+                if self.tree.exists(product['id']):  # Rows not inserted yet pick it up when they are
+                    self.tree.item(product['id'], values=self._row(product))
+
+    def _row(self, product):
+        return (product['id'], product['name'], f"£{product['price']:.2f}", product['stock'])
+
+    def _insert_rows(self):
+        self._fill_scheduled = False
+        end = min(self._inserted + ROW_CHUNK, len(self._row_ids))
+        for product_id in itertools.islice(self._row_ids, self._inserted, end):
+            self.tree.insert("", "end", iid=product_id, values=self._row(self.products[product_id]))
+        self._inserted = end
+
+    def _on_scroll(self, scrollbar, first, last):
+        scrollbar.set(first, last)
+        if float(last) >= FILL_AT and self._inserted < len(self._row_ids) and not self._fill_scheduled:
+            self._fill_scheduled = True  # Not from inside the Treeview's own scroll callback
+            self.root.after_idle(self._insert_rows)
+
+    def add_selected(self):
+        selection = self.tree.selection()
+        if not selection:
+            messagebox.showinfo("Add to Cart", "Select a product first.")
+            return
+        product = self.products[int(selection[0])]
+        self.prompt_quantity(product['id'], product['name'])
 
     def prompt_quantity(self, product_id, product_name):
         #Prompts the user to enter a quantity for the selected product.
@@ -55,35 +208,37 @@ class ShoppingClient:
         tk.Button(quantity_window, text="Confirm", command=confirm_quantity, bg="blue", fg="white").pack(pady=10)
 
     def add_to_cart(self, product_id, product_name, quantity):
-        #Adds the specified quantity of the product to the cart, checking available stock.
-        product = next((item for item in inventory if item['id'] == product_id), None)
-        if product:
-            # Check if the requested quantity is available
-            if product['stock'] >= quantity:
-                self.cart[product_id] = self.cart.get(product_id, 0) + quantity
-                product['stock'] -= quantity  # Deduct the quantity from the stock
-                messagebox.showinfo("Cart Updated", f"Added {quantity} of {product_name} to the cart.")
-            else:
-                messagebox.showerror("Stock Unavailable", f"Only {product['stock']} of {product_name} available.")
+        #Asks the server to add the product to the cart; the answer arrives in on_add.
+        self.status.config(text=f"Adding {product_name}...")
+        self.network.submit('add', lambda client: (product_id, product_name, quantity,
+                                                   client.add_to_cart(product_id, quantity)))
+
+    def on_add(self, result):
+        product_id, product_name, quantity, response = result
+        self.status.config(text=response)
+        if response.startswith('Added'):
+            self.cart[product_id] = self.cart.get(product_id, 0) + quantity
+            messagebox.showinfo("Cart Updated", f"Added {quantity} of {product_name} to the cart.")
         else:
-            messagebox.showerror("Product Not Found", f"Product ID {product_id} not found in inventory.")
+            messagebox.showerror("Stock Unavailable", response)
 
     def show_cart(self):
+        #Fetches the cart from the server; it is displayed by on_cart.
+        self.network.submit('cart', lambda client: json.loads(client.request('VIEW_CART')))
+
+    def on_cart(self, lines):
         #Displays the contents of the cart.
+        self.cart = {line['id']: line['quantity'] for line in lines}
         cart_window = tk.Toplevel(self.root)
         cart_window.title("Your Cart")
         tk.Label(cart_window, text="Your Cart", font=("Arial", 16)).pack(pady=10)
         total_cost = 0
 
-        for product_id, quantity in self.cart.items():
-            product = next((item for item in inventory if item['id'] == product_id), None)
-            if product:
-                cost = product['price'] * quantity
-                total_cost += cost
-                cart_item = f"Name: {product['name']} | Quantity: {quantity} | Price: £{cost:.2f}"
-                tk.Label(cart_window, text=cart_item).pack()
-            else:
-                tk.Label(cart_window, text=f"Error retrieving details for product ID: {product_id}").pack()
+        for line in lines:
+            cost = line['price'] * line['quantity']
+            total_cost += cost
+            cart_item = f"Name: {line['name']} | Quantity: {line['quantity']} | Price: £{cost:.2f}"
+            tk.Label(cart_window, text=cart_item).pack()
 
         tk.Label(cart_window, text=f"Total: £{total_cost:.2f}", font=("Arial", 14)).pack(pady=10)
         tk.Button(cart_window, text="Checkout", command=lambda: self.prompt_payment(total_cost), bg="blue", fg="white").pack(side="left", padx=10)
@@ -120,24 +275,37 @@ class ShoppingClient:
         return True  # Assume sufficient funds for other payment methods
 
     def process_checkout(self):
-        #Processes the checkout by sending the cart details to the server.
-        messagebox.showinfo("Checkout Successful", "Your order has been placed successfully!")
-        self.cart = {}  # Clear cart after successful checkout
+        #Processes the checkout by sending CHECKOUT to the server; the answer arrives in on_checkout.
+        self.status.config(text="Checking out...")
+        self.network.submit('checkout', lambda client: json.loads(client.checkout()))
+
+    def on_checkout(self, result):
+        self.status.config(text=result['message'])
+        if result['success']:
+            messagebox.showinfo("Checkout Successful", "Your order has been placed successfully!")
+            self.cart = {}  # Clear cart after successful checkout
+        else:
+            messagebox.showerror("Checkout Failed", result['message'])
 
     def clear_cart(self, cart_window):
-        #Clears the cart and refreshes the cart view.
-        self.cart = {}
+        #Clears the cart on the server and closes the cart view.
+        product_ids = list(self.cart)
+        self.network.submit('clear', lambda client: client.send_requests(
+            [f'REMOVE_FROM_CART {product_id}' for product_id in product_ids]))
         cart_window.destroy()
+
+    def on_clear(self, responses):
+        self.cart = {}
         messagebox.showinfo("Cart Cleared", "Your cart has been cleared.")
 
-def main():
-    # Dummy client socket for demonstration
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client_socket.connect(('localhost', 5000))
+    def close(self):
+        self.network.close()
+        self.root.destroy()
 
-    app = ShoppingClient(client_socket)
+def main():
+    network = NetworkWorker('localhost', 5000)  # Connects in the background; the window opens at once
+    app = ShoppingClient(network)
     app.root.mainloop()
-    client_socket.close()
 
 if __name__ == "__main__":
     main()
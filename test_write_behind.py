@@ -0,0 +1,62 @@
+import json
+import os
+import tempfile
+import unittest
+
+from Import_sqlite3 import InventoryDatabase
+from write_behind import WriteBehindStore
+
+PRODUCTS = [(1, "Python Programming eBook", 10.99, 25), (2, "Photo Editing License", 29.99, 17)]
+
+
+class RecoverTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.directory.name, 'shop.db')
+        self.log_path = self.db_path + '.log'
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def open_store(self):
+        store = WriteBehindStore(InventoryDatabase(self.db_path), self.log_path, flush_interval=3600)
+        self.addCleanup(store.db.pool.close)
+        self.addCleanup(store.close)
+        return store
+
+    def stock(self, store):
+        return {product_id: stock for product_id, _, _, stock in store.load_products(PRODUCTS)}
+
+    def test_restart_replays_unflushed_changes(self):
+        store = self.open_store()
+        store.load_products(PRODUCTS)
+        store.close()
+        # A crash after these were logged but before the background flush applied them
+        with open(self.log_path, 'w', encoding='utf-8') as log_file:
+            log_file.write(json.dumps({'op': 'checkout', 'lines': [[1, 3, 10.99]], 'ts': 1.0, 'seq': 1}) + '\n')
+            log_file.write(json.dumps({'op': 'price', 'id': 2, 'price': 24.99, 'seq': 2}) + '\n')
+            log_file.write('{"op": "checkout", "lin')  # Torn final write
+
+        with self.assertLogs('vending', 'INFO') as logs:
+            store = self.open_store()
+        self.assertIn("Recovered 2 unflushed change(s)", logs.output[0])
+        self.assertEqual(self.stock(store), {1: 22, 2: 17})
+        self.assertEqual(store.last_seq, 2)
+        self.assertEqual(os.path.getsize(self.log_path), 0)
+
+    def test_restart_skips_changes_already_applied(self):
+        store = self.open_store()
+        store.load_products(PRODUCTS)
+        store.record_checkout([(1, 2, 10.99)])
+        store.flush()
+        store.close()
+        with open(self.log_path, 'w', encoding='utf-8') as log_file:
+            log_file.write(json.dumps({'op': 'checkout', 'lines': [[1, 2, 10.99]], 'ts': 1.0, 'seq': 1}) + '\n')
+
+        store = self.open_store()
+        self.assertEqual(self.stock(store), {1: 23, 2: 17})
+        self.assertEqual(store.last_seq, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
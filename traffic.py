@@ -0,0 +1,128 @@
+import itertools
+import json
+import struct
+import threading
+import time
+
+from metrics import log
+
+# Traffic capture for the Server_Code.py engines (see replay.py for playing it back;
+# the Import_sqlite3.py server is not covered).
+#
+# With --record PATH the server appends every request it runs to a compact binary
+# file, together with when each connection opened and closed and the session
+# tokens it handed out, so the traffic can later be replayed with its original
+# timing and concurrency.
+#
+#     header   magic b'VMR1', wall clock at start (f64), catalog length (u32),
+#              catalog JSON (the products when recording started; may be empty)
+#     record   kind (u8), seconds since start (f64), connection id (u32),
+#              request id (u32), payload length (u32), payload
+#
+# Times are taken when the server starts on a request. Writes go to a 1 MB
+# buffer under a lock and are flushed every second, so recording costs a struct
+# pack and a memcpy per request. RECORDER is shared by the whole process and does
+# nothing until start() is called.
+
+FILE_MAGIC = b'VMR1'
+HEADER = struct.Struct('!dI')
+RECORD = struct.Struct('!BdIII')
+
+OPEN = 0  # A connection was accepted
+REQUEST = 1  # A framed request; request id as sent by the client
+LEGACY = 2  # A request on an unframed connection (request id 0)
+CLOSE = 3  # The connection is gone
+SESSION = 4  # SESSION handed this token (the payload) to the connection
+KINDS = {OPEN: 'open', REQUEST: 'request', LEGACY: 'legacy', CLOSE: 'close', SESSION: 'session'}
+
+
+class CaptureError(ValueError):
+    pass
+
+
+class TrafficRecorder:
+    def __init__(self):
+        self.file = None  # Set while recording; checked on the hot path
+        self.records = 0
+        self._started = 0.0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def start(self, path, catalog=None, flush_interval=1.0):
+        # Start writing a capture to path. catalog: the product list the traffic starts from.
+        encoded = json.dumps(catalog).encode('utf-8') if catalog is not None else b''
+        file = open(path, 'wb', buffering=1 << 20)
+        file.write(FILE_MAGIC + HEADER.pack(time.time(), len(encoded)) + encoded)
+        self._started = time.monotonic()
+        self.file = file
+        threading.Thread(target=self._flush_periodically, args=(flush_interval,), name="traffic-flush",
+                         daemon=True).start()
+        log.info("Recording traffic to %s", path)
+
+    def opened(self):
+        # A connection was accepted. Returns its connection id (0 when not recording).
+        if not self.file:
+            return 0
+        connection_id = next(self._ids)
+        self._write(OPEN, connection_id, 0, b'')
+        return connection_id
+
+    def request(self, connection_id, request_id, request):
+        self._write(REQUEST if request_id is not None else LEGACY, connection_id, request_id or 0,
+                    request.encode('utf-8'))
+
+    def session(self, connection_id, token):
+        if self.file:
+            self._write(SESSION, connection_id, 0, token.encode('utf-8'))
+
+    def closed(self, connection_id):
+        if self.file and connection_id:
+            self._write(CLOSE, connection_id, 0, b'')
+
+    def _write(self, kind, connection_id, request_id, payload):
+        with self._lock:
+            if self.file:
+                self.file.write(RECORD.pack(kind, time.monotonic() - self._started, connection_id, request_id,
+                                            len(payload)) + payload)
+                self.records += 1
+
+    def _flush_periodically(self, interval):
+        while self.file:
+            time.sleep(interval)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self.file:
+                self.file.flush()
+
+    def stop(self):
+        with self._lock:
+            file, self.file = self.file, None
+        if file:
+            file.close()
+
+
+RECORDER = TrafficRecorder()
+
+
+def read_capture(path):
+    # Returns (wall clock at start, catalog or None, list of (kind, seconds, connection id,
+    # request id, payload)).
+    with open(path, 'rb') as file:
+        data = file.read()
+    if not data.startswith(FILE_MAGIC) or len(data) < len(FILE_MAGIC) + HEADER.size:
+        raise CaptureError(f"{path} is not a traffic capture")
+    started_at, catalog_length = HEADER.unpack_from(data, len(FILE_MAGIC))
+    offset = len(FILE_MAGIC) + HEADER.size
+    catalog = json.loads(data[offset:offset + catalog_length]) if catalog_length else None
+    offset += catalog_length
+    records = []
+    while offset + RECORD.size <= len(data):
+        kind, seconds, connection_id, request_id, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if offset + length > len(data):
+            break  # Cut off mid-record, e.g. the server was killed between flushes
+        records.append((kind, seconds, connection_id, request_id, data[offset:offset + length]))
+        offset += length
+    return started_at, catalog, records
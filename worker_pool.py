@@ -0,0 +1,316 @@
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import METRICS, log
+from protocol import MAGIC, FrameDecoder, ProtocolError, encode_frame
+
+# Serving core for the threaded engine: a fixed pool of worker threads instead of one
+# thread per connection.
+#
+# A single I/O thread watches every socket with a selector. When a connection's bytes
+# arrive it cuts them into requests and queues them on the connection; a connection
+# with queued requests is handed to the pool, and one worker at a time runs its
+# requests in order and writes back the replies in one sendall. So a connection storm
+# costs sockets, not threads, and a pipelined burst still takes one write.
+#
+# Admission control happens on the I/O thread, before a request reaches the pool:
+#
+#   rate          per-connection token bucket (requests per second, `burst` at most at once)
+#   max_queue     requests admitted but not yet run, across all connections
+#   max_wait      a request that waited longer than this for a worker is not run
+#
+# A request refused by any of these is not run but answered with a reply starting with
+# BUSY (framed clients receive it under the request's id), so admitted requests are
+# never stuck behind an unbounded backlog. Refusals are queued on the connection's
+# outbox and written by a worker like any other reply: the I/O thread never writes to
+# a socket, so a client that floods requests without reading its replies cannot stall
+# the other connections. Once max_unsent refusals are waiting for such a client, it is
+# disconnected. Connections without a request for idle_timeout seconds are closed,
+# unless keep_alive says otherwise (e.g. a SUBSCRIBE is active).
+
+BUSY = b'BUSY Server overloaded, try again later.'
+RATE_LIMITED = b'BUSY Rate limit exceeded, slow down.'
+
+
+class Connection:
+    def __init__(self, client_socket, burst):
+        self.socket = client_socket
+        self.preamble = b''  # First bytes, until they show whether the client speaks the framed protocol
+        self.decoder = None  # FrameDecoder for framed connections
+        self.framed = None  # None until decided
+        self.requests = deque()  # (request_id or None for legacy, payload, time queued)
+        self.outbox = deque()  # Pushed SUBSCRIBE frames and BUSY replies, written by the next worker run
+        self.scheduled = False  # Handed to the pool; only one worker runs a connection at a time
+        self.closed = False
+        self.lock = threading.Lock()  # Guards requests, outbox, scheduled and closed
+        self.send_lock = threading.Lock()
+        self.tokens = burst
+        self.refilled = time.monotonic()
+        self.last_active = self.refilled
+        self.state = None  # Whatever open_client returned for this connection
+
+
+class PooledPusher:
+    # Push target for SUBSCRIBE on a pooled connection (see changefeed.py). Frames wait
+    # in the connection's outbox and a pool worker writes them, so subscribers do not
+    # need threads of their own.
+    def __init__(self, server, connection, limit=1000):
+        self.server = server
+        self.connection = connection
+        self.limit = limit
+
+    def push(self, frame):
+        with self.connection.lock:
+            if len(self.connection.outbox) >= self.limit:
+                return False
+            self.connection.outbox.append(frame)
+        self.server.schedule(self.connection)
+        return True
+
+    def force(self, frame):
+        # Queue frame even when full, dropping whatever is still waiting.
+        with self.connection.lock:
+            if len(self.connection.outbox) >= self.limit:
+                self.connection.outbox.clear()
+            self.connection.outbox.append(frame)
+        self.server.schedule(self.connection)
+
+    def close(self):
+        pass
+
+
+class PooledServer:
+    def __init__(self, server_socket, open_client, handle, close_client, keep_alive=None, workers=32,
+                 max_queue=1024, max_wait=2.0, rate=0.0, burst=None, idle_timeout=300.0, send_timeout=10.0,
+                 max_unsent=4096):
+        # open_client(connection) -> per-connection state; handle(state, payload, request_id) ->
+        # reply bytes or None; close_client(state) when the connection is gone;
+        # keep_alive(state) -> True to exempt an idle connection from idle_timeout.
+        # rate 0 disables the rate limit and idle_timeout 0 the idle check.
+        # max_unsent: BUSY replies a connection may have waiting before it is disconnected.
+        self.server_socket = server_socket
+        self.open_client = open_client
+        self.handle = handle
+        self.close_client = close_client
+        self.keep_alive = keep_alive
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.idle_timeout = idle_timeout
+        self.send_timeout = send_timeout
+        self.max_unsent = max_unsent
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='request-worker')
+        self.selector = selectors.DefaultSelector()
+        self.connections = set()
+        self.queued = 0  # Requests admitted and not yet run
+        self._queued_lock = threading.Lock()
+
+    def serve_forever(self):
+        self.server_socket.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+        next_sweep = time.monotonic() + 1.0
+        while True:
+            for key, _ in self.selector.select(timeout=1.0):
+                if key.fileobj is self.server_socket:
+                    self._accept()
+                else:
+                    self._read(key.data)
+            if self.idle_timeout and time.monotonic() >= next_sweep:
+                self._close_idle()
+                next_sweep = time.monotonic() + 1.0
+
+    def _accept(self):
+        while True:
+            try:
+                client_socket, _ = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:  # e.g. out of file descriptors: leave the rest in the backlog
+                log.warning("Accept failed: %s", e)
+                return
+            log.debug("Client connected.")
+            client_socket.settimeout(self.send_timeout)  # Bounds how long a worker waits on a slow reader
+            connection = Connection(client_socket, self.burst)
+            connection.state = self.open_client(connection)
+            self.connections.add(connection)
+            self.selector.register(client_socket, selectors.EVENT_READ, connection)
+
+    def _read(self, connection):
+        try:
+            data = connection.socket.recv(65536)
+        except (BlockingIOError, InterruptedError, socket.timeout):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._close(connection)  # The client disconnected
+            return
+        connection.last_active = time.monotonic()
+        try:
+            requests = self._split(connection, data)
+        except ProtocolError as e:
+            log.warning("Error handling client: %s", e)
+            self._close(connection)
+            return
+        if requests:
+            self._admit(connection, requests)
+
+    def _split(self, connection, data):
+        # Cut what arrived into (request_id, payload) requests. Legacy connections send
+        # one command per recv and have no request ids.
+        if connection.framed is None:
+            connection.preamble += data
+            preamble = connection.preamble
+            if len(preamble) < len(MAGIC) and MAGIC.startswith(preamble):
+                return []  # Could still be the start of MAGIC
+            connection.framed = preamble.startswith(MAGIC)
+            connection.preamble = b''
+            if not connection.framed:
+                return [(None, preamble)]
+            connection.decoder = FrameDecoder(preamble[len(MAGIC):])
+        elif connection.framed:
+            connection.decoder.feed(data)
+        else:
+            return [(None, data)]
+        return connection.decoder.frames()
+
+    def _admit(self, connection, requests):
+        refused = []
+        if self.rate:
+            now = time.monotonic()
+            connection.tokens = min(self.burst, connection.tokens + (now - connection.refilled) * self.rate)
+            connection.refilled = now
+            allowed = min(len(requests), int(connection.tokens))
+            connection.tokens -= allowed
+            if allowed < len(requests):
+                refused = [(request_id, RATE_LIMITED) for request_id, _ in requests[allowed:]]
+                METRICS.increment('busy.rate_limited', len(refused))
+                requests = requests[:allowed]
+        if requests:
+            with self._queued_lock:
+                admitted = self.queued + len(requests) <= self.max_queue
+                if admitted:
+                    self.queued += len(requests)
+            if admitted:
+                queued_at = time.monotonic()
+                with connection.lock:
+                    connection.requests.extend((request_id, payload, queued_at) for request_id, payload in requests)
+                self.schedule(connection)
+            else:
+                refused += [(request_id, BUSY) for request_id, _ in requests]
+                METRICS.increment('busy.queue_full', len(requests))
+        if refused:
+            self._refuse(connection, [self._reply(connection, request_id, reply) for request_id, reply in refused])
+
+    def _refuse(self, connection, replies):
+        # I/O thread: queue BUSY replies for a worker to write. A client that lets them
+        # pile up is not reading its socket, so it is disconnected instead.
+        with connection.lock:
+            overflow = len(connection.outbox) + len(replies) > self.max_unsent
+            if not overflow:
+                connection.outbox.extend(replies)
+        if overflow:
+            log.debug("Closing a connection that does not read its replies.")
+            METRICS.increment('connections.unread_closed')
+            self._shutdown(connection)  # Also wakes a worker blocked sending to it
+            self._close(connection)
+            return
+        self.schedule(connection)
+
+    def schedule(self, connection):
+        # Make sure a worker will run the connection's queued requests and pushed frames.
+        with connection.lock:
+            if connection.scheduled or connection.closed:
+                return
+            connection.scheduled = True
+        self.executor.submit(self._run, connection)
+
+    def _run(self, connection):
+        # Worker: run the connection's requests in order until none are left.
+        while True:
+            with connection.lock:
+                finished = connection.closed or not (connection.requests or connection.outbox)
+                if finished:
+                    connection.scheduled = False
+                else:
+                    requests = list(connection.requests)
+                    connection.requests.clear()
+                    out = list(connection.outbox)
+                    connection.outbox.clear()
+            if finished:
+                if connection.closed:
+                    self._drop(connection)  # _close left it to us
+                return
+            now = time.monotonic()
+            for request_id, payload, queued_at in requests:
+                if now - queued_at > self.max_wait:
+                    reply = BUSY  # Waited too long; the client has likely given up on it anyway
+                    METRICS.increment('busy.queue_timeout')
+                else:
+                    try:
+                        reply = self.handle(connection.state, payload, request_id)
+                    except Exception as e:
+                        log.warning("Error handling client: %s", e)
+                        reply = None
+                        self._shutdown(connection)
+                if reply is not None:
+                    out.append(self._reply(connection, request_id, reply))
+            with self._queued_lock:
+                self.queued -= len(requests)
+            if out:
+                self._send(connection, b''.join(out))
+
+    def _reply(self, connection, request_id, reply):
+        return encode_frame(request_id, reply) if connection.framed else reply
+
+    def _send(self, connection, data):
+        try:
+            with connection.send_lock:
+                connection.socket.sendall(data)
+        except OSError:  # Includes the send timeout
+            self._shutdown(connection)
+
+    def _shutdown(self, connection):
+        # Called from workers: wake the I/O thread, which sees end of file and closes the connection.
+        try:
+            connection.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _close(self, connection):
+        # I/O thread: stop watching the connection. The socket and the client state are
+        # released at once, or by the worker running it when it finishes.
+        if connection not in self.connections:
+            return
+        self.connections.discard(connection)
+        self.selector.unregister(connection.socket)
+        with connection.lock:
+            connection.closed = True
+            if connection.scheduled:
+                return
+        self._drop(connection)
+
+    def _drop(self, connection):
+        with self._queued_lock:
+            self.queued -= len(connection.requests)
+        connection.requests.clear()
+        try:
+            self.close_client(connection.state)
+        except Exception as e:
+            log.warning("Error closing client: %s", e)
+        connection.socket.close()
+
+    def _close_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        for connection in list(self.connections):
+            if connection.last_active < deadline and not connection.scheduled:
+                if self.keep_alive and self.keep_alive(connection.state):
+                    continue
+                log.debug("Closing idle connection.")
+                METRICS.increment('connections.idle_closed')
+                self._close(connection)
@@ -0,0 +1,149 @@
+import json
+import os
+import threading
+import time
+
+from Import_sqlite3 import insert_order, transaction
+from metrics import METRICS, log
+
+# Write-behind persistence for the in-memory Inventory.
+#
+# Reads are served from the Product objects in memory. Every change that has to
+# survive a restart is first appended to a local log file (cheap sequential write)
+# and queued; a background thread applies the queued changes to SQLite in one
+# transaction every flush_interval seconds. The database remembers the sequence
+# number of the last change it applied, so after a crash the log is replayed from
+# that point and nothing acknowledged to a client is lost.
+
+CREATE_STATE_SQL = (
+    'CREATE TABLE IF NOT EXISTS write_behind_state ('
+    'id INTEGER PRIMARY KEY CHECK (id = 1), last_seq INTEGER NOT NULL)'
+)
+APPLY_SALE_SQL = 'UPDATE products SET stock = stock - ? WHERE id = ?'
+UPDATE_PRICE_SQL = 'UPDATE products SET price = ? WHERE id = ?'
+INSERT_PRODUCT_SQL = 'INSERT INTO products (id, name, price, stock) VALUES (?, ?, ?, ?)'
+
+
+class WriteBehindStore:
+    def __init__(self, db, log_path, flush_interval=1.0, fsync=False):
+        # db: Import_sqlite3.InventoryDatabase
+        # log_path: append-only log of changes not yet known to be in the database
+        # fsync: also fsync each log record (survives power loss, not just a crash)
+        self.db = db
+        self.log_path = log_path
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self._lock = threading.Lock()  # Guards the log file, the pending list and the sequence
+        self._pending = []
+        self._flush_lock = threading.Lock()  # One flush at a time
+        self._stop = threading.Event()
+
+        self.db.create_schema()
+        with self.db.pool.connection() as connection:
+            with transaction(connection):
+                connection.execute(CREATE_STATE_SQL)
+        self.last_seq = self.recover()
+        self._log = open(self.log_path, 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def _flushed_seq(self, connection):
+        row = connection.execute('SELECT last_seq FROM write_behind_state WHERE id = 1').fetchone()
+        return row[0] if row else 0
+
+    def recover(self):
+        # Replay log records the database has not applied yet, then empty the log.
+        # Returns the highest sequence number seen.
+        records = []
+        if os.path.exists(self.log_path):
+            with open(self.log_path, encoding='utf-8') as log_file:
+                for line in log_file:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break  # Torn final write from a crash; nothing after it was acknowledged
+        with self.db.pool.connection() as connection:
+            with transaction(connection):
+                flushed = self._flushed_seq(connection)
+                unapplied = [record for record in records if record['seq'] > flushed]
+                self._apply(connection, unapplied)
+                last_seq = max([flushed] + [record['seq'] for record in records])
+        if unapplied:
+            log.info("Recovered %d unflushed change(s) from %s", len(unapplied), self.log_path)
+        open(self.log_path, 'w').close()
+        return last_seq
+
+    def load_products(self, defaults):
+        # Return the durable product rows, seeding the database with defaults when it is empty.
+        with self.db.pool.connection() as connection:
+            with transaction(connection):
+                if connection.execute('SELECT COUNT(*) FROM products').fetchone()[0] == 0:
+                    connection.executemany(INSERT_PRODUCT_SQL, defaults)
+                return connection.execute('SELECT id, name, price, stock FROM products ORDER BY id').fetchall()
+
+    def record_checkout(self, lines):
+        # Make a completed checkout durable. lines is a list of (product_id, quantity, price).
+        self._append({'op': 'checkout', 'lines': lines, 'ts': time.time()})
+
+    def record_price(self, product_id, price):
+        # Make a price change durable.
+        self._append({'op': 'price', 'id': product_id, 'price': price})
+
+    def _append(self, record):
+        with self._lock:
+            self.last_seq += 1
+            record['seq'] = self.last_seq
+            self._log.write(json.dumps(record) + '\n')
+            self._log.flush()
+            if self.fsync:
+                os.fsync(self._log.fileno())
+            self._pending.append(record)
+
+    def _apply(self, connection, records):
+        for record in records:
+            if record['op'] == 'checkout':
+                connection.executemany(APPLY_SALE_SQL, [(quantity, product_id)
+                                                        for product_id, quantity, _ in record['lines']])
+                insert_order(connection, record['lines'], record['ts'])
+            elif record['op'] == 'price':
+                connection.execute(UPDATE_PRICE_SQL, (record['price'], record['id']))
+        if records:
+            connection.execute('INSERT OR REPLACE INTO write_behind_state (id, last_seq) VALUES (1, ?)',
+                               (records[-1]['seq'],))
+
+    def flush(self):
+        # Apply every pending change to the database in one transaction.
+        with self._flush_lock:
+            with self._lock:
+                records, self._pending = self._pending, []
+            if not records:
+                return 0
+            started = METRICS.start()
+            try:
+                with self.db.pool.connection() as connection:
+                    with transaction(connection):
+                        self._apply(connection, records)
+            except Exception:
+                with self._lock:
+                    self._pending[:0] = records  # Keep them for the next attempt
+                raise
+            METRICS.observe('sqlite.flush', started)
+            with self._lock:
+                if not self._pending:
+                    # Everything logged is now in the database, so the log can start over
+                    self._log.seek(0)
+                    self._log.truncate()
+            return len(records)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                log.warning("Write-behind flush failed, will retry: %s", e)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+        self._log.close()